@@ -3,4 +3,8 @@ from django.apps import AppConfig
 
 class ChessboardConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
-    name = "chessboard"
\ No newline at end of file
+    name = "chessboard"
+
+    def ready(self):
+        # Register the login/logout signal handlers
+        from . import presence, sessions  # noqa: F401
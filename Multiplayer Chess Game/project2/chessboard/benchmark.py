@@ -0,0 +1,294 @@
+"""Load generation for the polling endpoints, and a login latency benchmark.
+
+Simulated clients run in threads, each with its own test Client, so requests
+go through the full middleware and view stack without a network in between.
+Every request is timed and its database queries counted on the thread's own
+connection.
+"""
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .models import Game, UserPresence, UserSession
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Collects (latency, query count, status) samples per endpoint, from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(list)
+        self._queries = defaultdict(list)
+        self._statuses = defaultdict(Counter)
+
+    def record(self, endpoint, seconds, queries, status):
+        with self._lock:
+            self._latencies[endpoint].append(seconds)
+            self._queries[endpoint].append(queries)
+            self._statuses[endpoint][status] += 1
+
+    def summary(self, elapsed):
+        """{endpoint: stats}; latencies in milliseconds, throughput in requests per second."""
+        with self._lock:
+            endpoints = {}
+            for endpoint, latencies in sorted(self._latencies.items()):
+                latencies = sorted(latencies)
+                queries = self._queries[endpoint]
+                statuses = self._statuses[endpoint]
+                endpoints[endpoint] = {
+                    'requests': len(latencies),
+                    'errors': sum(count for status, count in statuses.items() if status >= 500),
+                    'statuses': {str(status): count for status, count in sorted(statuses.items())},
+                    'throughput': len(latencies) / elapsed if elapsed else 0,
+                    'mean_ms': sum(latencies) / len(latencies) * 1000,
+                    'p50_ms': percentile(latencies, 50) * 1000,
+                    'p95_ms': percentile(latencies, 95) * 1000,
+                    'p99_ms': percentile(latencies, 99) * 1000,
+                    'max_ms': latencies[-1] * 1000,
+                    'queries_per_request': sum(queries) / len(queries),
+                    'max_queries': max(queries),
+                }
+            return endpoints
+
+
+class BenchmarkClient:
+    """A test client, logged in as `user` if given, that records every request it makes."""
+
+    def __init__(self, user, recorder):
+        self.user = user
+        self.recorder = recorder
+        self.client = Client(raise_request_exception=False)
+        if user is not None:
+            self.client.force_login(user)
+
+    def clone(self):
+        """Another client for the same user, for a second tab's worth of requests."""
+        return BenchmarkClient(self.user, self.recorder)
+
+    def request(self, endpoint, method, path, **extra):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            started = time.perf_counter()
+            response = getattr(self.client, method)(path, **extra)
+            elapsed = time.perf_counter() - started
+        self.recorder.record(endpoint, elapsed, queries, response.status_code)
+        return response
+
+
+def seed(users, games, prefix='bench'):
+    """Create `users` users, the first 2 * `games` of them paired up in active games.
+
+    Returns (players, lobby): a list of (game, white, black) and the users not
+    in a game. Everyone gets a fresh presence heartbeat, as if their tab were open.
+    """
+    if games * 2 > users:
+        raise ValueError('Each game needs two players of its own')
+    User.objects.filter(username__startswith=f'{prefix}-').delete()
+    User.objects.bulk_create([User(username=f'{prefix}-{i}') for i in range(users)])
+    # Some backends do not return primary keys from bulk_create
+    accounts = list(User.objects.filter(username__startswith=f'{prefix}-').order_by('id'))
+    now = timezone.now()
+    UserPresence.objects.bulk_create([UserPresence(user=user, last_seen=now) for user in accounts])
+
+    Game.objects.bulk_create([Game(player1=accounts[2 * i], player2=accounts[2 * i + 1]) for i in range(games)])
+    created = Game.objects.filter(player1__in=accounts[:2 * games:2], active=True).select_related('player1', 'player2')
+    players = [(game, game.player1, game.player2) for game in created.order_by('id')]
+    return players, accounts[2 * games:]
+
+
+class Simulation:
+    """Runs lobby and player clients against the views until the deadline.
+
+    Clients make the same requests as the pages do. Lobby clients poll the
+    online list with If-None-Match and hold a long-poll open on the challenge
+    inbox. Players long-poll their game's state (?since=<version>) and, when
+    it is their turn, think for about one interval and submit a random legal
+    move.
+    """
+
+    def __init__(self, recorder, interval=1.0, seed=0):
+        self.recorder = recorder
+        self.interval = interval
+        self.seed = seed
+        self._threads = []
+
+    def add_lobby(self, user):
+        self._add(self._lobby, user)
+
+    def add_player(self, user, game, color):
+        self._add(self._player, user, game.id, color)
+
+    def _add(self, target, user, *args):
+        rng = random.Random(f'{self.seed}-{user.id}')
+        self._threads.append((target, user, rng, args))
+
+    def run(self, duration):
+        """Run every client for `duration` seconds; returns the wall time taken."""
+        # Log everyone in first, so the session writes are not part of the run
+        clients = [(target, BenchmarkClient(user, self.recorder), rng, args)
+                   for target, user, rng, args in self._threads]
+        started = time.monotonic()
+        deadline = started + duration
+        threads = [
+            threading.Thread(target=self._run_client, args=(target, client, rng, deadline, *args), daemon=True)
+            for target, client, rng, args in clients
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+    def _run_client(self, target, client, rng, deadline, *args):
+        try:
+            # Spread the first requests over one interval, like tabs opened at different times
+            time.sleep(rng.uniform(0, self.interval))
+            target(client, rng, deadline, *args)
+        finally:
+            connection.close()
+
+    def _pace(self, rng, started):
+        # Poll roughly once per interval, with jitter so clients do not move in lockstep
+        time.sleep(max(rng.uniform(0.8, 1.2) * self.interval - (time.monotonic() - started), 0))
+
+    def _lobby(self, client, rng, deadline):
+        # The inbox long-poll runs alongside the online list poll, as on the page
+        inbox = threading.Thread(target=self._run_client, args=(self._inbox, client.clone(), rng, deadline), daemon=True)
+        inbox.start()
+        etag = None
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+            response = client.request('online_users_ajax', 'get', reverse('online_users_ajax'), **headers)
+            if response.status_code == 200:
+                etag = response['ETag']
+            self._pace(rng, started)
+        inbox.join()
+
+    def _inbox(self, client, rng, deadline):
+        url = reverse('challenge_inbox')
+        while (remaining := deadline - time.monotonic()) > 0:
+            client.request('challenge_inbox', 'get', url, data={'after': 0, 'timeout': remaining})
+
+    def _player(self, client, rng, deadline, game_id, color):
+        state_url = reverse('get_game_state', args=[game_id])
+        move_url = reverse('submit_move', args=[game_id])
+        etag = None
+        version = None
+        while (remaining := deadline - time.monotonic()) > 0:
+            # The first request loads the board, like opening the page; after
+            # that the server holds each one until the opponent moves
+            params = {'format': 'compact'}
+            if version is not None:
+                params.update(since=version, timeout=remaining)
+            headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+            response = client.request('get_game_state', 'get', state_url, data=params, **headers)
+            if response.status_code != 200:
+                continue
+            etag = response['ETag']
+            state = json.loads(response.content)
+            version = state['v']
+            if not state['a']:
+                # Game over: back to the lobby for the rest of the run
+                return self._lobby(client, rng, deadline)
+            if state['fen'].split()[1] == color and state['lm']:
+                time.sleep(rng.uniform(0.5, 1.5) * self.interval)
+                response = client.request('submit_move', 'post', move_url, content_type='application/json', data={
+                    'uci': rng.choice(state['lm'].split()), 'version': version,
+                })
+                if response.status_code == 200:
+                    version = json.loads(response.content)['v']
+
+
+# Logins are timed with a fast hasher: PBKDF2 would take most of the time
+# and hide how the session bookkeeping scales
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+LOGIN_PASSWORD = 'benchmark'
+
+
+def seed_sessions(total, password):
+    """Top the session table up to `total` live sessions, each for a different logged-in user."""
+    missing = total - Session.objects.filter(expire_date__gte=timezone.now()).count()
+    if missing <= 0:
+        return
+    first = User.objects.filter(username__startswith='bench-online-').count()
+    expire_date = timezone.now() + timedelta(days=1)
+    for start in range(first, first + missing, 5000):
+        names = [f'bench-online-{i}' for i in range(start, min(start + 5000, first + missing))]
+        User.objects.bulk_create([User(username=name, password=password) for name in names])
+        users = User.objects.filter(username__in=names)
+        keys = {user.id: get_random_string(32) for user in users}
+        Session.objects.bulk_create([
+            Session(session_key=key, session_data=SessionStore().encode({'_auth_user_id': str(user_id)}),
+                    expire_date=expire_date)
+            for user_id, key in keys.items()
+        ])
+        UserSession.objects.bulk_create([UserSession(session_key=key, user_id=user_id) for user_id, key in keys.items()])
+
+
+def benchmark_logins(recorder, session_counts, logins, users=200, seed=0):
+    """Time user_login as the number of live sessions grows through `session_counts`.
+
+    Each step is recorded as its own endpoint, 'user_login (<n> sessions)', so
+    a flat p50 across the steps means login cost does not depend on how many
+    other people are logged in.
+    """
+    rng = random.Random(seed)
+    with override_settings(PASSWORD_HASHERS=FAST_HASHERS):
+        password = make_password(LOGIN_PASSWORD)
+        User.objects.filter(username__startswith='bench-login-').delete()
+        User.objects.bulk_create([User(username=f'bench-login-{i}', password=password) for i in range(users)])
+        accounts = list(User.objects.filter(username__startswith='bench-login-'))
+        for count in sorted(session_counts):
+            seed_sessions(count, password)
+            endpoint = f'user_login ({count} sessions)'
+            for _ in range(logins):
+                # A fresh, anonymous client each time, like a new browser
+                BenchmarkClient(None, recorder).request(endpoint, 'post', reverse('login'), data={
+                    'username': rng.choice(accounts).username, 'password': LOGIN_PASSWORD,
+                })
+
+
+def format_summary(endpoints):
+    """A plain-text table of Recorder.summary() output."""
+    columns = ('requests', 'errors', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'queries_per_request')
+    headings = ('requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'queries')
+    width = max([len('endpoint')] + [len(name) for name in endpoints])
+    lines = ['endpoint'.ljust(width) + ''.join(h.rjust(10) for h in headings)]
+    for name, stats in endpoints.items():
+        cells = []
+        for column in columns:
+            value = stats[column]
+            cells.append(f'{value:10d}' if isinstance(value, int) else f'{value:10.1f}')
+        lines.append(name.ljust(width) + ''.join(cells))
+    return '\n'.join(lines)
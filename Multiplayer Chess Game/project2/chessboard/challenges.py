@@ -0,0 +1,146 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import game_list, realtime
+from .models import Challenge, Game
+
+# How long a challenge waits for an answer before it expires
+CHALLENGE_TIMEOUT = getattr(settings, 'CHALLENGE_TIMEOUT', 60)
+
+# Upper bound on how long an inbox request is held open
+INBOX_WAIT = 25
+# How often a waiting inbox request re-checks the database, for challenges
+# sent through another server process that our in-process hub cannot see
+INBOX_RECHECK = 5
+
+
+def inbox_channel(user_id):
+    return f'inbox:{user_id}'
+
+
+class ChallengeError(Exception):
+    """The challenge cannot be sent or accepted; the message says why."""
+
+
+def _notify_on_commit(user_id):
+    transaction.on_commit(lambda: realtime.hub.publish(inbox_channel(user_id), None))
+
+
+def _lock_players(*user_ids):
+    # Serializes challenge sends and accepts involving these users. Always
+    # locked in id order, so two transactions never wait on each other
+    list(User.objects.select_for_update().filter(id__in=user_ids).order_by('id').values_list('id', flat=True))
+
+
+def _pending():
+    # Pending and not yet overdue; overdue rows are marked expired by expire_stale()
+    return Challenge.objects.filter(status=Challenge.Status.PENDING, expires_at__gt=timezone.now())
+
+
+def send_challenge(challenger, recipient):
+    """Send a challenge; raises ChallengeError if one is already pending between the two players."""
+    expire_stale()
+    with transaction.atomic():
+        _lock_players(challenger.id, recipient.id)
+        if _pending().filter(
+            Q(challenger=challenger, recipient=recipient) | Q(challenger=recipient, recipient=challenger)
+        ).exists():
+            raise ChallengeError('There is already a pending challenge between you and this player.')
+        challenge = Challenge.objects.create(
+            challenger=challenger,
+            recipient=recipient,
+            expires_at=timezone.now() + timedelta(seconds=CHALLENGE_TIMEOUT),
+        )
+        _notify_on_commit(recipient.id)
+    return challenge
+
+
+def respond(challenge_id, user, accept):
+    """Accept or decline a pending challenge sent to `user`.
+
+    Returns the challenge, with its new game if accepted, or None if it is no
+    longer pending (already answered, or expired). Accepting raises
+    ChallengeError, leaving the challenge pending, if either player is
+    already in a game: a user plays at most one game at a time.
+    """
+    status = Challenge.Status.ACCEPTED if accept else Challenge.Status.DECLINED
+    with transaction.atomic():
+        challenge = _pending().filter(id=challenge_id, recipient=user).select_related('challenger').first()
+        if challenge is None:
+            return None
+        if accept:
+            _lock_players(challenge.challenger_id, user.id)
+            if Game.objects.filter(
+                Q(player1_id__in=[challenge.challenger_id, user.id]) | Q(player2_id__in=[challenge.challenger_id, user.id]),
+                active=True,
+            ).exists():
+                raise ChallengeError(f'You or {challenge.challenger.username} are already playing a game.')
+        updated = _pending().filter(id=challenge_id).update(status=status)
+        if not updated:
+            return None
+        challenge.status = status
+        if accept:
+            challenge.game = Game.objects.create(player1=challenge.challenger, player2=user, active=True)
+            challenge.save(update_fields=['game'])
+            game_list.invalidate(challenge.challenger_id, user.id)
+    # Wake the challenger's lobby so it hears the answer straight away
+    _notify_on_commit(challenge.challenger_id)
+    return challenge
+
+
+def expire_stale():
+    """Mark overdue pending challenges as expired.
+
+    Reads already treat them as expired; this only keeps the pending inbox
+    index small, so it runs when a challenge is sent, not on every poll.
+    """
+    Challenge.objects.filter(status=Challenge.Status.PENDING, expires_at__lte=timezone.now()).update(
+        status=Challenge.Status.EXPIRED
+    )
+
+
+def inbox_state(user, after=0, sent=None):
+    """What the lobby needs to react to, or None if there is nothing new.
+
+    after: the last received challenge id the client has already shown
+    sent: id of a challenge the client sent and is waiting on
+    """
+    if Game.objects.filter(Q(player1=user) | Q(player2=user), active=True).exists():
+        return {'game_started': True}
+
+    received = [
+        {'id': c.id, 'challenger': c.challenger.username}
+        for c in _pending().filter(recipient=user, id__gt=after).select_related('challenger').order_by('id')
+    ]
+    sent_status = None
+    if sent is not None:
+        sent_challenge = Challenge.objects.filter(id=sent, challenger=user).values_list('status', 'expires_at').first()
+        if sent_challenge is not None:
+            sent_status, expires_at = sent_challenge
+            if sent_status == Challenge.Status.PENDING and expires_at <= timezone.now():
+                sent_status = Challenge.Status.EXPIRED
+    if received or (sent_status is not None and sent_status != Challenge.Status.PENDING):
+        return {'game_started': False, 'challenges': received, 'sent_status': sent_status}
+    return None
+
+
+def wait_for_inbox(user, after=0, sent=None, timeout=INBOX_WAIT):
+    """Block until inbox_state() has something for the user, or the timeout expires."""
+    deadline = time.monotonic() + timeout
+    # Listen before reading the inbox, so a challenge sent in between still wakes us
+    with realtime.hub.listen(inbox_channel(user.id)) as published:
+        while True:
+            published.clear()
+            state = inbox_state(user, after, sent)
+            if state is not None:
+                return state
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {'game_started': False, 'challenges': [], 'sent_status': None}
+            published.wait(min(remaining, INBOX_RECHECK))
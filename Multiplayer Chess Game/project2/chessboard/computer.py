@@ -0,0 +1,225 @@
+"""The computer opponent and move hints, searched off the request thread.
+
+Searches run in a pool of worker processes (see engine.py), so a request never
+waits on one and the search does not hold the GIL of the web process. When a
+search finishes its result is handed to a small thread pool here:
+
+- a computer move is played through gameplay.play_move, so it is committed and
+  published exactly like a human move and reaches both players through the
+  usual game-state long-poll and websocket;
+- a hint is cached per game version and user, and anyone waiting on it is
+  woken through the hub. Hints are never put in the game state, which the
+  opponent can see too.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX, make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+
+from . import engine, game_list, realtime
+from .models import Game
+from .rendering import normalize_fen
+
+logger = logging.getLogger(__name__)
+
+ENGINE_WORKERS = getattr(settings, 'ENGINE_WORKERS', 2)
+# Seconds the computer thinks per move, and per hint
+ENGINE_MOVE_TIME = getattr(settings, 'ENGINE_MOVE_TIME', 1.0)
+ENGINE_HINT_TIME = getattr(settings, 'ENGINE_HINT_TIME', 0.5)
+COMPUTER_USERNAME = getattr(settings, 'COMPUTER_USERNAME', 'computer')
+
+# Hints are only useful while the position stands, but keep them a while for page reloads
+HINT_TIMEOUT = 300
+# Upper bound on how long a hint request is held open
+HINT_WAIT = 10
+# How often a waiting hint request re-checks the cache, for hints computed by
+# another server process that our in-process hub cannot see
+HINT_RECHECK = 1
+
+_lock = threading.Lock()
+_pool = None
+# Where finished searches are applied; the pool's own callback thread must not block
+_committer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='engine-commit')
+# (game id, version) of the computer moves being searched, so each is searched once
+_pending = set()
+_computer_id = None
+
+
+def _search(fen, time_budget):
+    """Submit a search to the worker pool; returns a future of engine.SearchResult."""
+    global _pool
+    with _lock:
+        if _pool is None:
+            # Spawn rather than fork: forking a threaded server process is unsafe
+            _pool = ProcessPoolExecutor(ENGINE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            return _pool.submit(engine.search_fen, fen, time_budget)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool
+            _pool = ProcessPoolExecutor(ENGINE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            return _pool.submit(engine.search_fen, fen, time_budget)
+
+
+def _when_done(future, apply, *args):
+    # Run `apply(result, *args)` on the committer threads once the search finishes
+    def done(future):
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception('event=engine_search_failed')
+            result = None
+        _committer.submit(_run, apply, result, *args)
+    future.add_done_callback(done)
+
+
+def _run(apply, result, *args):
+    close_old_connections()
+    try:
+        apply(result, *args)
+    except Exception:
+        logger.exception('event=engine_result_failed')
+    finally:
+        close_old_connections()
+
+
+def _computer_users():
+    # The account is told apart from a person who registered the same name
+    # by its unusable password (JoinForm also reserves the name)
+    return User.objects.filter(username=COMPUTER_USERNAME, password__startswith=UNUSABLE_PASSWORD_PREFIX)
+
+
+def computer_id():
+    """Id of the computer's account, or None if nobody has played the computer yet. Never creates it."""
+    global _computer_id
+    if _computer_id is None:
+        _computer_id = _computer_users().values_list('id', flat=True).first()
+    return _computer_id
+
+
+def computer_user():
+    """The user the computer plays as, created on first use; only for the computer-game paths.
+
+    Raises ImproperlyConfigured if a person already has the name.
+    """
+    global _computer_id
+    user, created = User.objects.get_or_create(
+        username=COMPUTER_USERNAME,
+        # Created in one INSERT; inactive, so it cannot log in or be challenged
+        defaults={'password': make_password(None), 'is_active': False},
+    )
+    if not created and user.has_usable_password():
+        raise ImproperlyConfigured(f'User {COMPUTER_USERNAME!r} is a person; set COMPUTER_USERNAME')
+    _computer_id = user.id
+    return user
+
+
+def is_computer(user_id):
+    return user_id is not None and user_id == computer_id()
+
+
+def start_game(user):
+    """Start a game of `user` (white) against the computer."""
+    game = Game.objects.create(player1=user, player2=computer_user(), active=True)
+    game_list.invalidate(user.id, game.player2_id)
+    return game
+
+
+def computer_to_move(game):
+    """True if the game is active and it is the computer's turn."""
+    if not game.active:
+        return False
+    return is_computer(game.player1_id if game.turn == 'white' else game.player2_id)
+
+
+def schedule_move(game):
+    """Have the computer reply in `game` if it is its turn; the move is committed in the background."""
+    if not computer_to_move(game):
+        return
+    key = (game.id, game.version)
+    with _lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+    # Search only once the human's move is committed
+    transaction.on_commit(lambda: _when_done(_search(normalize_fen(game.fen), ENGINE_MOVE_TIME), _play, key))
+
+
+def _play(result, key):
+    from . import gameplay
+
+    game_id, version = key
+    try:
+        if result is None or result.move is None:
+            return
+        game = Game.objects.select_related('player1', 'player2').filter(id=game_id).first()
+        if game is None or not game.active:
+            return
+        try:
+            gameplay.play_move(game, User(id=computer_id()), result.move, seen_version=version)
+        except gameplay.MoveConflict:
+            pass  # The human resigned, or the game moved on, while we were thinking
+        else:
+            logger.info('event=computer_move game=%s move=%s depth=%s nodes=%s nps=%s',
+                        game_id, result.move, result.depth, result.nodes, result.nps)
+    finally:
+        with _lock:
+            _pending.discard(key)
+
+
+def hint_key(game, user):
+    return f'hint:{game.id}:{game.version}:{user.id}'
+
+
+def hint_channel(game_id, user_id):
+    return f'hint:{game_id}:{user_id}'
+
+
+def request_hint(game, user):
+    """Start searching a hint for `user` in the current position; returns the hint if it is already known."""
+    key = hint_key(game, user)
+    hint = cache.get(key)
+    if hint is not None:
+        return hint
+    # Only the first request for this position starts a search
+    if cache.add(f'{key}:pending', True, HINT_TIMEOUT):
+        _when_done(_search(normalize_fen(game.fen), ENGINE_HINT_TIME), _store_hint, key, game.id, user.id)
+    return None
+
+
+def _store_hint(result, key, game_id, user_id):
+    if result is None:
+        cache.delete(f'{key}:pending')
+        return
+    cache.set(key, {
+        'move': result.move,
+        'score': result.score,
+        'depth': result.depth,
+        'pv': result.pv,
+    }, HINT_TIMEOUT)
+    realtime.hub.publish(hint_channel(game_id, user_id), None)
+
+
+def wait_for_hint(game, user, timeout=HINT_WAIT):
+    """Block until the hint for the game's current version is ready; returns it, or None on timeout."""
+    deadline = time.monotonic() + timeout
+    key = hint_key(game, user)
+    # Listen before reading the cache, so a hint stored in between still wakes us
+    with realtime.hub.listen(hint_channel(game.id, user.id)) as published:
+        while True:
+            published.clear()
+            hint = cache.get(key)
+            if hint is not None:
+                return hint
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            published.wait(min(remaining, HINT_RECHECK))
@@ -0,0 +1,415 @@
+"""A small alpha-beta chess engine on top of chess.Board.
+
+Iterative deepening negamax with alpha-beta pruning, a bounded transposition
+table, quiescence search on captures and move ordering (hash move, MVV-LVA
+captures, killer moves, history heuristic), stopped by a time budget. A
+position repeated along the line being searched scores as a draw.
+
+This module only depends on python-chess, never on Django, so searches can run
+in worker processes (see computer.py) without setting Django up there.
+"""
+import time
+from typing import NamedTuple
+
+import chess
+import chess.polyglot
+
+MATE = 100000
+# Scores beyond this are mates, counted in plies from the root
+MATE_BOUND = MATE - 1000
+INFINITY = 10 ** 9
+MAX_PLY = 64
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# Check the clock once every this many nodes
+CLOCK_INTERVAL = 1024
+
+PIECE_VALUES = {
+    chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0,
+}
+
+# Piece-square tables from white's point of view, rank 8 first (a8..h8, ..., a1..h1)
+PIECE_SQUARE_TABLES = {
+    chess.PAWN: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    chess.KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    chess.BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    chess.ROOK: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    chess.QUEEN: [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    chess.KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+
+# Without queens the king should come to the centre instead of hiding
+KING_ENDGAME_TABLE = [
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+]
+
+
+def _square_scores(table, value):
+    # Per color, material plus placement indexed directly by chess square (a1 = 0)
+    white = [value + table[chess.square_mirror(square)] for square in chess.SQUARES]
+    black = [value + table[square] for square in chess.SQUARES]
+    return white, black
+
+
+SQUARE_SCORES = {
+    piece_type: _square_scores(table, PIECE_VALUES[piece_type])
+    for piece_type, table in PIECE_SQUARE_TABLES.items()
+}
+KING_ENDGAME_SCORES = _square_scores(KING_ENDGAME_TABLE, 0)
+
+
+def evaluate(board):
+    """Static evaluation in centipawns, from the side to move's point of view."""
+    white, black = board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]
+    score = 0
+    for piece_type, pieces in (
+        (chess.PAWN, board.pawns), (chess.KNIGHT, board.knights), (chess.BISHOP, board.bishops),
+        (chess.ROOK, board.rooks), (chess.QUEEN, board.queens),
+    ):
+        white_scores, black_scores = SQUARE_SCORES[piece_type]
+        for square in chess.scan_forward(pieces & white):
+            score += white_scores[square]
+        for square in chess.scan_forward(pieces & black):
+            score -= black_scores[square]
+    white_scores, black_scores = KING_ENDGAME_SCORES if not board.queens else SQUARE_SCORES[chess.KING]
+    score += white_scores[board.king(chess.WHITE)] - black_scores[board.king(chess.BLACK)]
+    return score if board.turn == chess.WHITE else -score
+
+
+class TranspositionTable:
+    """Fixed-size hash table of search results; a newer or deeper entry replaces an older one."""
+
+    def __init__(self, size=1 << 18):
+        if size & (size - 1):
+            raise ValueError('size must be a power of two')
+        self.mask = size - 1
+        self.entries = [None] * size
+
+    def get(self, key):
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, flag, score, move):
+        index = key & self.mask
+        entry = self.entries[index]
+        # Keep a deeper result for the same position over a shallower one
+        if entry is None or entry[0] != key or depth >= entry[1]:
+            self.entries[index] = (key, depth, flag, score, move)
+
+    def clear(self):
+        self.entries = [None] * len(self.entries)
+
+
+class SearchResult(NamedTuple):
+    move: str  # Best move in UCI notation, or None if there are no legal moves
+    score: int  # Centipawns for the side to move; mates are +-(MATE - plies)
+    depth: int  # Deepest completed iteration
+    nodes: int
+    seconds: float
+    pv: list  # Principal variation, in UCI notation
+
+    @property
+    def nps(self):
+        return int(self.nodes / self.seconds) if self.seconds else 0
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def _position_key(board):
+    # Polyglot Zobrist hash: pieces, side to move, castling and en passant
+    return chess.polyglot.zobrist_hash(board)
+
+
+def _to_table(score, ply):
+    # Mate scores are stored relative to the node, not the root
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def _from_table(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+class Searcher:
+    """Iterative-deepening alpha-beta search. Keeps its transposition table between searches."""
+
+    def __init__(self, table_size=1 << 18):
+        self.table = TranspositionTable(table_size)
+        self.nodes = 0
+        self.deadline = None
+        self.killers = [[None, None] for _ in range(MAX_PLY + 1)]
+        self.history = {}
+        # Keys of the positions on the line being searched, root first
+        self.path = []
+
+    def search(self, board, time_budget=1.0, max_depth=MAX_PLY):
+        """Search `board` for up to `time_budget` seconds (or to `max_depth`); returns a SearchResult.
+
+        The result is from the deepest iteration that finished in time.
+        """
+        board = board.copy(stack=False)
+        started = time.monotonic()
+        self.deadline = started + time_budget if time_budget is not None else None
+        self.nodes = 0
+        self.killers = [[None, None] for _ in range(MAX_PLY + 1)]
+        self.history = {}
+        self.path = []
+
+        moves = list(board.legal_moves)
+        if not moves:
+            score = -MATE if board.is_check() else 0
+            return SearchResult(None, score, 0, 0, 0.0, [])
+        if len(moves) == 1:
+            # Nothing to think about
+            return SearchResult(moves[0].uci(), 0, 0, 1, time.monotonic() - started, [moves[0].uci()])
+
+        best_move, best_score, completed = moves[0], 0, 0
+        for depth in range(1, max_depth + 1):
+            iteration_started = time.monotonic()
+            try:
+                best_score, best_move = self._root(board, depth, best_move)
+            except SearchTimeout:
+                break
+            completed = depth
+            if abs(best_score) > MATE_BOUND:
+                break  # Found a forced mate; searching deeper will not change the move
+            if self.deadline is not None:
+                # The next iteration takes several times as long as this one
+                now = time.monotonic()
+                if now + (now - iteration_started) * 3 > self.deadline:
+                    break
+
+        elapsed = time.monotonic() - started
+        return SearchResult(best_move.uci(), best_score, completed, self.nodes, elapsed,
+                            self._principal_variation(board, best_move, completed))
+
+    def _root(self, board, depth, previous_best):
+        alpha, beta = -INFINITY, INFINITY
+        best_move, best_score = None, -INFINITY
+        key = _position_key(board)
+        self.path = [key]
+        for move in self._ordered(board, previous_best, 0):
+            board.push(move)
+            try:
+                score = -self._negamax(board, depth - 1, -beta, -alpha, 1)
+            finally:
+                board.pop()
+            if score > best_score:
+                best_score, best_move = score, move
+            alpha = max(alpha, score)
+        self.table.store(key, depth, EXACT, best_score, best_move)
+        return best_score, best_move
+
+    def _negamax(self, board, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.deadline is not None and not self.nodes % CLOCK_INTERVAL and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+        if board.halfmove_clock >= 100 or board.is_insufficient_material():
+            return 0
+
+        in_check = board.is_check()
+        if in_check and ply < MAX_PLY:
+            depth += 1  # Look one move further when in check
+        if depth <= 0 or ply >= MAX_PLY:
+            return self._quiesce(board, alpha, beta, ply)
+
+        key = _position_key(board)
+        # Back in a position from earlier on this line, with no capture or pawn
+        # move since: either side can keep repeating it, so it is a draw
+        if key in self.path[max(len(self.path) - board.halfmove_clock, 0):]:
+            return 0
+        entry = self.table.get(key)
+        hash_move = None
+        if entry is not None:
+            _, entry_depth, flag, entry_score, hash_move = entry
+            if entry_depth >= depth:
+                entry_score = _from_table(entry_score, ply)
+                if flag == EXACT:
+                    return entry_score
+                if flag == LOWER:
+                    alpha = max(alpha, entry_score)
+                elif flag == UPPER:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, None
+        self.path.append(key)
+        for move in self._ordered(board, hash_move, ply):
+            board.push(move)
+            try:
+                score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score > best_score:
+                best_score, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not board.is_capture(move):
+                    self._remember_cutoff(move, depth, ply)
+                break
+        self.path.pop()
+
+        if best_move is None:
+            # No legal moves: mated (the sooner the worse) or stalemated
+            return -MATE + ply if in_check else 0
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.store(key, depth, flag, _to_table(best_score, ply), best_move)
+        return best_score
+
+    def _quiesce(self, board, alpha, beta, ply):
+        # Only captures from here on, so the static evaluation is never taken mid-exchange
+        self.nodes += 1
+        if self.deadline is not None and not self.nodes % CLOCK_INTERVAL and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+        stand_pat = evaluate(board)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        captures = sorted(board.generate_legal_captures(), key=lambda move: -self._capture_score(board, move))
+        for move in captures:
+            board.push(move)
+            try:
+                score = -self._quiesce(board, -beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    @staticmethod
+    def _capture_score(board, move):
+        # Most valuable victim, least valuable attacker
+        victim = board.piece_type_at(move.to_square) or chess.PAWN  # En passant lands on an empty square
+        attacker = board.piece_type_at(move.from_square)
+        return PIECE_VALUES[victim] * 10 - PIECE_VALUES[attacker] + (PIECE_VALUES[move.promotion] if move.promotion else 0)
+
+    def _ordered(self, board, hash_move, ply):
+        killers = self.killers[min(ply, MAX_PLY)]
+        history = self.history
+
+        def score(move):
+            if move == hash_move:
+                return 10 ** 8
+            if board.is_capture(move) or move.promotion:
+                return 10 ** 7 + self._capture_score(board, move)
+            if move == killers[0] or move == killers[1]:
+                return 10 ** 6
+            return history.get((move.from_square, move.to_square), 0)
+
+        return sorted(board.legal_moves, key=score, reverse=True)
+
+    def _remember_cutoff(self, move, depth, ply):
+        killers = self.killers[min(ply, MAX_PLY)]
+        if move != killers[0]:
+            killers[1], killers[0] = killers[0], move
+        key = (move.from_square, move.to_square)
+        self.history[key] = self.history.get(key, 0) + depth * depth
+
+    def _principal_variation(self, board, first_move, depth):
+        # Follow the best moves stored in the transposition table
+        board = board.copy(stack=False)
+        pv = []
+        move = first_move
+        while move is not None and len(pv) < max(depth, 1) and move in board.legal_moves:
+            pv.append(move.uci())
+            board.push(move)
+            entry = self.table.get(_position_key(board))
+            move = entry[4] if entry is not None else None
+        return pv
+
+
+# One searcher per process, so the transposition table carries over from one
+# search to the next (the positions of a game are closely related)
+_searcher = None
+
+
+def search_fen(fen, time_budget=1.0, max_depth=MAX_PLY):
+    """Search a FEN position with this process's searcher; the entry point for worker processes."""
+    global _searcher
+    if _searcher is None:
+        _searcher = Searcher()
+    return _searcher.search(chess.Board(fen), time_budget, max_depth)
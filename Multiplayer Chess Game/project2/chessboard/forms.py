@@ -1,6 +1,8 @@
 from django import forms
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
+from .computer import COMPUTER_USERNAME
+from .pgn import IMPORTED_PREFIX
 from .models import Game, UserGameJournal
 
 def validate_uci_move(value):
@@ -15,6 +17,8 @@ class ChessMoveForm(forms.Form):
         widget=forms.TextInput(attrs={'placeholder': 'Move (e.g., e2e4, e7e8q)'}),
         required=False  # Make this field optional to prevent form submission issues on resign
     )
+    # Version of the game the move was made against; a stale one is rejected
+    version = forms.IntegerField(widget=forms.HiddenInput, required=False)
 
     def clean(self):
         cleaned_data = super().clean()
@@ -32,6 +36,16 @@ class JoinForm(forms.ModelForm):
         model = User
         fields = ('first_name', 'last_name', 'username', 'email', 'password')
 
+    def clean_username(self):
+        username = self.cleaned_data['username']
+        # Reserved for the built-in engine's account
+        if username.lower() == COMPUTER_USERNAME.lower():
+            raise ValidationError("This username is reserved.")
+        # Reserved for players imported from PGN files
+        if username.lower().startswith(IMPORTED_PREFIX):
+            raise ValidationError("This username is reserved.")
+        return username
+
     def clean(self):
         cleaned_data = super().clean()
         password = cleaned_data.get("password")
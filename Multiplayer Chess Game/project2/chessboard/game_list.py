@@ -0,0 +1,82 @@
+"""The game history list on the home page: keyset pages and their cache generation.
+
+Pages are addressed by a cursor on the game id (?before=<id> for older
+games, ?after=<id> for newer ones), so every page costs the same few indexed
+queries however long the history is; there is no COUNT(*) and no OFFSET.
+
+Rendered pages are cached per user under a generation number, which is
+bumped whenever one of the user's games starts, ends or is deleted or
+annotated by them. Old entries are never deleted, just no longer looked up.
+The generation is a column of the user's UserStats row rather than a cache
+counter, so every server process sees a bump even when each has its own
+cache, and it commits (or rolls back) with the change that caused it.
+"""
+from django.db.models import F
+
+from .models import Game, UserGameJournal, UserStats
+
+PAGE_SIZE = 10
+# Seconds a rendered page stays cached, if nothing invalidates it first
+CACHE_TIMEOUT = 600
+
+
+def generation(user_id):
+    """The current cache generation of the user's history."""
+    return UserStats.objects.filter(user_id=user_id).values_list('history_generation', flat=True).first() or 0
+
+
+def invalidate(*user_ids):
+    """Make the users' cached history pages stale, in the caller's transaction."""
+    user_ids = sorted(set(user_ids))
+    UserStats.objects.bulk_create([UserStats(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    UserStats.objects.filter(user_id__in=user_ids).update(history_generation=F('history_generation') + 1)
+
+
+class HistoryPage:
+    def __init__(self, games, newer, older):
+        self.games = games
+        self.newer = newer  # Cursor for ?after=, or None on the first page
+        self.older = older  # Cursor for ?before=, or None on the last page
+
+
+def load_page(user, before=None, after=None):
+    """One page of the user's games, newest first, with their journal notes attached.
+
+    Each side of the game (as white, as black) is read with its own query on
+    the (player, id) index and the two are merged, which keeps both queries a
+    short index range scan.
+    """
+    games = Game.objects.exclude(deleted_by=user).select_related('player1', 'player2')
+    if after is not None:
+        games = games.filter(id__gt=after).order_by('id')
+    else:
+        games = games.order_by('-id')
+        if before is not None:
+            games = games.filter(id__lt=before)
+
+    # One extra row tells us whether there is another page in this direction
+    merged = {game.id: game for game in games.filter(player1=user)[:PAGE_SIZE + 1]}
+    merged.update((game.id, game) for game in games.filter(player2=user)[:PAGE_SIZE + 1])
+    rows = sorted(merged.values(), key=lambda game: game.id, reverse=after is None)
+    more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if after is not None:
+        rows.reverse()
+
+    journals = UserGameJournal.objects.filter(user=user, game__in=rows, deleted_for_user=False)
+    descriptions = dict(journals.values_list('game_id', 'description'))
+    for game in rows:
+        game.user_outcome = game.result_for(user)
+        game.journal_description = descriptions.get(game.id)
+
+    if not rows:
+        if after is not None:
+            # Nothing newer any more (games deleted meanwhile): show the first page
+            return load_page(user)
+        return HistoryPage(rows, None, None)
+    if after is not None:
+        newer, older = (rows[0].id if more else None), rows[-1].id
+    else:
+        newer = rows[0].id if before is not None else None
+        older = rows[-1].id if more else None
+    return HistoryPage(rows, newer, older)
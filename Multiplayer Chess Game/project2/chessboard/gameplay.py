@@ -0,0 +1,237 @@
+import chess
+import chess.polyglot
+from django.db import transaction
+from django.db.models import BinaryField, F, Func, Value
+
+from . import computer, game_list, realtime
+from .models import Game, PositionCount, UserStats
+from .movelog import encode_move
+from .rendering import normalize_fen
+
+
+class MoveConflict(Exception):
+    """The game changed (or ended) after it was read, so the write was not applied."""
+
+
+class NotYourTurn(Exception):
+    """The user is not the player to move."""
+
+
+class IllegalMove(Exception):
+    """The move is malformed or not legal in the current position."""
+
+
+class AppendBytes(Func):
+    """`column || bytes` for a BinaryField. Concat would cast both sides to text."""
+    arg_joiner = ' || '
+    template = '(%(expressions)s)'
+    output_field = BinaryField()
+
+    def __init__(self, column, data):
+        super().__init__(F(column), Value(data, output_field=BinaryField()))
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # SQLite's || yields text; cast the (byte-exact) result back to a blob
+        return self.as_sql(compiler, connection, template='CAST(%(expressions)s AS BLOB)', **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        # || is logical OR there
+        return self.as_sql(
+            compiler, connection, function='CONCAT', arg_joiner=', ', template='%(function)s(%(expressions)s)',
+            **extra_context,
+        )
+
+
+def _publish_on_commit(game):
+    # Push the new state to both players' sockets once it is visible to them
+    transaction.on_commit(lambda: realtime.publish_game_state(game))
+
+
+def play_move(game, user, uci_move, seen_version=None):
+    """Validate a move by `user` and commit it; returns the board after the move.
+
+    seen_version: the game version the move was made against, if the client
+    sent one. A stale version raises MoveConflict without looking at the move.
+    """
+    if seen_version is not None and seen_version != game.version:
+        raise MoveConflict(f'Game {game.id} is no longer at version {seen_version}')
+
+    chess_board = chess.Board(normalize_fen(game.fen))
+    player_id = game.player1_id if chess_board.turn == chess.WHITE else game.player2_id
+    if user.id != player_id:
+        raise NotYourTurn()
+
+    try:
+        chess_move = chess.Move.from_uci(uci_move)
+    except ValueError:
+        raise IllegalMove('Invalid move format!')
+    if chess_move not in chess_board.legal_moves:
+        raise IllegalMove('Invalid move!')
+
+    chess_board.push(chess_move)
+    commit_move(game, chess_board)
+    # In a game against the computer, it replies in the background
+    computer.schedule_move(game)
+    return chess_board
+
+
+def commit_move(game, chess_board):
+    """Store the position reached after a move, if nobody else got there first.
+
+    `game` is the row as read before the move and `chess_board` the board with
+    the move already pushed. The write is a single conditional
+    UPDATE ... WHERE id=? AND version=? AND active touching only the changed
+    columns; if another request committed in between, MoveConflict is raised
+    and nothing is written. On success `game` is updated in place.
+
+    The move is appended to the move log in the same statement, in SQL
+    (move_log || <two bytes>), so only the new move is sent to the database
+    however long the game gets.
+
+    If the move ends the game (mate, stalemate, insufficient material,
+    threefold repetition or the fifty-move rule) the game is finished in the
+    same transaction. Repetitions are counted incrementally per position hash.
+    """
+    fen = chess_board.fen()
+    turn = 'white' if chess_board.turn else 'black'
+    move = encode_move(chess_board.peek())
+    with transaction.atomic():
+        updated = Game.objects.filter(id=game.id, version=game.version, active=True).update(
+            fen=fen,
+            turn=turn,
+            move_log=AppendBytes('move_log', move),
+            moves=F('moves') + 1,
+            version=F('version') + 1,
+        )
+        if not updated:
+            raise MoveConflict(f'Game {game.id} is no longer at version {game.version}')
+
+        game.fen = fen
+        game.turn = turn
+        # The version check guarantees the stored log is the one we read
+        game.move_log = bytes(game.move_log) + move
+        game.moves += 1
+        game.version += 1
+
+        if game.moves == 1:
+            # Count the starting position too, so it can be repeated like any other
+            start = chess_board.copy()
+            start.pop()
+            count_position(game, start)
+        repetitions = count_position(game, chess_board)
+
+        # End the game on the spot if the move reached a terminal position
+        ending = detect_termination(chess_board, repetitions)
+        if ending is not None:
+            termination, winner_color = ending
+            finish_game(game, _player(game, winner_color), termination, _describe(game, termination, winner_color))
+            return game
+
+    _publish_on_commit(game)
+    return game
+
+
+def position_hash(chess_board):
+    """Zobrist (polyglot) hash of a position, as a signed 64-bit integer for a BigIntegerField."""
+    value = chess.polyglot.zobrist_hash(chess_board)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def count_position(game, chess_board):
+    """Record one more occurrence of a position in the game; returns its new count."""
+    position = PositionCount.objects.filter(game=game, position_hash=position_hash(chess_board))
+    if not position.update(count=F('count') + 1):
+        # First time here. Only the committer of this version can get this
+        # far, so no other request races us to create the row
+        PositionCount.objects.create(game=game, position_hash=position_hash(chess_board), count=1)
+        return 1
+    return position.values_list('count', flat=True).get()
+
+
+def detect_termination(chess_board, repetitions):
+    """(termination, winning color or None) if the position ends the game, else None."""
+    if chess_board.is_checkmate():
+        # The side that just moved delivered mate
+        return Game.Termination.CHECKMATE, not chess_board.turn
+    if chess_board.is_stalemate():
+        return Game.Termination.STALEMATE, None
+    if chess_board.is_insufficient_material():
+        return Game.Termination.INSUFFICIENT_MATERIAL, None
+    if repetitions >= 3:
+        return Game.Termination.THREEFOLD_REPETITION, None
+    if chess_board.halfmove_clock >= 100:
+        return Game.Termination.FIFTY_MOVES, None
+    return None
+
+
+def _player(game, color):
+    if color is None:
+        return None
+    return game.player1 if color == chess.WHITE else game.player2
+
+
+def _describe(game, termination, winner_color):
+    label = Game.Termination(termination).label.lower()
+    if winner_color is None:
+        return f'Draw by {label}'
+    return f'{_player(game, winner_color).username} wins by {label}'
+
+
+def finish_game(game, winner, termination, outcome):
+    """End an active game and record its result; raises MoveConflict if it already ended.
+
+    `winner` is None for a draw. The game row, both players' statistics and
+    the opening explorer index are updated in one transaction, so the totals
+    always agree with the games.
+    """
+    from . import openings  # It needs position_hash() from this module
+
+    if winner is None:
+        result = Game.DRAW
+    else:
+        result = Game.WHITE_WINS if winner.id == game.player1_id else Game.BLACK_WINS
+
+    with transaction.atomic():
+        updated = Game.objects.filter(id=game.id, active=True).update(
+            outcome=outcome,
+            active=False,
+            result=result,
+            winner=winner,
+            termination=termination,
+            version=F('version') + 1,
+        )
+        if not updated:
+            raise MoveConflict(f'Game {game.id} has already ended')
+        record_result(game.player1_id, game.player2_id, winner.id if winner else None)
+        game_list.invalidate(game.player1_id, game.player2_id)
+        # Games begun before moves were logged have no full record to index
+        if len(game.move_log) == 2 * game.moves:
+            openings.add_games([(game.move_log, result)])
+
+    game.outcome = outcome
+    game.active = False
+    game.result = result
+    game.winner = winner
+    game.termination = termination
+    game.version += 1
+    _publish_on_commit(game)
+    return game
+
+
+def record_result(player1_id, player2_id, winner_id):
+    """Add one finished game to both players' win/loss/draw totals."""
+    UserStats.objects.bulk_create(
+        [UserStats(user_id=player1_id), UserStats(user_id=player2_id)], ignore_conflicts=True
+    )
+    players = UserStats.objects.filter(user_id__in=[player1_id, player2_id])
+    if winner_id is None:
+        players.update(draws=F('draws') + 1)
+    else:
+        players.filter(user_id=winner_id).update(wins=F('wins') + 1)
+        players.exclude(user_id=winner_id).update(losses=F('losses') + 1)
+
+
+def resign(game, user):
+    """End the game with `user` resigning; raises MoveConflict if it already ended."""
+    winner = game.player2 if user == game.player1 else game.player1
+    return finish_game(game, winner, Game.Termination.RESIGNATION, f'{winner.username} wins by resignation')
@@ -0,0 +1,93 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from chessboard import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test the polling endpoints with simulated lobby tabs and games in progress, '
+        'or (--scenario login) time logins as the session table grows. '
+        'Runs against a throwaway test database, never the real one.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=['polling', 'login'], default='polling')
+        parser.add_argument('--users', type=int, default=200, help='Simulated users (one open tab each)')
+        parser.add_argument('--games', type=int, default=50, help='Active games among those users')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run for')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between each client\'s polls')
+        parser.add_argument('--sessions', default='1000,10000,100000',
+                            help='Login scenario: comma-separated live session counts to time logins at')
+        parser.add_argument('--logins', type=int, default=50, help='Login scenario: logins timed per session count')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for repeatable runs')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+        parser.add_argument('-o', '--output', help='Also write the JSON results to this file')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse the test database between runs')
+
+    def handle(self, *args, **options):
+        if options['scenario'] == 'polling' and options['games'] * 2 > options['users']:
+            raise CommandError('--users must be at least twice --games')
+        try:
+            options['sessions'] = [int(count) for count in options['sessions'].split(',')]
+        except ValueError:
+            raise CommandError('--sessions must be a comma-separated list of numbers')
+
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            if options['scenario'] == 'login':
+                results = self.run_logins(options)
+            else:
+                results = self.run(options)
+        finally:
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.stdout.write(benchmark.format_summary(results['endpoints']))
+            self.stdout.write(f"{results['total_requests']} requests in {results['elapsed']:.1f}s "
+                              f"({results['throughput']:.1f} req/s)")
+
+    def results(self, config, recorder, elapsed):
+        endpoints = recorder.summary(elapsed)
+        total = sum(stats['requests'] for stats in endpoints.values())
+        return {
+            'config': config,
+            'database': connections['default'].vendor,
+            'elapsed': elapsed,
+            'total_requests': total,
+            'throughput': total / elapsed if elapsed else 0,
+            'endpoints': endpoints,
+        }
+
+    def run_logins(self, options):
+        recorder = benchmark.Recorder()
+        started = time.monotonic()
+        benchmark.benchmark_logins(recorder, options['sessions'], options['logins'], seed=options['seed'])
+        config = {key: options[key] for key in ('scenario', 'sessions', 'logins', 'seed')}
+        return self.results(config, recorder, time.monotonic() - started)
+
+    def run(self, options):
+        players, lobby = benchmark.seed(options['users'], options['games'])
+        recorder = benchmark.Recorder()
+        simulation = benchmark.Simulation(recorder, interval=options['interval'], seed=options['seed'])
+        for game, white, black in players:
+            simulation.add_player(white, game, 'w')
+            simulation.add_player(black, game, 'b')
+        for user in lobby:
+            simulation.add_lobby(user)
+
+        elapsed = simulation.run(options['duration'])
+        config = {key: options[key] for key in ('scenario', 'users', 'games', 'duration', 'interval', 'seed')}
+        return self.results(config, recorder, elapsed)
@@ -0,0 +1,78 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+from django.core.management.base import BaseCommand, CommandError
+
+from chessboard import engine
+
+# Fixed positions, so runs are comparable between engine versions
+POSITIONS = {
+    'start': 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+    'kiwipete': 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    'middlegame': 'r1bq1rk1/pp2bppp/2n1pn2/2pp4/3P4/2PBPN2/PP1N1PPP/R1BQ1RK1 w - - 0 8',
+    'endgame': '8/5k2/3p4/1p1Pp2p/pP2Pp1P/P4P1K/8/8 b - - 0 1',
+}
+
+
+def _run(fen, time_budget, depth):
+    # A fresh searcher per position, so no position benefits from the one before
+    return engine.Searcher().search(chess.Board(fen), time_budget, depth)
+
+
+class Command(BaseCommand):
+    help = (
+        'Search a fixed set of positions and report nodes per second. '
+        'With --workers, each worker process searches every position at the same time, '
+        'as they would when several games are waiting on the computer.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--time', type=float, default=2.0, help='Seconds to search each position')
+        parser.add_argument('--depth', type=int, help='Search to this depth instead of for a fixed time')
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes searching in parallel')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be positive')
+        time_budget = None if options['depth'] else options['time']
+        depth = options['depth'] or engine.MAX_PLY
+
+        jobs = [(name, fen) for _ in range(options['workers']) for name, fen in POSITIONS.items()]
+        started = time.monotonic()
+        if options['workers'] == 1:
+            results = [_run(fen, time_budget, depth) for _, fen in jobs]
+        else:
+            with ProcessPoolExecutor(options['workers']) as pool:
+                results = list(pool.map(_run, [fen for _, fen in jobs], [time_budget] * len(jobs), [depth] * len(jobs)))
+        elapsed = time.monotonic() - started
+
+        positions = [
+            {'position': name, 'move': result.move, 'score': result.score, 'depth': result.depth,
+             'nodes': result.nodes, 'seconds': round(result.seconds, 3), 'nps': result.nps}
+            for (name, _), result in zip(jobs, results)
+        ]
+        nodes = sum(result.nodes for result in results)
+        summary = {
+            'workers': options['workers'],
+            'time': time_budget,
+            'depth': options['depth'],
+            'positions': positions,
+            'nodes': nodes,
+            'elapsed': round(elapsed, 3),
+            # Nodes searched per wall-clock second by all workers together
+            'nps': int(nodes / elapsed) if elapsed else 0,
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        self.stdout.write(f"{'position':<12} {'move':<6} {'score':>7} {'depth':>5} {'nodes':>9} {'seconds':>8} {'nps':>8}")
+        for row in positions:
+            self.stdout.write(
+                f"{row['position']:<12} {row['move'] or '-':<6} {row['score']:>7} {row['depth']:>5} "
+                f"{row['nodes']:>9} {row['seconds']:>8.2f} {row['nps']:>8}"
+            )
+        self.stdout.write(f"{nodes} nodes in {elapsed:.1f}s with {options['workers']} worker(s): {summary['nps']} nps")
@@ -0,0 +1,35 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chessboard import pgn
+
+
+class Command(BaseCommand):
+    help = "Export games as PGN: one user's games, or every game."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only export games played by this username')
+        parser.add_argument('-o', '--output', help='File to write to (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, default=pgn.CHUNK_SIZE, help='Games fetched per query')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"No user named {options['user']!r}")
+
+        games = pgn.games_for(user)
+        out = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+        count = 0
+        try:
+            for text in pgn.export_pgn(games, user=user, chunk_size=options['chunk_size']):
+                out.write(text)
+                count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.stderr.write(f'Exported {count} games')
@@ -0,0 +1,80 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from chessboard import pgn
+
+# How often progress is reported, in seconds
+REPORT_INTERVAL = 5
+
+
+class Command(BaseCommand):
+    help = 'Import games from a PGN file, parsing in parallel and inserting in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='PGN file to import')
+        parser.add_argument('--offset', type=int, default=0,
+                            help='Byte offset to start from, as printed by an earlier run')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Games per parse task and per transaction')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Parser processes')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        workers = options['workers']
+        if batch_size < 1 or workers < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+
+        try:
+            stream = open(options['path'], 'rb')
+        except OSError as e:
+            raise CommandError(e)
+
+        imported = skipped = 0
+        offset = options['offset']
+        known_players = {}
+        started = last_report = time.monotonic()
+        with stream, ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            stream.seek(offset)
+            games = pgn.split_games(stream, offset)
+            # Keep a couple of batches per worker in flight: enough to keep
+            # them busy while we write, without reading the whole file ahead
+            pending = deque()
+            try:
+                while True:
+                    while len(pending) < 2 * workers:
+                        batch = list(islice(games, batch_size))
+                        if not batch:
+                            break
+                        raw_games = [raw for raw, _ in batch]
+                        pending.append((pool.submit(pgn.parse_games, raw_games), len(batch), batch[-1][1]))
+                    if not pending:
+                        break
+
+                    future, count, end_offset = pending.popleft()
+                    records = [record for record in future.result() if record is not None]
+                    skipped += count - len(records)
+                    imported += pgn.save_games(records, known_players)
+                    # Everything before end_offset is now committed
+                    offset = end_offset
+
+                    now = time.monotonic()
+                    if now - last_report >= REPORT_INTERVAL:
+                        last_report = now
+                        self.report(imported, skipped, offset, now - started)
+            except BaseException:
+                for future, _, _ in pending:
+                    future.cancel()
+                self.stderr.write(f'Import stopped; resume with --offset {offset}')
+                raise
+
+        self.report(imported, skipped, offset, time.monotonic() - started)
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} games ({skipped} skipped)'))
+
+    def report(self, imported, skipped, offset, elapsed):
+        rate = imported / elapsed if elapsed else 0
+        self.stdout.write(f'{imported} games imported, {skipped} skipped, {rate:.0f} games/s, offset {offset}')
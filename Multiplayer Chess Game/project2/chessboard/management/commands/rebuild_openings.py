@@ -0,0 +1,88 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from chessboard import openings
+from chessboard.models import Game, OpeningMove, OpeningMoveRebuild
+
+
+def _complete(move_log, moves):
+    # Games begun before moves were logged have no full record to index
+    return len(move_log) == 2 * moves
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the opening explorer index from every finished game, e.g. after an import '
+        'or a change to OPENING_PLIES. The new index is built aside and swapped in at the end, '
+        'so the explorer keeps serving the old one meanwhile. Games that finish while it runs '
+        'are counted once, in the new index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Games read and indexed per batch')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        started = time.monotonic()
+
+        with transaction.atomic():
+            # Games in progress now, and games started later, are left out of
+            # the build; the ones finished by the swap are added there
+            last_id = Game.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            in_progress = set(Game.objects.filter(active=True).values_list('id', flat=True))
+        # Left over from an interrupted run
+        OpeningMoveRebuild.objects.all().delete()
+
+        finished = Game.objects.filter(id__lte=last_id, active=False).order_by('id')
+        games = last_seen = 0
+        while True:
+            chunk = list(
+                finished.filter(id__gt=last_seen).values_list('id', 'move_log', 'result', 'moves')[:options['chunk_size']]
+            )
+            if not chunk:
+                break
+            last_seen = chunk[-1][0]
+            openings.add_games(
+                ((move_log, result) for game_id, move_log, result, moves in chunk
+                 if game_id not in in_progress and _complete(move_log, moves)),
+                model=OpeningMoveRebuild,
+            )
+            games += len(chunk)
+            self.stdout.write(f'{games} games indexed (up to id {last_seen})')
+
+        games += self.swap(last_id, in_progress)
+        # Web processes cache lookups for at most openings.CACHE_TTL; they only
+        # ever held answers from a complete index, old or new
+        openings.explorer_cache.clear()
+        self.stdout.write(
+            f'Indexed {games} games into {OpeningMove.objects.count()} positions/moves '
+            f'in {time.monotonic() - started:.1f}s'
+        )
+
+    def swap(self, last_id, in_progress):
+        """Replace the live index with the rebuilt one; returns the number of games that finished meanwhile."""
+        live = connection.ops.quote_name(OpeningMove._meta.db_table)
+        rebuilt = connection.ops.quote_name(OpeningMoveRebuild._meta.db_table)
+        columns = 'position_hash, move, white_wins, draws, black_wins'
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Hold games finishing from now on until the swap commits (the
+                # explorer can still read); they then add themselves to the new
+                # index, and every game that finished before is counted below
+                cursor.execute(f'LOCK TABLE {live} IN SHARE ROW EXCLUSIVE MODE')
+            OpeningMove.objects.all().delete()
+            cursor.execute(f'INSERT INTO {live} ({columns}) SELECT {columns} FROM {rebuilt}')
+            late = [
+                (move_log, result)
+                for move_log, result, moves in Game.objects.filter(
+                    Q(id__gt=last_id) | Q(id__in=in_progress), active=False,
+                ).values_list('move_log', 'result', 'moves')
+                if _complete(move_log, moves)
+            ]
+            openings.add_games(late)
+            OpeningMoveRebuild.objects.all().delete()
+        return len(late)
@@ -0,0 +1,54 @@
+import time
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chessboard import sessions
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete expired sessions in small batches, walking the primary key so each '
+        'DELETE touches a bounded range. Run it from cron, or with --every to keep it running.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Sessions deleted per statement')
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help='Seconds to sleep between batches, to leave room for other writers')
+        parser.add_argument('--every', type=float, help='Sweep again every N seconds instead of exiting')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        while True:
+            started = time.monotonic()
+            deleted, batches = self.sweep(options['batch_size'], options['pause'])
+            self.stdout.write(
+                f'Deleted {deleted} expired sessions in {batches} batches ({time.monotonic() - started:.1f}s)'
+            )
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
+
+    def sweep(self, batch_size, pause):
+        """Delete sessions that expired before the sweep started; returns (rows deleted, batches)."""
+        cutoff = timezone.now()
+        expired = Session.objects.filter(expire_date__lt=cutoff).order_by('session_key')
+        deleted = batches = 0
+        last_key = ''
+        while True:
+            keys = list(expired.filter(session_key__gt=last_key).values_list('session_key', flat=True)[:batch_size])
+            if not keys:
+                return deleted, batches
+            last_key = keys[-1]
+            # Re-check the expiry: a session refreshed since we read it stays
+            count, _ = Session.objects.filter(
+                session_key__in=keys, expire_date__lt=cutoff
+            ).delete()
+            sessions.forget(keys)
+            deleted += count
+            batches += 1
+            if pause:
+                time.sleep(pause)
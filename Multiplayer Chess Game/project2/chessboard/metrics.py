@@ -0,0 +1,160 @@
+"""In-process metrics registry, rendered in the Prometheus text format.
+
+Each server process keeps its own counters; the scraper adds them up across
+processes. Recording a sample is a dict lookup and a few additions under a
+lock, cheap enough to do on every request.
+"""
+import threading
+from bisect import bisect_left
+
+# Seconds; covers cached 304s up to requests held open by a long-poll
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [count per bucket (last one is +Inf)..., sum]
+        self._values = {}
+
+    def observe(self, label_values, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        bounds = self.buckets + (float('inf'),)
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = (('le', _format_number(bound)),)
+                yield f'{self.name}_bucket', _format_labels(self.labels, label_values, le), cumulative
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class CacheStats:
+    """One field of LRUCache.stats() for every registered cache, read when scraped."""
+
+    def __init__(self, name, documentation, kind, field, caches):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.field = field
+        self._caches = caches
+
+    def samples(self):
+        for cache_name, cache in sorted(self._caches.items()):
+            yield self.name, _format_labels(('cache',), (cache_name,)), cache.stats()[self.field]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    'chess_http_requests_total', 'HTTP requests by view, method and status code.', ('view', 'method', 'status'),
+))
+REQUEST_DURATION = registry.register(Histogram(
+    'chess_http_request_duration_seconds', 'Time to produce a response, by view.', ('view', 'method'),
+))
+RESPONSE_SIZE = registry.register(Histogram(
+    'chess_http_response_size_bytes', 'Response body size (streamed responses excluded), by view.', ('view',),
+    buckets=SIZE_BUCKETS,
+))
+DB_QUERIES = registry.register(Histogram(
+    'chess_db_queries_per_request', 'Database queries run per request, by view.', ('view',),
+    buckets=QUERY_COUNT_BUCKETS,
+))
+DB_DURATION = registry.register(Histogram(
+    'chess_db_query_duration_seconds', 'Total time spent in database queries per request, by view.', ('view',),
+))
+
+# In-memory caches (see lru.py), by name; added with register_cache()
+_caches = {}
+
+
+def register_cache(name, cache):
+    _caches[name] = cache
+    return cache
+
+
+CACHE_HITS = registry.register(CacheStats(
+    'chess_cache_hits_total', 'In-memory cache lookups that found an entry, by cache.', 'counter', 'hits', _caches,
+))
+CACHE_MISSES = registry.register(CacheStats(
+    'chess_cache_misses_total', 'In-memory cache lookups that missed, by cache.', 'counter', 'misses', _caches,
+))
+CACHE_SIZE = registry.register(CacheStats(
+    'chess_cache_entries', 'Entries held by each in-memory cache.', 'gauge', 'size', _caches,
+))
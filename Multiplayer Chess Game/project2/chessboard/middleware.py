@@ -0,0 +1,73 @@
+import time
+
+from django.db import connection
+
+from . import metrics, presence, profiling
+
+
+class PresenceMiddleware:
+    """Heartbeat the presence record of every authenticated request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.user.is_authenticated:
+            presence.touch(request.user.id)
+        return self.get_response(request)
+
+
+class MetricsMiddleware:
+    """Record latency, status, response size and database usage of every request.
+
+    Goes first in MIDDLEWARE so the timing covers the whole stack. Samples
+    are labelled by URL name, so /get-game-state/1/ and /get-game-state/2/
+    share a series.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+        query_time = 0.0
+
+        def record_query(execute, sql, params, many, context):
+            nonlocal queries, query_time
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries += 1
+                query_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(record_query):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match is not None else 'unmatched'
+        metrics.REQUESTS.inc((view, request.method, str(response.status_code)))
+        metrics.REQUEST_DURATION.observe((view, request.method), duration)
+        metrics.DB_QUERIES.observe((view,), queries)
+        metrics.DB_DURATION.observe((view,), query_time)
+        if not response.streaming:
+            metrics.RESPONSE_SIZE.observe((view,), len(response.content))
+        return response
+
+
+class ProfilingMiddleware:
+    """Profile sampled requests, and requests that ask for it with a signed header.
+
+    See profiling.py; does nothing unless PROFILE_SAMPLE_RATE is set or the
+    X-Profile header is sent.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if profiling.wanted(request):
+            return profiling.profile_request(self.get_response, request)
+        return self.get_response(request)
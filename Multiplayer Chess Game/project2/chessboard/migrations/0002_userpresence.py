@@ -0,0 +1,32 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("chessboard", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserPresence",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="presence",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("last_seen", models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0002_userpresence"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="game",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0003_game_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="board",
+            name="squares",
+            field=models.CharField(
+                default="................................................................",
+                max_length=64,
+            ),
+        ),
+        # Give the old per-square columns a default so the migration can be reversed
+        migrations.AlterField(
+            model_name="board",
+            name="location",
+            field=models.CharField(default="", max_length=11),
+        ),
+        migrations.AlterField(
+            model_name="board",
+            name="value",
+            field=models.CharField(default="", max_length=10),
+        ),
+    ]
@@ -0,0 +1,76 @@
+import chess
+from django.db import migrations
+
+PIECE_ENTITIES = {
+    "K": "&#9812;",
+    "Q": "&#9813;",
+    "R": "&#9814;",
+    "B": "&#9815;",
+    "N": "&#9816;",
+    "P": "&#9817;",
+    "k": "&#9818;",
+    "q": "&#9819;",
+    "r": "&#9820;",
+    "b": "&#9821;",
+    "n": "&#9822;",
+    "p": "&#9823;",
+}
+ENTITY_PIECES = {entity: piece for piece, entity in PIECE_ENTITIES.items()}
+
+
+def collapse_board_rows(apps, schema_editor):
+    # Fold each user's FEN row and 64 per-square rows into a single row
+    Board = apps.get_model("chessboard", "Board")
+    user_ids = Board.objects.values_list("user_id", flat=True).distinct()
+    for user_id in list(user_ids):
+        rows = list(Board.objects.filter(user_id=user_id).order_by("id"))
+        fen = next((row.fen for row in rows if row.fen), None)
+
+        squares = ["."] * 64
+        try:
+            chess_board = chess.Board(fen) if fen else None
+        except ValueError:
+            chess_board = None
+        if chess_board is not None:
+            for square in chess.SQUARES:
+                piece = chess_board.piece_at(square)
+                squares[square] = piece.symbol() if piece else "."
+        else:
+            for row in rows:
+                if row.location in chess.SQUARE_NAMES:
+                    square = chess.parse_square(row.location)
+                    squares[square] = ENTITY_PIECES.get(row.value, ".")
+
+        keep = rows[0]
+        Board.objects.filter(user_id=user_id).exclude(id=keep.id).delete()
+        keep.fen = fen
+        keep.squares = "".join(squares)
+        keep.save(update_fields=["fen", "squares"])
+
+
+def expand_board_rows(apps, schema_editor):
+    # Inverse of collapse_board_rows: one FEN row plus one row per square
+    Board = apps.get_model("chessboard", "Board")
+    for board in list(Board.objects.all()):
+        board.location = ""
+        board.value = ""
+        board.save(update_fields=["location", "value"])
+        Board.objects.bulk_create(
+            Board(
+                user_id=board.user_id,
+                location=chess.square_name(square),
+                value=PIECE_ENTITIES.get(piece, "&nbsp;"),
+            )
+            for square, piece in enumerate(board.squares)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0004_board_squares"),
+    ]
+
+    operations = [
+        migrations.RunPython(collapse_board_rows, expand_board_rows),
+    ]
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("chessboard", "0004_collapse_board_rows"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="board",
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name="board",
+            name="user",
+            field=models.OneToOneField(
+                on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL
+            ),
+        ),
+        migrations.RemoveField(
+            model_name="board",
+            name="location",
+        ),
+        migrations.RemoveField(
+            model_name="board",
+            name="value",
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0004_packed_board"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="game",
+            name="move_log",
+            field=models.BinaryField(default=b""),
+        ),
+    ]
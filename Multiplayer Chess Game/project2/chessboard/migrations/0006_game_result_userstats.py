@@ -0,0 +1,108 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_results(apps, schema_editor):
+    # Derive the structured result from the free-text outcome of finished games
+    # ("<username> wins by ..." or a draw) and build everyone's totals from it
+    Game = apps.get_model("chessboard", "Game")
+    UserStats = apps.get_model("chessboard", "UserStats")
+    totals = {}
+    games = Game.objects.filter(active=False).exclude(outcome="").select_related("player1", "player2")
+    for game in games.iterator():
+        if game.outcome.startswith(f"{game.player1.username} wins"):
+            game.winner, game.result = game.player1, "1-0"
+        elif game.outcome.startswith(f"{game.player2.username} wins"):
+            game.winner, game.result = game.player2, "0-1"
+        elif "draw" in game.outcome:
+            game.winner, game.result = None, "1/2-1/2"
+        else:
+            continue
+        if "resignation" in game.outcome:
+            game.termination = "resignation"
+        game.save(update_fields=["winner", "result", "termination"])
+
+        for user_id in (game.player1_id, game.player2_id):
+            stats = totals.setdefault(user_id, UserStats(user_id=user_id))
+            if game.winner_id is None:
+                stats.draws += 1
+            elif game.winner_id == user_id:
+                stats.wins += 1
+            else:
+                stats.losses += 1
+    UserStats.objects.bulk_create(totals.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("chessboard", "0005_game_move_log"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserStats",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("wins", models.PositiveIntegerField(default=0)),
+                ("losses", models.PositiveIntegerField(default=0)),
+                ("draws", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="game",
+            name="result",
+            field=models.CharField(
+                choices=[
+                    ("1-0", "White wins"),
+                    ("0-1", "Black wins"),
+                    ("1/2-1/2", "Draw"),
+                    ("*", "Ongoing"),
+                ],
+                default="*",
+                max_length=7,
+            ),
+        ),
+        migrations.AddField(
+            model_name="game",
+            name="termination",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("resignation", "Resignation"),
+                    ("checkmate", "Checkmate"),
+                    ("stalemate", "Stalemate"),
+                    ("insufficient_material", "Insufficient material"),
+                    ("fifty_moves", "Fifty-move rule"),
+                    ("threefold_repetition", "Threefold repetition"),
+                ],
+                max_length=25,
+            ),
+        ),
+        migrations.AddField(
+            model_name="game",
+            name="winner",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="won_games",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.RunPython(backfill_results, migrations.RunPython.noop),
+    ]
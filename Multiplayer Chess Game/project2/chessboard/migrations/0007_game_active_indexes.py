@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0006_game_result_userstats"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="game",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["player1"],
+                name="game_active_player1_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="game",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["player2", "moves"],
+                name="game_active_player2_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0008_challenge"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PositionCount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("position_hash", models.BigIntegerField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "game",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="position_counts",
+                        to="chessboard.game",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("game", "position_hash")},
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.contrib.sessions.backends.db import SessionStore
+from django.utils import timezone
+
+
+def index_live_sessions(apps, schema_editor):
+    # Decode the existing sessions one last time to find their users
+    Session = apps.get_model("sessions", "Session")
+    User = apps.get_model("auth", "User")
+    UserSession = apps.get_model("chessboard", "UserSession")
+    user_ids = set(User.objects.values_list("id", flat=True))
+    store = SessionStore()
+    rows = []
+    sessions = Session.objects.filter(expire_date__gte=timezone.now())
+    for session_key, session_data in sessions.values_list(
+        "session_key", "session_data"
+    ).iterator():
+        user_id = store.decode(session_data).get("_auth_user_id")
+        if user_id is not None and int(user_id) in user_ids:
+            rows.append(UserSession(session_key=session_key, user_id=int(user_id)))
+    UserSession.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("chessboard", "0009_positioncount"),
+        ("sessions", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserSession",
+            fields=[
+                (
+                    "session_key",
+                    models.CharField(max_length=40, primary_key=True, serialize=False),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sessions",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(index_live_sessions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0010_usersession"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="game",
+            index=models.Index(fields=["player1", "id"], name="game_player1_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="game",
+            index=models.Index(fields=["player2", "id"], name="game_player2_id_idx"),
+        ),
+    ]
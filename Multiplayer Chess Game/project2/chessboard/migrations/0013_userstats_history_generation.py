@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0012_openingmove"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userstats",
+            name="history_generation",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
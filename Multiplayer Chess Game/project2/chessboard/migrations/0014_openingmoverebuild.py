@@ -0,0 +1,35 @@
+# Generated by Django 4.2.16 on 2026-10-18 17:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chessboard", "0013_userstats_history_generation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OpeningMoveRebuild",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("position_hash", models.BigIntegerField()),
+                ("move", models.PositiveSmallIntegerField()),
+                ("white_wins", models.PositiveIntegerField(default=0)),
+                ("draws", models.PositiveIntegerField(default=0)),
+                ("black_wins", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "unique_together": {("position_hash", "move")},
+            },
+        ),
+    ]
@@ -1,16 +1,33 @@
 from django.db import models
 from django.contrib.auth.models import User
+import chess
 
-class Board(models.Model):
-    location = models.CharField(max_length=11)
-    value = models.CharField(max_length=10)
-    user =  models.ForeignKey(User, on_delete=models.CASCADE)
-    fen = models.CharField(max_length=100, null=True, blank=True)  
+from .movelog import decode_moves
 
-    class Meta:
-        unique_together = (("user", "location"))
+# One row per user: the FEN plus the 64 squares packed as piece letters
+# (a1, b1, ... h8; '.' for an empty square)
+class Board(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    fen = models.CharField(max_length=100, null=True, blank=True)
+    squares = models.CharField(max_length=64, default='.' * 64)
 
 class Game(models.Model):
+    # How a finished game ended
+    class Termination(models.TextChoices):
+        RESIGNATION = 'resignation', 'Resignation'
+        CHECKMATE = 'checkmate', 'Checkmate'
+        STALEMATE = 'stalemate', 'Stalemate'
+        INSUFFICIENT_MATERIAL = 'insufficient_material', 'Insufficient material'
+        FIFTY_MOVES = 'fifty_moves', 'Fifty-move rule'
+        THREEFOLD_REPETITION = 'threefold_repetition', 'Threefold repetition'
+
+    # Result codes, as used in PGN
+    WHITE_WINS = '1-0'
+    BLACK_WINS = '0-1'
+    DRAW = '1/2-1/2'
+    ONGOING = '*'
+    RESULT_CHOICES = [(WHITE_WINS, 'White wins'), (BLACK_WINS, 'Black wins'), (DRAW, 'Draw'), (ONGOING, 'Ongoing')]
+
     player1 = models.ForeignKey(User, related_name='player1', on_delete=models.CASCADE)
     player2 = models.ForeignKey(User, related_name='player2', on_delete=models.CASCADE)
     moves = models.IntegerField(default=0)
@@ -18,10 +35,28 @@ class Game(models.Model):
     active = models.BooleanField(default=True)
     fen = models.CharField(max_length=100, default='startpos')  # Store FEN for both players
     turn = models.CharField(max_length=5, default='white')  # Store whose turn it is ('white' or 'black')
+    version = models.PositiveIntegerField(default=0)  # Bumped on every state change; used as the ETag
+    move_log = models.BinaryField(default=b'')  # Append-only, 2 bytes per move (see movelog.py)
+
+    # Structured result, set in the same transaction that ends the game
+    result = models.CharField(max_length=7, choices=RESULT_CHOICES, default=ONGOING)
+    winner = models.ForeignKey(User, related_name='won_games', on_delete=models.SET_NULL, null=True, blank=True)
+    termination = models.CharField(max_length=25, choices=Termination.choices, blank=True)
 
     # New field to track users who have deleted the game
     deleted_by = models.ManyToManyField(User, related_name='deleted_games', blank=True)
 
+    class Meta:
+        indexes = [
+            # Partial indexes over the (few) active games, for the polled
+            # "current game" lookups and the one-game-at-a-time checks
+            models.Index(fields=['player1'], condition=models.Q(active=True), name='game_active_player1_idx'),
+            models.Index(fields=['player2', 'moves'], condition=models.Q(active=True), name='game_active_player2_idx'),
+            # Keyset pages of a player's history (see game_list.py)
+            models.Index(fields=['player1', 'id'], name='game_player1_id_idx'),
+            models.Index(fields=['player2', 'id'], name='game_player2_id_idx'),
+        ]
+
     def is_player_turn(self, user):
         """Check if it's the user's turn."""
         if self.turn == 'white' and user == self.player1:
@@ -29,7 +64,26 @@ class Game(models.Model):
         elif self.turn == 'black' and user == self.player2:
             return True
         return False
-    
+
+    def result_for(self, user):
+        """'Win', 'Loss', 'Tie' or 'Ongoing' from the point of view of a player."""
+        if self.result == self.ONGOING:
+            return 'Ongoing'
+        if self.result == self.DRAW:
+            return 'Tie'
+        return 'Win' if self.winner_id == user.id else 'Loss'
+
+    def move_list(self):
+        """All moves played so far, decoded from the move log."""
+        return decode_moves(self.move_log)
+
+    def replay(self):
+        """A chess.Board at the current position with the full move stack."""
+        chess_board = chess.Board()
+        for move in self.move_list():
+            chess_board.push(move)
+        return chess_board
+
 # New model to store journal entries specific to each user for each game
 class UserGameJournal(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -41,3 +95,89 @@ class UserGameJournal(models.Model):
     class Meta:
         unique_together = (("user", "game"))
 
+
+# How many times each position (by Zobrist hash) has occurred in a game,
+# so threefold repetition is an O(1) lookup per move
+class PositionCount(models.Model):
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='position_counts')
+    position_hash = models.BigIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("game", "position_hash"))
+
+
+# Opening explorer index: for each position (by Zobrist hash) and move played
+# from it, the results of the finished games that played it. Looking a
+# position up reads one range of the unique index
+class OpeningMove(models.Model):
+    position_hash = models.BigIntegerField()
+    move = models.PositiveSmallIntegerField()  # 16-bit code, as in the move log
+    white_wins = models.PositiveIntegerField(default=0)
+    draws = models.PositiveIntegerField(default=0)
+    black_wins = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("position_hash", "move"))
+
+
+# Where `manage.py rebuild_openings` builds a fresh copy of the index, which
+# then replaces OpeningMove's rows in one transaction
+class OpeningMoveRebuild(models.Model):
+    position_hash = models.BigIntegerField()
+    move = models.PositiveSmallIntegerField()
+    white_wins = models.PositiveIntegerField(default=0)
+    draws = models.PositiveIntegerField(default=0)
+    black_wins = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("position_hash", "move"))
+
+
+# A challenge from one player to another; the game is created on acceptance
+class Challenge(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        ACCEPTED = 'accepted', 'Accepted'
+        DECLINED = 'declined', 'Declined'
+        EXPIRED = 'expired', 'Expired'
+
+    challenger = models.ForeignKey(User, related_name='challenges_sent', on_delete=models.CASCADE)
+    recipient = models.ForeignKey(User, related_name='challenges_received', on_delete=models.CASCADE)
+    status = models.CharField(max_length=8, choices=Status.choices, default=Status.PENDING)
+    game = models.OneToOneField(Game, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Each user's inbox of pending challenges
+            models.Index(fields=['recipient', 'id'], condition=models.Q(status='pending'), name='challenge_inbox_idx'),
+        ]
+
+
+# Per-user totals, kept up to date as games finish
+class UserStats(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    wins = models.PositiveIntegerField(default=0)
+    losses = models.PositiveIntegerField(default=0)
+    draws = models.PositiveIntegerField(default=0)
+    # Bumped whenever the user's game history changes; keys their cached history pages (see game_list.py)
+    history_generation = models.PositiveIntegerField(default=0)
+
+    @property
+    def games(self):
+        return self.wins + self.losses + self.draws
+
+
+# Heartbeat-updated "last seen" record used to work out who is online
+class UserPresence(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='presence')
+    last_seen = models.DateTimeField(db_index=True)
+
+
+# Which sessions belong to which user, so a user's sessions can be found (and
+# ended) with one indexed query instead of decoding every session in the table
+class UserSession(models.Model):
+    session_key = models.CharField(max_length=40, primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sessions')
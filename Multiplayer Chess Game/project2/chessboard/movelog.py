@@ -0,0 +1,31 @@
+"""Compact binary encoding of a game's moves.
+
+Each move is 16 bits, stored big-endian: bits 0-5 are the from square,
+bits 6-11 the to square and bits 12-14 the promotion piece type
+(0 for none, otherwise chess.KNIGHT..chess.QUEEN).
+"""
+import struct
+
+import chess
+
+
+def move_code(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def encode_move(move):
+    return struct.pack('>H', move_code(move))
+
+
+def decode_move(code):
+    return chess.Move(code & 0x3F, code >> 6 & 0x3F, code >> 12 & 0x7 or None)
+
+
+def encode_moves(moves):
+    return b''.join(map(encode_move, moves))
+
+
+def decode_moves(data):
+    """Decode a whole move log into a list of chess.Move."""
+    data = bytes(data)
+    return [decode_move(code) for (code,) in struct.iter_unpack('>H', data)]
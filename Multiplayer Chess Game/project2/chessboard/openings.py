@@ -0,0 +1,176 @@
+"""Opening explorer: the moves played from a position, with their results.
+
+The OpeningMove index holds one row per (position hash, move) with win, draw
+and loss counts. A game is added to it when it finishes (see
+gameplay.finish_game); `manage.py rebuild_openings` rebuilds it from the
+archive. Only the first OPENING_PLIES plies of each game are indexed, which
+keeps the index, and the write when a game ends, bounded by the number of
+games rather than the number of moves played.
+"""
+import time
+from collections import defaultdict
+
+import chess
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, When
+
+from . import metrics
+from .gameplay import position_hash
+from .lru import LRUCache
+from .models import Game, OpeningMove
+from .movelog import decode_move, decode_moves, move_code
+from .rendering import normalize_fen
+
+OPENING_PLIES = getattr(settings, 'OPENING_PLIES', 40)
+
+# Results of positions up to this ply are cached in memory: every lookup of
+# the early opening reads the same handful of rows
+CACHE_PLIES = getattr(settings, 'OPENING_CACHE_PLIES', 8)
+CACHE_TTL = getattr(settings, 'OPENING_CACHE_TTL', 60)
+explorer_cache = metrics.register_cache('openings', LRUCache(getattr(settings, 'OPENING_CACHE_SIZE', 4096)))
+
+# Which counter a game's result adds to
+RESULT_FIELDS = {Game.WHITE_WINS: 'white_wins', Game.DRAW: 'draws', Game.BLACK_WINS: 'black_wins'}
+
+# Rows updated per statement when adding counts
+BATCH_SIZE = 500
+
+
+def game_positions(move_list, plies=None):
+    """{(position hash, move code)} for the moves of a game, from the start.
+
+    A position repeated with the same move counts once: the index counts games.
+    """
+    plies = OPENING_PLIES if plies is None else plies
+    chess_board = chess.Board()
+    played = set()
+    for move in move_list[:plies]:
+        played.add((position_hash(chess_board), move_code(move)))
+        chess_board.push(move)
+    return played
+
+
+def count_games(games):
+    """Index counts for (move log, result) pairs of finished games, ready for add_counts()."""
+    return count_positions((game_positions(decode_moves(move_log)), result) for move_log, result in games)
+
+
+def count_positions(games):
+    """Index counts for (game_positions() keys, result) pairs of finished games."""
+    counts = defaultdict(lambda: defaultdict(int))
+    for positions, result in games:
+        field = RESULT_FIELDS.get(result)
+        if field is None:
+            continue
+        for key in positions:
+            counts[key][field] += 1
+    return counts
+
+
+def add_games(games, model=OpeningMove):
+    """Add (move log, result) pairs of finished games to the index, in the caller's transaction.
+
+    model: OpeningMove, or OpeningMoveRebuild while the index is rebuilt.
+    """
+    counts = count_games(games)
+    if counts:
+        add_counts(counts, model)
+
+
+def add_positions(games):
+    """Like add_games(), for games whose game_positions() keys are already known (e.g. from the PGN parser)."""
+    counts = count_positions(games)
+    if counts:
+        add_counts(counts)
+
+
+def add_counts(counts, model=OpeningMove):
+    """Add {(position hash, move code): {field: n}} to the index.
+
+    Missing rows are inserted first; the counts are then added with atomic
+    UPDATE ... SET field = field + n statements, so games finishing at the
+    same time never overwrite each other's counts. Rows are inserted in key
+    order and locked in id order before they are updated, so two writers
+    sharing positions queue up behind each other instead of deadlocking.
+    """
+    keys = sorted(counts)
+    for start in range(0, len(keys), BATCH_SIZE):
+        batch = keys[start:start + BATCH_SIZE]
+        with transaction.atomic():
+            model.objects.bulk_create(
+                [model(position_hash=position, move=move) for position, move in batch], ignore_conflicts=True
+            )
+            wanted = set(batch)
+            ids = {
+                (position, move): row_id
+                for row_id, position, move in model.objects.select_for_update().filter(
+                    position_hash__in={position for position, _ in batch}
+                ).order_by('id').values_list('id', 'position_hash', 'move')
+                if (position, move) in wanted
+            }
+            by_field = defaultdict(dict)
+            for key in batch:
+                for field, count in counts[key].items():
+                    if count:
+                        by_field[field][ids[key]] = count
+            for field, increments in sorted(by_field.items()):
+                rows = model.objects.filter(id__in=sorted(increments))
+                if len(set(increments.values())) == 1:
+                    rows.update(**{field: F(field) + next(iter(increments.values()))})
+                else:
+                    rows.update(**{field: F(field) + Case(
+                        *[When(id=row_id, then=increments[row_id]) for row_id in sorted(increments)],
+                        output_field=PositiveIntegerField(),
+                    )})
+
+
+def explore(chess_board):
+    """Moves played from a position, most played first, as a list of dicts."""
+    key = position_hash(chess_board)
+    if chess_board.ply() > CACHE_PLIES:
+        return _lookup(chess_board, key)
+    cached = explorer_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    moves = _lookup(chess_board, key)
+    explorer_cache.set(key, (time.monotonic() + CACHE_TTL, moves))
+    return moves
+
+
+def _lookup(chess_board, key):
+    moves = []
+    for code, white_wins, draws, black_wins in OpeningMove.objects.filter(position_hash=key).values_list(
+        'move', 'white_wins', 'draws', 'black_wins'
+    ):
+        move = decode_move(code)
+        games = white_wins + draws + black_wins
+        # A hash collision with another position could name a move that is illegal here
+        if not games or move not in chess_board.legal_moves:
+            continue
+        moves.append({
+            'uci': move.uci(),
+            'san': chess_board.san(move),
+            'games': games,
+            'white_wins': white_wins,
+            'draws': draws,
+            'black_wins': black_wins,
+            'white_pct': round(100 * white_wins / games, 1),
+            'draw_pct': round(100 * draws / games, 1),
+            'black_pct': round(100 * black_wins / games, 1),
+        })
+    moves.sort(key=lambda row: (-row['games'], row['san']))
+    return moves
+
+
+def board_for(fen=None, moves=None):
+    """The position to explore: a FEN, or UCI moves from the start. Raises ValueError if invalid."""
+    if fen:
+        return chess.Board(normalize_fen(fen))
+    chess_board = chess.Board()
+    for uci in moves or ():
+        move = chess.Move.from_uci(uci)
+        if move not in chess_board.legal_moves:
+            raise ValueError(f'Illegal move {uci}')
+        chess_board.push(move)
+    return chess_board
@@ -0,0 +1,340 @@
+"""PGN export and import of games.
+
+Export reads games with a chunked QuerySet.iterator() and writes them out one
+at a time, so exporting any number of games runs in constant memory.
+
+Import is split in two: parse_games() turns raw PGN text into plain tuples
+and touches no database, so it can run in worker processes. That includes
+replaying the moves for the opening index keys. save_games() then writes a
+batch of those tuples with a few bulk queries.
+"""
+import hashlib
+import io
+import re
+import unicodedata
+from collections import Counter
+from itertools import islice
+
+import chess
+import chess.pgn
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX, make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, When
+
+from . import game_list, openings
+from .computer import COMPUTER_USERNAME
+from .models import Game, UserGameJournal, UserStats
+from .gameplay import position_hash
+from .movelog import encode_moves, move_code
+from .rendering import normalize_fen
+
+# Games fetched per database round trip (plus one journal query per chunk)
+CHUNK_SIZE = 500
+# Games converted per hop to the sync thread when streaming under ASGI
+ASYNC_BATCH_SIZE = 20
+
+EVENT = 'Multiplayer Chess Game'
+
+# Imported players whose PGN name cannot be used as a username as it is get a
+# username starting with this; people cannot register such names (see JoinForm)
+IMPORTED_PREFIX = 'pgn_'
+USERNAME_MAX_LENGTH = User._meta.get_field('username').max_length
+_validate_username = UnicodeUsernameValidator()
+OUTCOME_MAX_LENGTH = Game._meta.get_field('outcome').max_length
+
+
+def games_for(user=None):
+    """The games to export: `user`'s (minus ones they deleted), or every game."""
+    games = Game.objects.select_related('player1', 'player2').order_by('id')
+    if user is not None:
+        games = games.filter(Q(player1=user) | Q(player2=user)).exclude(deleted_by=user)
+    # Only what the export needs; the FEN is only used for games without a move log
+    return games.only(
+        'id', 'player1__username', 'player2__username', 'moves', 'result', 'termination', 'fen', 'move_log',
+    )
+
+
+def _journal_notes(game_ids, user=None):
+    """{game id: [note, ...]} with the journal entries for a chunk of games."""
+    journals = UserGameJournal.objects.filter(game_id__in=game_ids, deleted_for_user=False)
+    if user is not None:
+        journals = journals.filter(user=user)
+    notes = {}
+    for game_id, username, description, entry in journals.order_by('id').values_list(
+        'game_id', 'user__username', 'description', 'journal_entry'
+    ):
+        text = ' '.join(part.strip() for part in (description, entry) if part and part.strip())
+        if text:
+            # Only say whose note it is when several users' notes can appear
+            notes.setdefault(game_id, []).append(text if user is not None else f'{username}: {text}')
+    return notes
+
+
+def game_to_pgn(game, notes=()):
+    """One game as PGN text, ending with a blank line."""
+    pgn_game = chess.pgn.Game()
+    pgn_game.headers['Event'] = EVENT
+    pgn_game.headers['Site'] = '?'
+    pgn_game.headers['Round'] = '-'
+    pgn_game.headers['White'] = game.player1.username
+    pgn_game.headers['Black'] = game.player2.username
+    pgn_game.headers['Result'] = game.result
+    pgn_game.headers['GameId'] = str(game.id)
+    if game.termination:
+        pgn_game.headers['Termination'] = Game.Termination(game.termination).label
+
+    moves = game.move_list()
+    if game.moves and not moves:
+        # Played before moves were logged: all we have is the final position
+        pgn_game.setup(chess.Board(normalize_fen(game.fen)))
+    node = pgn_game
+    for move in moves:
+        node = node.add_main_variation(move)
+
+    if notes:
+        pgn_game.comment = ' '.join(notes)
+    return pgn_game.accept(chess.pgn.StringExporter(headers=True, variations=False, comments=True)) + '\n\n'
+
+
+def export_pgn(games, user=None, chunk_size=CHUNK_SIZE):
+    """Yield PGN text for each game in the queryset, in order.
+
+    Rows are fetched chunk_size at a time, but each game is yielded as soon
+    as it is converted, so the first bytes go out before the rest of the
+    chunk is. Journal notes become a comment before the first move; with
+    `user` set, only that user's notes are included.
+    """
+    rows = games.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        notes = _journal_notes([game.id for game in chunk], user)
+        for game in chunk:
+            yield game_to_pgn(game, notes.get(game.id, ()))
+
+
+async def aexport_pgn(games, user=None, chunk_size=CHUNK_SIZE, batch_size=ASYNC_BATCH_SIZE):
+    """Async export_pgn() for ASGI, yielding the text of batch_size games at a time.
+
+    Django would otherwise read a sync iterator to the end before sending
+    anything under ASGI. Each batch is produced in the sync thread, where the
+    database cursor lives; a batch is a few games rather than a whole chunk
+    of rows, so each hop to that thread returns quickly.
+    """
+    texts = export_pgn(games, user, chunk_size)
+    next_batch = sync_to_async(lambda: list(islice(texts, batch_size)), thread_sensitive=True)
+    try:
+        while True:
+            batch = await next_batch()
+            if not batch:
+                return
+            yield ''.join(batch)
+    finally:
+        await sync_to_async(texts.close, thread_sensitive=True)()
+
+
+# How python-chess reports a game-ending position, in our terms
+OUTCOME_TERMINATIONS = {
+    chess.Termination.CHECKMATE: Game.Termination.CHECKMATE,
+    chess.Termination.STALEMATE: Game.Termination.STALEMATE,
+    chess.Termination.INSUFFICIENT_MATERIAL: Game.Termination.INSUFFICIENT_MATERIAL,
+    chess.Termination.SEVENTYFIVE_MOVES: Game.Termination.FIFTY_MOVES,
+    chess.Termination.FIVEFOLD_REPETITION: Game.Termination.THREEFOLD_REPETITION,
+}
+
+# Termination tags as written by game_to_pgn, so exports import back unchanged
+TERMINATION_LABELS = {label: value for value, label in Game.Termination.choices}
+
+FINISHED_RESULTS = {Game.WHITE_WINS, Game.BLACK_WINS, Game.DRAW}
+
+
+def split_games(stream, offset=0):
+    """Yield (raw PGN bytes, end offset) for each game in a binary stream.
+
+    A new game starts at a tag line that follows some movetext. Offsets are
+    byte positions in the stream, so an import can resume from any of them.
+    """
+    position = offset
+    lines = []
+    in_movetext = False
+    for line in stream:
+        if in_movetext and line.startswith(b'['):
+            yield b''.join(lines), position
+            lines = []
+            in_movetext = False
+        lines.append(line)
+        position += len(line)
+        stripped = line.strip()
+        if stripped and not stripped.startswith((b'[', b'%')):
+            in_movetext = True
+    if in_movetext:
+        yield b''.join(lines), position
+
+
+def parse_games(raw_games):
+    """Parse raw PGN games into (white, black, result, termination, fen, turn, move log, opening keys) tuples.
+
+    The opening keys are the game's openings.game_positions(), ready for
+    openings.add_positions().
+
+    Games that cannot be stored (unfinished, from a custom start position,
+    with illegal moves or without both player names) come back as None.
+    Runs in worker processes, so it must not touch the database.
+    """
+    parsed = []
+    for raw in raw_games:
+        pgn_game = chess.pgn.read_game(io.StringIO(raw.decode('utf-8-sig', errors='replace')))
+        parsed.append(_parse_game(pgn_game) if pgn_game is not None else None)
+    return parsed
+
+
+def _parse_game(pgn_game):
+    headers = pgn_game.headers
+    # Names are kept whole: cutting them short could merge different players
+    white = headers.get('White', '').strip()
+    black = headers.get('Black', '').strip()
+    result = headers.get('Result', Game.ONGOING)
+    if pgn_game.errors or 'FEN' in headers or result not in FINISHED_RESULTS or white in ('', '?') or black in ('', '?'):
+        return None
+
+    chess_board = pgn_game.board()
+    moves = list(pgn_game.mainline_moves())
+    # The same keys as openings.game_positions(), without replaying the game twice
+    opening_keys = set()
+    for ply, move in enumerate(moves):
+        if ply < openings.OPENING_PLIES:
+            opening_keys.add((position_hash(chess_board), move_code(move)))
+        chess_board.push(move)
+
+    termination = TERMINATION_LABELS.get(headers.get('Termination'), '')
+    if not termination:
+        outcome = chess_board.outcome()
+        if outcome is not None:
+            termination = OUTCOME_TERMINATIONS.get(outcome.termination, '')
+        elif result != Game.DRAW:
+            # Decisive without mate on the board: somebody gave up
+            termination = Game.Termination.RESIGNATION
+    turn = 'white' if chess_board.turn else 'black'
+    return white, black, result, termination, chess_board.fen(), turn, encode_moves(moves), opening_keys
+
+
+def _namespaced(name):
+    # A readable username in the import namespace; the digest of the full
+    # name keeps players apart whose names only differ in what was replaced
+    slug = re.sub(r'[^\w.@+-]+', '_', name).strip('_')[:100]
+    digest = hashlib.blake2b(name.encode(), digest_size=4).hexdigest()
+    return f'{IMPORTED_PREFIX}{slug}_{digest}' if slug else f'{IMPORTED_PREFIX}{digest}'
+
+
+def import_username(name):
+    """The username a PGN player name is imported as.
+
+    Valid usernames are kept as they are; anything else (spaces, commas, "?",
+    too long, or already in the import namespace) is mapped to a
+    deterministic name in the import namespace, so re-importing the same
+    player finds the same account.
+    """
+    name = unicodedata.normalize('NFKC', name).strip()
+    if len(name) <= USERNAME_MAX_LENGTH and not name.startswith(IMPORTED_PREFIX):
+        try:
+            _validate_username(name)
+        except ValidationError:
+            pass
+        else:
+            return name
+    return _namespaced(name)
+
+
+def _import_accounts(usernames):
+    # {username: id} of the existing accounts, with None for accounts games
+    # must not be attached to: people who can log in, and the computer
+    accounts = {}
+    for user_id, username, password in User.objects.filter(username__in=usernames).values_list(
+        'id', 'username', 'password'
+    ):
+        can_log_in = not password.startswith(UNUSABLE_PASSWORD_PREFIX)
+        accounts[username] = None if can_log_in or username == COMPUTER_USERNAME else user_id
+    return accounts
+
+
+def player_ids(names, known):
+    """Map PGN player names to user ids, creating accounts for new players.
+
+    `known` is the caller's name -> id map; it is extended in place so each
+    name is only looked up once per import. Created accounts have an
+    unusable password. A name that belongs to an account someone logs in
+    with (or to the computer) is imported under the import namespace
+    instead, so imported games are never attached to it.
+    """
+    missing = set(names) - known.keys()
+    if not missing:
+        return known
+    wanted = {name: import_username(name) for name in missing}
+    accounts = _import_accounts(set(wanted.values()))
+    for name, username in wanted.items():
+        if username in accounts and accounts[username] is None:
+            wanted[name] = _namespaced(unicodedata.normalize('NFKC', name).strip())
+    accounts.update(_import_accounts(set(wanted.values()) - accounts.keys()))
+
+    new = set(wanted.values()) - accounts.keys()
+    if new:
+        User.objects.bulk_create(
+            [User(username=username, password=make_password(None)) for username in sorted(new)], ignore_conflicts=True
+        )
+        accounts.update(_import_accounts(new))
+    for name, username in wanted.items():
+        if accounts.get(username) is None:
+            raise ValueError(f'Cannot import player {name!r}: the account {username!r} can log in')
+        known[name] = accounts[username]
+    return known
+
+
+def save_games(records, known_players):
+    """Insert a batch of parsed games and add them to the players' totals, in one transaction."""
+    with transaction.atomic():
+        ids = player_ids({name for record in records for name in record[:2]}, known_players)
+        games = []
+        positions = []
+        tallies = {'wins': Counter(), 'losses': Counter(), 'draws': Counter()}
+        for white, black, result, termination, fen, turn, move_log, opening_keys in records:
+            white_id, black_id = ids[white], ids[black]
+            if result == Game.DRAW:
+                winner_id, outcome = None, 'Draw'
+                tallies['draws'].update((white_id, black_id))
+            else:
+                winner_id, loser_id = (white_id, black_id) if result == Game.WHITE_WINS else (black_id, white_id)
+                outcome = f'{white if winner_id == white_id else black} wins'
+                tallies['wins'][winner_id] += 1
+                tallies['losses'][loser_id] += 1
+            if termination:
+                label = Game.Termination(termination).label.lower()
+                outcome = f'{outcome} by {label}'
+            games.append(Game(
+                player1_id=white_id, player2_id=black_id, active=False, moves=len(move_log) // 2,
+                fen=fen, turn=turn, move_log=move_log, result=result, winner_id=winner_id,
+                # Long player names would not fit
+                termination=termination, outcome=outcome[:OUTCOME_MAX_LENGTH],
+            ))
+            positions.append((opening_keys, result))
+        Game.objects.bulk_create(games)
+        _add_to_stats(tallies)
+        openings.add_positions(positions)
+        game_list.invalidate(*{game.player1_id for game in games} | {game.player2_id for game in games})
+    return len(games)
+
+
+def _add_to_stats(tallies):
+    # One UPDATE per counter for the whole batch, rather than one per player
+    players = set().union(*tallies.values())
+    UserStats.objects.bulk_create([UserStats(user_id=user_id) for user_id in players], ignore_conflicts=True)
+    for field, counts in tallies.items():
+        if counts:
+            UserStats.objects.filter(user_id__in=counts).update(**{field: F(field) + Case(
+                *[When(user_id=user_id, then=count) for user_id, count in counts.items()],
+                output_field=PositiveIntegerField(),
+            )})
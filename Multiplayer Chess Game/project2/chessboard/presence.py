@@ -0,0 +1,114 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+from typing import NamedTuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.core.cache import cache
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import UserPresence
+
+# A user counts as online if we have heard from them within this window
+PRESENCE_TIMEOUT = getattr(settings, 'PRESENCE_TIMEOUT', 60)
+
+# Only write the heartbeat to the database once per interval per user;
+# requests in between are answered from the cache
+HEARTBEAT_INTERVAL = getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 15)
+
+# The online list served to lobby pollers is rebuilt at most this often
+SNAPSHOT_INTERVAL = getattr(settings, 'ONLINE_SNAPSHOT_INTERVAL', 2)
+SNAPSHOT_KEY = 'presence:online-snapshot'
+SNAPSHOT_LOCK_KEY = 'presence:online-snapshot:lock'
+# Longest a rebuild may hold the lock; a crashed leader frees it after this
+SNAPSHOT_LOCK_TIMEOUT = 10
+
+
+def _heartbeat_key(user_id):
+    return f'presence:heartbeat:{user_id}'
+
+
+def touch(user_id):
+    """Record that the user was just seen."""
+    if cache.get(_heartbeat_key(user_id)):
+        return
+    now = timezone.now()
+    if not UserPresence.objects.filter(user_id=user_id).update(last_seen=now):
+        UserPresence.objects.update_or_create(user_id=user_id, defaults={'last_seen': now})
+    cache.set(_heartbeat_key(user_id), True, HEARTBEAT_INTERVAL)
+
+
+def clear(user_id):
+    """Mark the user as offline straight away (e.g. on logout)."""
+    cache.delete(_heartbeat_key(user_id))
+    UserPresence.objects.filter(user_id=user_id).delete()
+
+
+def online_cutoff():
+    return timezone.now() - timedelta(seconds=PRESENCE_TIMEOUT)
+
+
+def online_users():
+    """Users seen within the presence window, as one indexed range query."""
+    return User.objects.filter(presence__last_seen__gte=online_cutoff())
+
+
+class OnlineSnapshot(NamedTuple):
+    built_at: float
+    version: str  # Digest of the list, so it only changes when the list does
+    body: bytes  # The JSON response, serialized once for every poller
+
+
+def _build_snapshot():
+    users = list(online_users().order_by('username').values('id', 'username'))
+    version = hashlib.blake2b(json.dumps(users).encode(), digest_size=8).hexdigest()
+    body = json.dumps({'v': version, 'online_users': users}, separators=(',', ':')).encode()
+    return OnlineSnapshot(time.time(), version, body)
+
+
+def online_snapshot():
+    """The shared online-users snapshot, rebuilt at most once per SNAPSHOT_INTERVAL.
+
+    The snapshot lives in the cache, so every poller (and every process, with
+    a shared backend) is served the same bytes. When it goes stale one caller
+    wins the cache.add() lock and rebuilds it; everyone else keeps serving the
+    stale copy meanwhile, so a stampede of polls costs one query. Only with
+    nothing cached at all (a cold start) do the others query for themselves.
+    """
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot is not None and time.time() - snapshot.built_at < SNAPSHOT_INTERVAL:
+        return snapshot
+
+    if cache.add(SNAPSHOT_LOCK_KEY, True, SNAPSHOT_LOCK_TIMEOUT):
+        try:
+            snapshot = _build_snapshot()
+            # Past the presence window a snapshot is wrong, not just stale
+            cache.set(SNAPSHOT_KEY, snapshot, PRESENCE_TIMEOUT)
+        finally:
+            cache.delete(SNAPSHOT_LOCK_KEY)
+        return snapshot
+
+    if snapshot is not None:
+        return snapshot
+    # Nothing cached yet and another caller is building it: build our own
+    # rather than wait, which only happens until the first build lands
+    return _build_snapshot()
+
+
+def is_online(user_id):
+    return UserPresence.objects.filter(user_id=user_id, last_seen__gte=online_cutoff()).exists()
+
+
+@receiver(user_logged_in)
+def _on_login(sender, request, user, **kwargs):
+    touch(user.id)
+
+
+@receiver(user_logged_out)
+def _on_logout(sender, request, user, **kwargs):
+    if user is not None:
+        clear(user.id)
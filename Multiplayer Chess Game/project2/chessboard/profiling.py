@@ -0,0 +1,233 @@
+"""Opt-in sampled request profiling.
+
+One request in PROFILE_SAMPLE_RATE is profiled, as is any request carrying a
+valid signed X-Profile header (see profile_token()). Each profile is written
+to PROFILE_DIR as one file per request, named after the view and the time
+taken, and only the newest PROFILE_MAX_FILES are kept.
+
+PROFILE_MODE picks the profiler:
+  'sample' (default)  a stack sampler of the request's own thread; writes
+                      .collapsed files, one 'frame;frame;frame count' line
+                      per stack, ready for flamegraph.pl or speedscope
+  'cprofile'          deterministic; writes .pstats files for pstats/snakeviz.
+                      From Python 3.12 it sees every thread, so a profile also
+                      holds whatever other requests ran meanwhile
+
+Only one request per process is profiled at a time (cProfile refuses to run
+twice at once); a request that would overlap runs unprofiled. Profiling never
+fails a request: profiler errors are logged and the request served as usual.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core import signing
+
+# 0 disables sampling; profiling is then only done on request
+SAMPLE_RATE = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+MODE = getattr(settings, 'PROFILE_MODE', 'sample')
+PROFILE_DIR = getattr(settings, 'PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+MAX_FILES = getattr(settings, 'PROFILE_MAX_FILES', 200)
+# Seconds between stack samples in 'sample' mode
+SAMPLE_INTERVAL = getattr(settings, 'PROFILE_SAMPLE_INTERVAL', 0.002)
+
+HEADER = 'X-Profile'
+TOKEN_SALT = 'chessboard.profiling'
+TOKEN_MAX_AGE = 24 * 60 * 60
+
+EXTENSIONS = {'cprofile': '.pstats', 'sample': '.collapsed'}
+logger = logging.getLogger(__name__)
+
+# Held while a request is being profiled
+_profiling = threading.Lock()
+
+PROFILE_NAME = re.compile(r'^(?P<stamp>\d+)-(?P<view>[\w.-]+)-(?P<ms>\d+)ms\.(?P<ext>pstats|collapsed)$')
+
+
+def profile_token():
+    """A header value that gets requests profiled for the next day."""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+def _token_valid(value):
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(value, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def wanted(request):
+    """Whether to profile this request."""
+    token = request.headers.get(HEADER)
+    if token is not None and _token_valid(token):
+        return True
+    return SAMPLE_RATE > 0 and random.randrange(SAMPLE_RATE) == 0
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval from a helper thread."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if self._stop.is_set():
+                break  # The request finished while we were waking up
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+def profile_request(get_response, request):
+    """Run the request under the configured profiler and save the result."""
+    if not _profiling.acquire(blocking=False):
+        # Another request is being profiled; serve this one normally
+        return get_response(request)
+    try:
+        return _profile_request(get_response, request)
+    finally:
+        _profiling.release()
+
+
+def _profile_request(get_response, request):
+    if MODE == 'sample':
+        profiler = StackSampler(threading.get_ident())
+        profiler.start()
+        started = time.perf_counter()
+        try:
+            response = get_response(request)
+        finally:
+            profiler.stop()
+    else:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Some other profiler (e.g. a debugger or coverage tool) is active
+            logger.warning('event=profile_skipped reason=profiler_active')
+            return get_response(request)
+        started = time.perf_counter()
+        try:
+            response = get_response(request)
+        finally:
+            profiler.disable()
+    elapsed = time.perf_counter() - started
+
+    match = request.resolver_match
+    view = (match.url_name or match.view_name) if match is not None else 'unmatched'
+    try:
+        save(profiler, re.sub(r'[^\w.-]', '_', view), elapsed)
+    except Exception:
+        logger.exception('event=profile_save_failed view=%s', view)
+    return response
+
+
+def save(profiler, view, elapsed):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f'{time.time_ns()}-{view}-{round(elapsed * 1000)}ms{EXTENSIONS[MODE]}'
+    path = os.path.join(PROFILE_DIR, name)
+    if isinstance(profiler, StackSampler):
+        profiler.write(path)
+    else:
+        profiler.dump_stats(path)
+    rotate()
+
+
+def profile_files():
+    """[(file name, match)] for the saved profiles, newest first."""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    matches = [(name, PROFILE_NAME.match(name)) for name in names]
+    return sorted(((name, match) for name, match in matches if match), key=lambda item: -int(item[1]['stamp']))
+
+
+def rotate():
+    # Drop the oldest profiles beyond the limit
+    for name, _ in profile_files()[MAX_FILES:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except FileNotFoundError:
+            pass  # Another process rotated it first
+
+
+def hottest_views():
+    """Per view: profiles taken and total/mean/max milliseconds, slowest total first."""
+    totals = defaultdict(list)
+    for _, match in profile_files():
+        totals[match['view']].append(int(match['ms']))
+    views = [
+        {'view': view, 'profiles': len(ms), 'total_ms': sum(ms), 'mean_ms': sum(ms) / len(ms), 'max_ms': max(ms)}
+        for view, ms in totals.items()
+    ]
+    return sorted(views, key=lambda row: -row['total_ms'])
+
+
+def hottest_functions(limit=30, view=None):
+    """The functions with the most time of their own across the saved profiles.
+
+    From .pstats files: own and cumulative seconds and call counts. From
+    .collapsed files: own and cumulative sample counts.
+    """
+    paths = {'pstats': [], 'collapsed': []}
+    for name, match in profile_files():
+        if view is None or match['view'] == view:
+            paths[match['ext']].append(os.path.join(PROFILE_DIR, name))
+
+    rows = []
+    if paths['pstats']:
+        stats = pstats.Stats(*paths['pstats'])
+        timed = [
+            {'function': f'{function} ({os.path.basename(filename)}:{line})',
+             'calls': calls, 'own': own, 'cumulative': cumulative, 'unit': 's'}
+            for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items()
+        ]
+        rows.extend(sorted(timed, key=lambda row: -row['own'])[:limit])
+    if paths['collapsed']:
+        own, cumulative = Counter(), Counter()
+        for path in paths['collapsed']:
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    frames = stack.split(';')
+                    own[frames[-1]] += int(count)
+                    for frame in set(frames):
+                        cumulative[frame] += int(count)
+        sampled = [
+            {'function': frame, 'calls': None, 'own': own[frame], 'cumulative': total, 'unit': 'samples'}
+            for frame, total in cumulative.items()
+        ]
+        rows.extend(sorted(sampled, key=lambda row: -row['own'])[:limit])
+    return rows
@@ -0,0 +1,212 @@
+import asyncio
+import re
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http.request import split_domain_port, validate_host
+
+# Only the latest state matters to a client, so a slow socket just drops
+# older events instead of buffering an unbounded backlog
+QUEUE_SIZE = 8
+
+GAME_SOCKET_PATH = re.compile(r'^/ws/game/(?P<game_id>\d+)/$')
+
+
+def game_channel(game_id):
+    return f'game:{game_id}'
+
+
+class Hub:
+    """In-process publish/subscribe layer; no external broker needed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._waiters = defaultdict(set)
+
+    def subscribe(self, channel):
+        # Must be called from the event loop that will read the queue
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[channel].add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None:
+                return
+            subscribers.difference_update({s for s in subscribers if s[1] is queue})
+            if not subscribers:
+                del self._subscribers[channel]
+
+    @contextmanager
+    def listen(self, channel):
+        """Register for publishes on the channel; yields a threading.Event set by each one.
+
+        Register before reading the state being waited on, then clear the
+        event, read, and wait on it: a publish landing between the read and
+        the wait then still wakes the waiter.
+        """
+        event = threading.Event()
+        with self._lock:
+            self._waiters[channel].add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(channel)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[channel]
+
+    def wait(self, channel, timeout):
+        """Block the calling thread until something is published on the channel.
+
+        Returns True if woken by a publish, False on timeout. Anything
+        published before the call is missed; see listen().
+        """
+        with self.listen(channel) as event:
+            return event.wait(timeout)
+
+    def publish(self, channel, message):
+        """Deliver a message to every subscriber; safe to call from any thread."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+            waiters = list(self._waiters.get(channel, ()))
+        for event in waiters:
+            event.set()
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_put_latest, queue, message)
+            except RuntimeError:
+                # The subscriber's event loop has already shut down
+                pass
+
+
+def _put_latest(queue, message):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+hub = Hub()
+
+
+class GameStateEvent:
+    """A committed game state, encoded lazily (and once) per wire format."""
+
+    def __init__(self, game):
+        self.game = game
+        self._lock = threading.Lock()
+        self._encoded = {}
+
+    def encode(self, wire_format):
+        from .views import encode_game_state
+        with self._lock:
+            if wire_format not in self._encoded:
+                self._encoded[wire_format] = encode_game_state(self.game, wire_format)[0]
+            return self._encoded[wire_format]
+
+
+def publish_game_state(game):
+    """Push the current state of a game to everyone watching it."""
+    # Load the players here, in the committing thread, so that encoding the
+    # event later on the event loop never has to touch the database
+    game.player1, game.player2
+    hub.publish(game_channel(game.id), GameStateEvent(game))
+
+
+def _load_game_for_user(session_key, game_id, wire_format):
+    # Runs in a worker thread: resolve the session cookie to a user the same
+    # way AuthenticationMiddleware does, then check they play in this game
+    from .models import Game
+    from .views import encode_game_state
+    close_old_connections()
+    try:
+        engine = import_module(settings.SESSION_ENGINE)
+        request = SimpleNamespace(session=engine.SessionStore(session_key))
+        user = get_user(request)
+        if not user.is_authenticated:
+            return None
+        game = Game.objects.select_related('player1', 'player2').filter(id=game_id).first()
+        if game is None or user.id not in (game.player1_id, game.player2_id):
+            return None
+        return encode_game_state(game, wire_format)[0]
+    finally:
+        close_old_connections()
+
+
+def _headers(scope):
+    return {name.decode('latin1'): value.decode('latin1') for name, value in scope.get('headers', [])}
+
+
+def _origin_allowed(headers):
+    origin = headers.get('origin')
+    if origin is None:
+        return True
+    host = origin.split('://', 1)[-1]
+    domain, port = split_domain_port(host)
+    allowed_hosts = settings.ALLOWED_HOSTS or ['localhost', '127.0.0.1', '[::1]']
+    return bool(domain) and validate_host(domain, allowed_hosts)
+
+
+async def websocket_application(scope, receive, send):
+    """Raw ASGI websocket handler for /ws/game/<id>/."""
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    match = GAME_SOCKET_PATH.match(scope['path'])
+    headers = _headers(scope)
+    if match is None or not _origin_allowed(headers):
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    cookie = SimpleCookie(headers.get('cookie', ''))
+    morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+    game_id = int(match['game_id'])
+    # Clients pick the wire format with ?format=compact, as for polling
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    wire_format = 'compact' if query.get('format') == ['compact'] else 'full'
+    initial_state = None
+    if morsel is not None:
+        initial_state = await sync_to_async(_load_game_for_user)(morsel.value, game_id, wire_format)
+    if initial_state is None:
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+
+    channel = game_channel(game_id)
+    queue = hub.subscribe(channel)
+    receive_task = None
+    try:
+        await send({'type': 'websocket.accept'})
+        await send({'type': 'websocket.send', 'text': initial_state})
+
+        receive_task = asyncio.ensure_future(receive())
+        while True:
+            queue_task = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({receive_task, queue_task}, return_when=asyncio.FIRST_COMPLETED)
+            if queue_task in done:
+                await send({'type': 'websocket.send', 'text': queue_task.result().encode(wire_format)})
+            else:
+                queue_task.cancel()
+            if receive_task in done:
+                if receive_task.result()['type'] == 'websocket.disconnect':
+                    break
+                # Clients have nothing to say; ignore anything they send
+                receive_task = asyncio.ensure_future(receive())
+    finally:
+        if receive_task is not None and not receive_task.done():
+            receive_task.cancel()
+        hub.unsubscribe(channel, queue)
@@ -0,0 +1,91 @@
+import json
+from types import MappingProxyType
+from typing import NamedTuple
+
+import chess
+from django.conf import settings
+
+from . import metrics
+from .lru import LRUCache
+
+# Mapping of chess pieces to their Unicode symbols
+PIECE_SYMBOLS = {
+    'K': '&#9812;', 'Q': '&#9813;', 'R': '&#9814;', 'B': '&#9815;', 'N': '&#9816;', 'P': '&#9817;',  # White pieces
+    'k': '&#9818;', 'q': '&#9819;', 'r': '&#9820;', 'b': '&#9821;', 'n': '&#9822;', 'p': '&#9823;'   # Black pieces
+}
+
+# Labels for A-H at the bottom of the board
+ROW_LABELS = MappingProxyType({"row_labels": MappingProxyType({c: c for c in "ABCDEFGH"})})
+
+
+class RenderedPosition(NamedTuple):
+    """Read-only, pre-rendered form of a position, shared between requests."""
+    page_data: MappingProxyType  # {"rows": (...)} in the shape the template expects
+    page_data_json: str  # page_data already serialized for the full wire format
+    turn: str  # 'white' or 'black'
+
+
+render_cache = metrics.register_cache('render', LRUCache(getattr(settings, 'BOARD_RENDER_CACHE_SIZE', 1024)))
+legal_move_cache = metrics.register_cache('legal_moves', LRUCache(getattr(settings, 'LEGAL_MOVE_CACHE_SIZE', 1024)))
+
+
+def normalize_fen(fen):
+    return chess.STARTING_FEN if fen == 'startpos' else fen
+
+
+def position_key(fen):
+    # Only piece placement and side to move affect the rendering; castling,
+    # en passant and the clocks do not, so positions differing only in those share an entry
+    placement, _, rest = normalize_fen(fen).partition(' ')
+    return f'{placement} {rest[:1] or "w"}'
+
+
+def legal_moves_key(fen):
+    # Castling rights and the en passant square change the legal moves; the clocks do not
+    return ' '.join(normalize_fen(fen).split(' ')[:4])
+
+
+def legal_moves(fen, chess_board=None):
+    """Legal moves of the side to move, as space-separated UCI, memoized per position."""
+    def build():
+        board = chess_board if chess_board is not None else chess.Board(normalize_fen(fen))
+        return ' '.join(sorted(move.uci() for move in board.legal_moves))
+    return legal_move_cache.get_or_create(legal_moves_key(fen), build)
+
+
+def render_position(fen, chess_board=None):
+    """Rendered board for a FEN, memoized per position.
+
+    Pass the chess.Board if the caller already has one, to skip re-parsing on a miss.
+    """
+    return render_cache.get_or_create(position_key(fen), lambda: _render(fen, chess_board))
+
+
+def _render(fen, chess_board):
+    if chess_board is None:
+        try:
+            chess_board = chess.Board(normalize_fen(fen))  # Load the FEN from the game model
+        except ValueError as e:
+            raise ValueError(f"Error loading FEN: {e}")
+
+    rows = []
+    plain_rows = []
+    for row_number in range(8, 0, -1):  # Chess rows 8 to 1
+        row_data = {'row_number': row_number}
+
+        for col in 'abcdefgh':  # Columns a to h
+            square_index = chess.square(ord(col) - ord('a'), row_number - 1)  # Convert 'a1' to square index
+            piece = chess_board.piece_at(square_index)
+            row_data[f"{col}{row_number}"] = PIECE_SYMBOLS.get(piece.symbol(), '&nbsp;') if piece else '&nbsp;'
+
+        plain_rows.append(row_data)
+        rows.append(MappingProxyType(row_data))
+
+    plain_rows.append({"row_labels": dict(ROW_LABELS["row_labels"])})
+    rows.append(ROW_LABELS)
+
+    return RenderedPosition(
+        page_data=MappingProxyType({"rows": tuple(rows)}),
+        page_data_json=json.dumps({"rows": plain_rows}),
+        turn='white' if chess_board.turn else 'black',
+    )
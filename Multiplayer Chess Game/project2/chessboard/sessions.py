@@ -0,0 +1,35 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.dispatch import receiver
+
+from .models import UserSession
+
+
+def end_sessions(user):
+    """Log the user out everywhere: delete all their sessions by the user index."""
+    with transaction.atomic():
+        keys = UserSession.objects.filter(user=user).values('session_key')
+        Session.objects.filter(session_key__in=keys).delete()
+        UserSession.objects.filter(user=user).delete()
+
+
+def forget(session_keys):
+    """Drop the index rows of any of these sessions that no longer exist (e.g. swept ones)."""
+    live = Session.objects.filter(session_key__in=session_keys).values('session_key')
+    UserSession.objects.filter(session_key__in=session_keys).exclude(session_key__in=live).delete()
+
+
+@receiver(user_logged_in)
+def _on_login(sender, request, user, **kwargs):
+    # login() has already cycled the key, so this is the session being used from now on
+    session_key = request.session.session_key
+    if session_key:
+        UserSession.objects.update_or_create(session_key=session_key, defaults={'user': user})
+
+
+@receiver(user_logged_out)
+def _on_logout(sender, request, user, **kwargs):
+    # Sent just before the session is flushed
+    if request.session.session_key:
+        UserSession.objects.filter(session_key=request.session.session_key).delete()
@@ -1,3 +1,1287 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import chess
+import chess.polyglot
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    challenges, computer, engine, game_list, gameplay, metrics, movelog, openings, pgn, presence, profiling,
+    realtime, rendering, sessions, views,
+)
+from .forms import JoinForm
+from .lru import LRUCache
+from .middleware import MetricsMiddleware
+from .models import (
+    Challenge, Game, OpeningMove, OpeningMoveRebuild, PositionCount, UserGameJournal, UserPresence, UserSession,
+    UserStats,
+)
+
+# Plan fragments that mean the whole chessboard_game table is read. Walking
+# one of the partial indexes over active games is fine: it only holds the few
+# games in progress.
+SEQUENTIAL_SCANS = {
+    'postgresql': re.compile(r'Seq Scan on "?chessboard_game"?\b'),
+    'sqlite': re.compile(r'^SCAN chessboard_game\b(?! USING (COVERING )?INDEX game_active_)'),
+}
+
+
+class HotQueryPlanTests(TestCase):
+    """Guards the SQL behind the polled views against seq scans and N+1 patterns.
+
+    The database is seeded with enough games that a missing index would show
+    up in the plan; every query a view runs against chessboard_game is then
+    EXPLAINed.
+    """
+
+    USERS = 30
+    GAMES = 3000
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(620)
+        cls.users = User.objects.bulk_create([User(username=f'player{i}') for i in range(cls.USERS)])
+        games = []
+        for _ in range(cls.GAMES):
+            player1, player2 = rng.sample(cls.users, 2)
+            games.append(Game(player1=player1, player2=player2, active=False, moves=rng.randint(1, 80),
+                              result=Game.WHITE_WINS, winner=player1, termination=Game.Termination.RESIGNATION))
+        Game.objects.bulk_create(games, batch_size=500)
+
+        # A fresh game in progress, and a user with only a handful of games
+        cls.active_game = Game.objects.create(player1=cls.users[0], player2=cls.users[1])
+        cls.light_user = User.objects.create(username='newcomer')
+        Game.objects.bulk_create([
+            Game(player1=cls.light_user, player2=cls.users[2], active=False, moves=10, result=Game.DRAW)
+            for _ in range(12)
+        ])
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        # Cached fragments (e.g. the home game list) would hide the queries under test
+        cache.clear()
+
+    def capture(self, user, url):
+        """Request `url` as `user`, returning the response and every (sql, params) it ran."""
+        self.client.force_login(user)
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            queries.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            response = self.client.get(url)
+        self.assertLess(response.status_code, 400)
+        return response, queries
+
+    def explain(self, sql, params):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # With seq scans priced out, the planner only picks one if no index applies
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}', params)
+                return [row[0] for row in cursor.fetchall()]
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                return [row[-1] for row in cursor.fetchall()]
+        self.skipTest(f'No plan inspection for {connection.vendor}')
+
+    def assertNoGameTableScan(self, queries):
+        pattern = SEQUENTIAL_SCANS.get(connection.vendor)
+        for sql, params in queries:
+            if not sql.startswith('SELECT') or 'chessboard_game' not in sql:
+                continue
+            plan = self.explain(sql, params)
+            for line in plan:
+                self.assertIsNone(
+                    pattern.search(line.strip()),
+                    f'Sequential scan of chessboard_game:\n{sql}\n' + '\n'.join(plan),
+                )
+
+    def test_home_game_list(self):
+        _, queries = self.capture(self.users[5], reverse('home'))
+        self.assertNoGameTableScan(queries)
+
+    def test_home_query_count_does_not_grow_with_history(self):
+        # Same number of queries for a user with hundreds of games as for one with a dozen
+        _, heavy = self.capture(self.users[5], reverse('home'))
+        _, light = self.capture(self.light_user, reverse('home'))
+        self.assertEqual(len(heavy), len(light), 'home issues per-game queries (N+1)')
+
+    def test_game_in_progress(self):
+        _, queries = self.capture(self.users[0], reverse('game_in_progress'))
+        self.assertNoGameTableScan(queries)
+
+    def test_get_game_state(self):
+        _, queries = self.capture(self.users[1], reverse('get_game_state', args=[self.active_game.id]))
+        self.assertNoGameTableScan(queries)
+        self.assertEqual(sum('chessboard_game' in sql for sql, _ in queries), 1)
+
+    def test_challenge_inbox(self):
+        _, queries = self.capture(self.users[1], reverse('challenge_inbox') + '?timeout=0')
+        self.assertNoGameTableScan(queries)
+
+
+class OpeningExplorerTests(TestCase):
+    """The explorer index is kept up to date as games finish, and read with one indexed query."""
+
+    def setUp(self):
+        openings.explorer_cache.clear()
+        self.white = User.objects.create(username='white')
+        self.black = User.objects.create(username='black')
+
+    def play(self, moves, loser):
+        game = Game.objects.create(player1=self.white, player2=self.black)
+        for uci in moves:
+            gameplay.play_move(game, self.white if game.turn == 'white' else self.black, uci)
+        gameplay.resign(game, loser)
+
+    def test_counts_results_per_move(self):
+        self.play(['e2e4', 'e7e5'], loser=self.black)
+        self.play(['e2e4', 'c7c5'], loser=self.white)
+        self.play(['d2d4'], loser=self.white)
+        self.client.force_login(self.white)
+
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            response = self.client.get(reverse('opening_explorer'))
+        moves = {row['uci']: row for row in response.json()['moves']}
+        self.assertEqual(moves['e2e4']['games'], 2)
+        self.assertEqual(moves['e2e4']['white_pct'], 50.0)
+        self.assertEqual(moves['d2d4']['black_wins'], 1)
+        self.assertEqual(sum('chessboard_openingmove' in sql for sql in queries), 1)
+
+        response = self.client.get(reverse('opening_explorer'), {'moves': 'e2e4'})
+        self.assertEqual([row['san'] for row in response.json()['moves']], ['c5', 'e5'])
+
+
+    def test_rebuild(self):
+        self.play(['e2e4', 'e7e5'], loser=self.black)
+        self.play(['e2e4', 'c7c5'], loser=self.white)
+        unfinished = Game.objects.create(player1=self.white, player2=self.black)
+        gameplay.play_move(unfinished, self.white, 'e2e4')
+        OpeningMove.objects.filter(move=movelog.move_code(chess.Move.from_uci('e2e4'))).update(draws=7)
+        broken = list(OpeningMove.objects.values_list('position_hash', 'move', 'white_wins', 'draws', 'black_wins'))
+
+        add_games = openings.add_games
+
+        def build(games, model=OpeningMove):
+            if model is OpeningMoveRebuild and unfinished.active:
+                # The explorer keeps the whole old index while the new one is built...
+                self.assertCountEqual(
+                    OpeningMove.objects.values_list('position_hash', 'move', 'white_wins', 'draws', 'black_wins'),
+                    broken,
+                )
+                # ...and a game finishing meanwhile still ends up counted once
+                gameplay.resign(unfinished, self.black)
+            return add_games(games, model)
+
+        with mock.patch.object(openings, 'add_games', side_effect=build):
+            call_command('rebuild_openings', stdout=io.StringIO())
+        e4 = OpeningMove.objects.get(move=movelog.move_code(chess.Move.from_uci('e2e4')))
+        self.assertEqual((e4.white_wins, e4.draws, e4.black_wins), (2, 0, 1))
+        self.assertFalse(OpeningMoveRebuild.objects.exists())
+
+
+class ComputerOpponentTests(TestCase):
+    """The computer's account is only created by playing it, and never confused with a person."""
+
+    def setUp(self):
+        patcher = mock.patch.object(computer, '_computer_id', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.human = User.objects.create_user('human', password='secret')
+        self.client.force_login(self.human)
+
+    def test_game_page_does_not_create_the_computer(self):
+        opponent = User.objects.create_user('opponent')
+        Game.objects.create(player1=self.human, player2=opponent)
+        self.assertEqual(self.client.get(reverse('game_in_progress')).status_code, 200)
+        self.assertFalse(User.objects.filter(username=computer.COMPUTER_USERNAME).exists())
+
+    def test_person_named_computer_is_not_the_computer(self):
+        person = User.objects.create_user(computer.COMPUTER_USERNAME, password='secret')
+        Game.objects.create(player1=self.human, player2=person)
+        response = self.client.get(reverse('game_in_progress'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['against_computer'])
+        # Playing the computer is refused rather than playing moves for them
+        Game.objects.filter(player1=self.human).update(active=False)
+        with self.assertLogs('chessboard.views', 'ERROR'):
+            response = self.client.post(reverse('play_computer'))
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        self.assertFalse(Game.objects.filter(player2=person, active=True).exists())
+
+    def test_play_computer(self):
+        self.client.post(reverse('play_computer'))
+        game = Game.objects.select_related('player2').get(active=True)
+        self.assertEqual(game.player1, self.human)
+        self.assertFalse(game.player2.has_usable_password())
+        self.assertFalse(game.player2.is_active)
+        self.assertTrue(self.client.get(reverse('game_in_progress')).context['against_computer'])
+
+    def test_username_is_reserved(self):
+        form = JoinForm({'username': computer.COMPUTER_USERNAME.title(), 'password': 'x', 'confirm_password': 'x'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('username', form.errors)
+
+    def test_hint_stored_while_checking_wakes_the_waiter(self):
+        game = Game.objects.create(player1=self.human, player2=User.objects.create_user('opponent'))
+        key = computer.hint_key(game, self.human)
+        hint = {'move': 'e2e4', 'score': 30, 'depth': 4, 'pv': ['e2e4']}
+        get = cache.get
+
+        def finish_search(cache_key, *args):
+            value = get(cache_key, *args)
+            if value is None:
+                # The search finishes right after the waiter looked
+                cache.set(key, hint)
+                realtime.hub.publish(computer.hint_channel(game.id, self.human.id), None)
+            return value
+
+        started = time.monotonic()
+        with mock.patch.object(computer.cache, 'get', side_effect=finish_search):
+            self.assertEqual(computer.wait_for_hint(game, self.human, timeout=5), hint)
+        self.assertLess(time.monotonic() - started, computer.HINT_RECHECK / 2)
+
+
+class ChallengeTests(TestCase):
+    """Sending, answering and expiring challenges; a user plays one game at a time."""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.carol = User.objects.create_user('carol')
+
+    def test_send(self):
+        challenge = challenges.send_challenge(self.alice, self.bob)
+        self.assertEqual(challenge.status, Challenge.Status.PENDING)
+        state = challenges.inbox_state(self.bob)
+        self.assertEqual(state['challenges'], [{'id': challenge.id, 'challenger': 'alice'}])
+        # Nothing new once the lobby has shown it
+        self.assertIsNone(challenges.inbox_state(self.bob, after=challenge.id))
+
+    def test_duplicate_is_rejected(self):
+        challenges.send_challenge(self.alice, self.bob)
+        with self.assertRaises(challenges.ChallengeError):
+            challenges.send_challenge(self.alice, self.bob)
+        with self.assertRaises(challenges.ChallengeError):
+            challenges.send_challenge(self.bob, self.alice)
+        self.assertEqual(Challenge.objects.count(), 1)
+
+    def test_accept_starts_a_game(self):
+        challenge = challenges.send_challenge(self.alice, self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            accepted = challenges.respond(challenge.id, self.bob, accept=True)
+        self.assertEqual(accepted.status, Challenge.Status.ACCEPTED)
+        game = Game.objects.get(active=True)
+        self.assertEqual((game.player1, game.player2), (self.alice, self.bob))
+        self.assertEqual(challenges.inbox_state(self.alice, sent=challenge.id), {'game_started': True})
+        # Answering twice does nothing
+        self.assertIsNone(challenges.respond(challenge.id, self.bob, accept=True))
+        self.assertEqual(Game.objects.count(), 1)
+
+    def test_accept_while_playing_is_rejected(self):
+        first = challenges.send_challenge(self.alice, self.bob)
+        second = challenges.send_challenge(self.carol, self.bob)
+        challenges.respond(first.id, self.bob, accept=True)
+        with self.assertRaisesMessage(challenges.ChallengeError, 'carol'):
+            challenges.respond(second.id, self.bob, accept=True)
+        self.assertEqual(Game.objects.filter(active=True).count(), 1)
+        # The challenge is still there to decline
+        self.assertEqual(challenges.respond(second.id, self.bob, accept=False).status, Challenge.Status.DECLINED)
+
+    def test_accept_while_playing_view(self):
+        first = challenges.send_challenge(self.alice, self.bob)
+        second = challenges.send_challenge(self.carol, self.alice)
+        challenges.respond(first.id, self.bob, accept=True)
+        self.client.force_login(self.alice)
+        response = self.client.post(reverse('respond_to_challenge', args=[second.id]), {'action': 'accept'})
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(response.json()['success'])
+
+    def test_decline(self):
+        challenge = challenges.send_challenge(self.alice, self.bob)
+        declined = challenges.respond(challenge.id, self.bob, accept=False)
+        self.assertEqual(declined.status, Challenge.Status.DECLINED)
+        self.assertFalse(Game.objects.exists())
+        state = challenges.inbox_state(self.alice, sent=challenge.id)
+        self.assertEqual(state['sent_status'], Challenge.Status.DECLINED)
+        # Only the recipient can answer
+        other = challenges.send_challenge(self.alice, self.carol)
+        self.assertIsNone(challenges.respond(other.id, self.bob, accept=True))
+
+    def test_expiry(self):
+        challenge = challenges.send_challenge(self.alice, self.bob)
+        Challenge.objects.filter(id=challenge.id).update(expires_at=challenge.created_at)
+        # Overdue challenges are hidden without the inbox writing anything
+        with self.assertNumQueries(2):
+            self.assertIsNone(challenges.inbox_state(self.bob))
+        state = challenges.inbox_state(self.alice, sent=challenge.id)
+        self.assertEqual(state['sent_status'], Challenge.Status.EXPIRED)
+        self.assertIsNone(challenges.respond(challenge.id, self.bob, accept=True))
+        # The next send marks it expired, and the pair can challenge again
+        challenges.send_challenge(self.bob, self.alice)
+        challenge.refresh_from_db()
+        self.assertEqual(challenge.status, Challenge.Status.EXPIRED)
+
+    def test_inbox_wakes_for_a_challenge_sent_while_reading(self):
+        done = []
+
+        def wrapper(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            if not done and 'FROM "chessboard_challenge"' in sql:
+                # Alice's challenge is committed right after Bob's inbox read
+                done.append(True)
+                with self.captureOnCommitCallbacks(execute=True):
+                    challenges.send_challenge(self.alice, self.bob)
+            return result
+
+        started = time.monotonic()
+        with connection.execute_wrapper(wrapper):
+            state = challenges.wait_for_inbox(self.bob, timeout=20)
+        self.assertEqual([challenge['challenger'] for challenge in state['challenges']], ['alice'])
+        self.assertLess(time.monotonic() - started, challenges.INBOX_RECHECK / 2)
+
+
+class GameEndingTests(TestCase):
+    """A move that ends the game finishes it on the spot, with the result and stats recorded."""
+
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+
+    def new_game(self, fen=None):
+        game = Game.objects.create(player1=self.white, player2=self.black, active=True)
+        if fen is not None:
+            # As if the earlier moves were played before moves were logged
+            chess_board = chess.Board(fen)
+            Game.objects.filter(id=game.id).update(
+                fen=fen, turn='white' if chess_board.turn else 'black', moves=chess_board.ply(),
+            )
+            game.refresh_from_db()
+        return game
+
+    def play(self, game, *moves):
+        for uci in moves:
+            gameplay.play_move(game, self.white if game.turn == 'white' else self.black, uci)
+        return game
+
+    def stats(self, user):
+        return UserStats.objects.filter(user=user).values_list('wins', 'losses', 'draws').first()
+
+    def assertEnded(self, game, result, termination):
+        # The instance is up to date without a reload, and agrees with the row
+        self.assertFalse(game.active)
+        self.assertEqual((game.result, game.termination), (result, termination))
+        game.refresh_from_db()
+        self.assertFalse(game.active)
+        self.assertEqual((game.result, game.termination), (result, termination))
+
+    def test_checkmate(self):
+        game = self.play(self.new_game(), 'f2f3', 'e7e5', 'g2g4', 'd8h4')
+        self.assertEnded(game, Game.BLACK_WINS, Game.Termination.CHECKMATE)
+        self.assertEqual(game.winner, self.black)
+        self.assertEqual(game.outcome, 'black wins by checkmate')
+        self.assertEqual(self.stats(self.white), (0, 1, 0))
+        self.assertEqual(self.stats(self.black), (1, 0, 0))
+        # The move log is complete, so the game is in the opening index
+        self.assertEqual(OpeningMove.objects.filter(black_wins=1).count(), 4)
+
+    def test_stalemate(self):
+        game = self.play(self.new_game('k7/8/2Q5/8/8/8/8/7K w - - 0 40'), 'c6b6')
+        self.assertEnded(game, Game.DRAW, Game.Termination.STALEMATE)
+        self.assertIsNone(game.winner)
+        self.assertEqual(self.stats(self.white), (0, 0, 1))
+        self.assertEqual(self.stats(self.black), (0, 0, 1))
+        # Without the full move log there is nothing for the opening index
+        self.assertFalse(OpeningMove.objects.exists())
+
+    def test_insufficient_material(self):
+        game = self.play(self.new_game('k7/8/8/8/8/8/1r6/K7 w - - 0 50'), 'a1b2')
+        self.assertEnded(game, Game.DRAW, Game.Termination.INSUFFICIENT_MATERIAL)
+
+    def test_fifty_move_rule(self):
+        game = self.new_game('k7/8/8/8/8/8/8/KR6 w - - 98 80')
+        self.play(game, 'b1b2')
+        self.assertTrue(game.active)
+        self.play(game, 'a8a7')
+        self.assertEnded(game, Game.DRAW, Game.Termination.FIFTY_MOVES)
+
+    def test_threefold_repetition(self):
+        game = self.new_game()
+        start = gameplay.position_hash(chess.Board())
+        knights = ('g1f3', 'g8f6', 'f3g1', 'f6g8')
+
+        def occurrences():
+            return PositionCount.objects.get(game=game, position_hash=start).count
+
+        self.play(game, 'g1f3')
+        # The starting position is counted along with the first move
+        self.assertEqual(occurrences(), 1)
+        self.play(game, *knights[1:])
+        self.assertEqual(occurrences(), 2)
+        self.assertTrue(game.active)
+        self.play(game, *knights[:3])
+        self.assertEqual(occurrences(), 2)
+        self.assertTrue(game.active)
+        self.play(game, knights[3])
+        self.assertEqual(occurrences(), 3)
+        self.assertEnded(game, Game.DRAW, Game.Termination.THREEFOLD_REPETITION)
+        self.assertEqual(self.stats(self.black), (0, 0, 1))
+
+    def test_resignation(self):
+        game = self.new_game()
+        gameplay.resign(game, self.white)
+        self.assertEnded(game, Game.BLACK_WINS, Game.Termination.RESIGNATION)
+        with self.assertRaises(gameplay.MoveConflict):
+            gameplay.resign(game, self.black)
+        self.assertEqual(self.stats(self.black), (1, 0, 0))
+
+
+class CommitMoveTests(TestCase):
+    """A move is only written against the version it was made on, and only while the game is on."""
+
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = Game.objects.create(player1=self.white, player2=self.black, active=True)
+
+    def board_after(self, uci):
+        chess_board = chess.Board()
+        chess_board.push_uci(uci)
+        return chess_board
+
+    def row(self):
+        return Game.objects.values('fen', 'turn', 'move_log', 'moves', 'version', 'active').get(id=self.game.id)
+
+    def test_commit(self):
+        gameplay.commit_move(self.game, self.board_after('e2e4'))
+        self.assertEqual(self.game.version, 1)
+        row = self.row()
+        self.assertEqual((row['moves'], row['version'], row['turn']), (1, 1, 'black'))
+        self.assertEqual(row['fen'], self.game.fen)
+
+    def test_move_is_appended_in_sql(self):
+        played = chess.Board()
+        for uci in ('e2e4', 'e7e5', 'g1f3'):
+            played.push_uci(uci)
+            with CaptureQueriesContext(connection) as context:
+                gameplay.commit_move(self.game, played)
+            update = next(query['sql'] for query in context.captured_queries if query['sql'].startswith('UPDATE'))
+            # Only the new move is sent, not the log so far
+            self.assertIn('"chessboard_game"."move_log" || ', update)
+        self.assertEqual(bytes(self.row()['move_log']), movelog.encode_moves(played.move_stack))
+        self.assertEqual(self.game.move_log, movelog.encode_moves(played.move_stack))
+
+    def test_stale_version_is_rejected(self):
+        stale = Game.objects.get(id=self.game.id)
+        gameplay.commit_move(self.game, self.board_after('e2e4'))
+        before = self.row()
+        with self.assertRaises(gameplay.MoveConflict):
+            gameplay.commit_move(stale, self.board_after('d2d4'))
+        self.assertEqual(self.row(), before)
+        # The stale copy is left as it was read
+        self.assertEqual((stale.version, stale.moves), (0, 0))
+
+    def test_seen_version_is_checked_before_the_move(self):
+        with self.assertRaises(gameplay.MoveConflict):
+            gameplay.play_move(self.game, self.white, 'not a move', seen_version=3)
+        self.assertEqual(self.row()['version'], 0)
+
+    def test_inactive_game_is_rejected(self):
+        gameplay.resign(self.game, self.black)
+        before = self.row()
+        with self.assertRaises(gameplay.MoveConflict):
+            gameplay.commit_move(self.game, self.board_after('e2e4'))
+        self.assertEqual(self.row(), before)
+        self.assertFalse(PositionCount.objects.filter(game=self.game).exists())
+
+
+class MoveLogTests(TestCase):
+    """The two-byte move encoding round-trips every kind of move, and a game rebuilds from its log."""
+
+    # Sidelines with en passant (d5c6), a promotion (b7a8n) and castling on both sides
+    GAME = 'e2e4 d7d5 e4d5 c7c5 d5c6 g8f6 c6b7 e7e6 b7a8n f8e7 g1f3 e8g8 f1e2 d8d5 e1g1'.split()
+
+    def test_round_trip(self):
+        moves = [chess.Move.from_uci(uci) for uci in (
+            'e2e4', 'h7h8q', 'h7h8r', 'h7h8b', 'h7h8n', 'a2a1q', 'b2c1n',
+            'e1g1', 'e1c1', 'e8g8', 'e8c8', 'd5c6', 'a1h8', 'h8a1',
+        )]
+        log = movelog.encode_moves(moves)
+        self.assertEqual(len(log), 2 * len(moves))
+        self.assertEqual(movelog.decode_moves(log), moves)
+        self.assertEqual(movelog.decode_moves(memoryview(log)), moves)
+        for move in moves:
+            self.assertEqual(movelog.decode_move(movelog.move_code(move)), move)
+
+    def test_game_rebuilds_from_its_log(self):
+        white = User.objects.create_user('white')
+        black = User.objects.create_user('black')
+        game = Game.objects.create(player1=white, player2=black, active=True)
+        for uci in self.GAME:
+            gameplay.play_move(game, white if game.turn == 'white' else black, uci)
+
+        game = Game.objects.get(id=game.id)
+        self.assertEqual(len(game.move_log), 2 * game.moves)
+        self.assertEqual([move.uci() for move in game.move_list()], self.GAME)
+        chess_board = game.replay()
+        self.assertEqual(chess_board.fen(), game.fen)
+        # The special moves come back as what they were
+        self.assertEqual(chess_board.piece_at(chess.A8), chess.Piece(chess.KNIGHT, chess.WHITE))
+        self.assertEqual(chess_board.king(chess.WHITE), chess.G1)
+        self.assertEqual(chess_board.king(chess.BLACK), chess.G8)
+        self.assertIsNone(chess_board.piece_at(chess.C5))
+        self.assertEqual(chess_board.castling_rights, 0)
+
+
+class SubmitMoveTests(TestCase):
+    """The JSON move API: its error statuses, the changed-squares payload and resigning."""
+
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = Game.objects.create(player1=self.white, player2=self.black, active=True)
+        self.url = reverse('submit_move', args=[self.game.id])
+        self.client.force_login(self.white)
+
+    def post(self, data):
+        return self.client.post(self.url, json.dumps(data), content_type='application/json')
+
+    def test_move(self):
+        response = self.post({'uci': 'E2E4', 'version': 0})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['v'], 1)
+        self.assertEqual(data['turn'], 'black')
+        self.assertTrue(data['a'])
+        # Only the squares that changed, emptied ones as ''
+        self.assertEqual(data['changed'], {'e2': '', 'e4': 'P'})
+        self.assertTrue(data['lm'])
+
+    def test_bad_requests(self):
+        for body in ('{"uci": ', '["e2e4"]', '"e2e4"', '3'):
+            response = self.client.post(self.url, body, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(self.post({'uci': 'e2e5'}).status_code, 400)
+        self.assertEqual(self.post({'uci': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.post({'uci': 'e2e4', 'version': 'x'}).status_code, 400)
+        self.assertEqual(Game.objects.get(id=self.game.id).version, 0)
+
+    def test_forbidden(self):
+        # Not this player's turn
+        self.client.force_login(self.black)
+        self.assertEqual(self.post({'uci': 'e7e5'}).status_code, 403)
+        # Not a player in this game at all
+        self.client.force_login(User.objects.create_user('watcher'))
+        self.assertEqual(self.post({'uci': 'e2e4'}).status_code, 403)
+
+    def test_stale_version(self):
+        self.post({'uci': 'e2e4', 'version': 0})
+        self.client.force_login(self.black)
+        self.post({'uci': 'e7e5', 'version': 1})
+        self.client.force_login(self.white)
+        response = self.post({'uci': 'd2d4', 'version': 1})
+        self.assertEqual(response.status_code, 409)
+        # The client is told where the game is now, to catch up from
+        self.assertEqual(response.json()['v'], 2)
+
+    def test_resign(self):
+        response = self.post({'resign': True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'success': True, 'v': 1, 'a': False, 'o': 'black wins by resignation'})
+        self.assertEqual(Game.objects.get(id=self.game.id).result, Game.BLACK_WINS)
+        # Resigning or moving in a finished game is a conflict
+        self.assertEqual(self.post({'resign': True}).status_code, 409)
+        self.assertEqual(self.post({'uci': 'e2e4'}).status_code, 409)
+
+
+class UserSessionTests(TestCase):
+    """Each login is indexed by user, so logging in elsewhere ends the other sessions without a table scan."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('player', password='secret')
+
+    def log_in(self, client):
+        response = client.post(reverse('login'), {'username': 'player', 'password': 'secret'})
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        return client.session.session_key
+
+    def test_login_is_indexed(self):
+        session_key = self.log_in(self.client)
+        self.assertEqual(list(UserSession.objects.values_list('session_key', 'user')), [(session_key, self.user.id)])
+
+    def test_login_ends_other_sessions(self):
+        other = User.objects.create_user('other')
+        other_client = self.client_class()
+        other_client.force_login(other)
+
+        first = self.log_in(self.client_class())
+        second = self.log_in(self.client)
+        self.assertFalse(Session.objects.filter(session_key=first).exists())
+        self.assertEqual(list(UserSession.objects.filter(user=self.user).values_list('session_key', flat=True)), [second])
+        # Nobody else is logged out
+        self.assertTrue(Session.objects.filter(session_key=other_client.session.session_key).exists())
+        self.assertTrue(UserSession.objects.filter(user=other).exists())
+
+    def test_end_sessions(self):
+        self.log_in(self.client)
+        # A second session, as another server process might have created
+        store = SessionStore()
+        store.create()
+        UserSession.objects.create(session_key=store.session_key, user=self.user)
+        with CaptureQueriesContext(connection) as context:
+            sessions.end_sessions(self.user)
+        # Two deletes, both found through the user index rather than by reading every session
+        statements = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 2)
+        for sql in statements:
+            self.assertTrue(sql.startswith('DELETE'), sql)
+            self.assertIn('"user_id" = ', sql)
+        self.assertFalse(UserSession.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+    def test_logout_and_sweep_forget_the_session(self):
+        session_key = self.log_in(self.client)
+        self.client.get(reverse('logout'))
+        self.assertFalse(UserSession.objects.filter(session_key=session_key).exists())
+
+        session_key = self.log_in(self.client)
+        Session.objects.filter(session_key=session_key).delete()
+        sessions.forget([session_key])
+        self.assertFalse(UserSession.objects.exists())
+
+    def test_sweep_sessions(self):
+        now = timezone.now()
+        for index in range(7):
+            # Keys interleave expired and live sessions across the batches
+            expire_date = now + timedelta(days=1 if index % 4 == 0 else -1)
+            session_key = f'session{index}'
+            Session.objects.create(session_key=session_key, session_data='', expire_date=expire_date)
+            UserSession.objects.create(session_key=session_key, user=self.user)
+        out = io.StringIO()
+        with mock.patch('time.sleep'):
+            call_command('sweep_sessions', batch_size=2, stdout=out)
+        self.assertIn('Deleted 5 expired sessions in 3 batches', out.getvalue())
+        live = ['session0', 'session4']
+        self.assertEqual(list(Session.objects.order_by('session_key').values_list('session_key', flat=True)), live)
+        self.assertEqual(list(UserSession.objects.order_by('session_key').values_list('session_key', flat=True)), live)
+
+
+class PresenceTests(TestCase):
+    """Who is online: heartbeats on login/logout, and the shared snapshot lobby pollers are served."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('player', password='secret')
+
+    def expire_snapshot(self):
+        cache.delete(presence.SNAPSHOT_KEY)
+
+    def test_login_and_logout(self):
+        self.client.post(reverse('login'), {'username': 'player', 'password': 'secret'})
+        self.assertTrue(presence.is_online(self.user.id))
+        self.client.get(reverse('logout'))
+        self.assertFalse(presence.is_online(self.user.id))
+        self.assertFalse(UserPresence.objects.exists())
+
+    def test_heartbeat_writes_once_per_interval(self):
+        presence.touch(self.user.id)
+        with self.assertNumQueries(0):
+            presence.touch(self.user.id)
+        presence.clear(self.user.id)
+        # Clearing forgets the heartbeat too, so the next request counts again
+        presence.touch(self.user.id)
+        self.assertTrue(presence.is_online(self.user.id))
+
+    def test_snapshot_version_follows_the_list(self):
+        presence.touch(self.user.id)
+        first = presence.online_snapshot()
+        self.assertEqual(json.loads(first.body)['online_users'], [{'id': self.user.id, 'username': 'player'}])
+
+        self.expire_snapshot()
+        self.assertEqual(presence.online_snapshot().version, first.version)
+
+        presence.touch(User.objects.create_user('other').id)
+        self.expire_snapshot()
+        second = presence.online_snapshot()
+        self.assertNotEqual(second.version, first.version)
+        self.assertEqual(json.loads(second.body)['v'], second.version)
+
+    def test_stale_snapshot_is_rebuilt_by_one_caller(self):
+        presence.touch(self.user.id)
+        snapshot = presence.online_snapshot()
+        stale = snapshot._replace(built_at=snapshot.built_at - presence.SNAPSHOT_INTERVAL)
+        cache.set(presence.SNAPSHOT_KEY, stale)
+
+        # Somebody else holds the rebuild lock: serve the stale copy without a query
+        cache.add(presence.SNAPSHOT_LOCK_KEY, True)
+        with self.assertNumQueries(0):
+            self.assertEqual(presence.online_snapshot(), stale)
+
+        # With the lock free the caller rebuilds it, and releases the lock
+        cache.delete(presence.SNAPSHOT_LOCK_KEY)
+        with self.assertNumQueries(1):
+            rebuilt = presence.online_snapshot()
+        self.assertGreater(rebuilt.built_at, stale.built_at)
+        self.assertIsNone(cache.get(presence.SNAPSHOT_LOCK_KEY))
+        with self.assertNumQueries(0):
+            self.assertEqual(presence.online_snapshot(), rebuilt)
+
+    def test_cold_start_does_not_wait_for_the_lock(self):
+        presence.touch(self.user.id)
+        cache.delete(presence.SNAPSHOT_KEY)
+        cache.add(presence.SNAPSHOT_LOCK_KEY, True)
+        started = time.monotonic()
+        with mock.patch('time.sleep', side_effect=AssertionError('waited for the lock')), self.assertNumQueries(1):
+            snapshot = presence.online_snapshot()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(json.loads(snapshot.body)['online_users'], [{'id': self.user.id, 'username': 'player'}])
+        cache.delete(presence.SNAPSHOT_LOCK_KEY)
+
+    def test_unchanged_list_is_not_modified(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('online_users_ajax'))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        self.expire_snapshot()
+        response = self.client.get(reverse('online_users_ajax'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        presence.touch(User.objects.create_user('other').id)
+        self.expire_snapshot()
+        response = self.client.get(reverse('online_users_ajax'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()['online_users']), 2)
+
+
+class GameStateTests(TestCase):
+    """The polled game state: ETags and 304s, and long-polls woken by the hub rather than by re-reading."""
+
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = Game.objects.create(player1=self.white, player2=self.black, active=True)
+        self.url = reverse('get_game_state', args=[self.game.id])
+        self.client.force_login(self.white)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        gameplay.play_move(self.game, self.white, 'e2e4')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        # Each wire format has its own ETag
+        compact = self.client.get(self.url, {'format': 'compact'})
+        self.assertNotEqual(compact['ETag'], response['ETag'])
+
+    def move_after_version_read(self):
+        # Another request commits (and publishes) a move right after the long-poll reads the version
+        done = []
+
+        def wrapper(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            if not done and sql.startswith('SELECT "chessboard_game"."version"'):
+                done.append(True)
+                gameplay.play_move(self.game, self.white, 'e2e4')
+                realtime.publish_game_state(self.game)
+            return result
+        return connection.execute_wrapper(wrapper)
+
+    def test_long_poll_is_woken_by_the_hub(self):
+        started = time.monotonic()
+        with self.move_after_version_read():
+            response = self.client.get(self.url, {'since': 0, 'timeout': 20, 'format': 'compact'})
+        self.assertEqual(response.json()['v'], 1)
+        # Woken by the publish, not by the safety recheck
+        self.assertLess(time.monotonic() - started, views.LONG_POLL_RECHECK / 2)
+
+    def test_long_poll_times_out(self):
+        started = time.monotonic()
+        response = self.client.get(self.url, {'since': 0, 'timeout': 0, 'format': 'compact'})
+        self.assertEqual(response.json()['v'], 0)
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class HubTests(SimpleTestCase):
+    def test_listen_catches_publishes_before_the_wait(self):
+        with realtime.hub.listen('test') as published:
+            realtime.hub.publish('test', None)
+            self.assertTrue(published.wait(0))
+        self.assertNotIn('test', realtime.hub._waiters)
+        self.assertFalse(realtime.hub.wait('test', 0))
+
+
+class GameHistoryCacheTests(TestCase):
+    """Cached history pages go stale through a generation kept in the database, not in the cache."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('player')
+        self.client.force_login(self.user)
+
+    def finish_game_against(self, username):
+        game = Game.objects.create(player1=self.user, player2=User.objects.create_user(username), active=True)
+        gameplay.resign(game, self.user)
+
+    def test_finished_game_shows_up(self):
+        self.finish_game_against('first')
+        self.assertContains(self.client.get(reverse('home')), 'first')
+        before = game_list.generation(self.user.id)
+        self.finish_game_against('second')
+        self.assertEqual(game_list.generation(self.user.id), before + 1)
+        # The page cached before is not served, even by a process whose cache was never told
+        self.assertContains(self.client.get(reverse('home')), 'second')
+
+    def test_cached_page_is_reused(self):
+        self.client.get(reverse('home'))
+        with mock.patch.object(game_list, 'load_page', side_effect=AssertionError('page rebuilt')):
+            self.assertEqual(self.client.get(reverse('home')).status_code, 200)
+
+    def test_rolled_back_changes_do_not_bump(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            game_list.invalidate(self.user.id)
+            raise RuntimeError
+        self.assertEqual(game_list.generation(self.user.id), 0)
+
+
+class WebsocketTests(TestCase):
+    """The live game socket: who may connect, the initial state, and relaying published states."""
+
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = Game.objects.create(player1=self.white, player2=self.black, active=True)
+
+    def session_cookie(self, user):
+        self.client.force_login(user)
+        return f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+    async def connect(self, cookie=None, origin='http://localhost', path=None, query=b''):
+        """Start the socket application; returns (messages sent, queue feeding receive(), the task)."""
+        headers = []
+        if cookie is not None:
+            headers.append((b'cookie', cookie.encode()))
+        if origin is not None:
+            headers.append((b'origin', origin.encode()))
+        scope = {
+            'type': 'websocket',
+            'path': path or f'/ws/game/{self.game.id}/',
+            'query_string': query,
+            'headers': headers,
+        }
+        incoming = asyncio.Queue()
+        await incoming.put({'type': 'websocket.connect'})
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        task = asyncio.ensure_future(realtime.websocket_application(scope, incoming.get, send))
+        return sent, incoming, task
+
+    async def wait_for(self, sent, count):
+        for _ in range(500):
+            if len(sent) >= count:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f'Only {len(sent)} of {count} messages sent: {sent}')
+
+    async def test_refused(self):
+        white = await sync_to_async(self.session_cookie)(self.white)
+        outsider = await sync_to_async(self.session_cookie)(await User.objects.acreate(username='outsider'))
+        cases = [
+            ({'cookie': white, 'origin': 'https://evil.example'}, 4404),
+            ({'cookie': white, 'path': '/ws/other/'}, 4404),
+            ({}, 4403),
+            ({'cookie': f'{settings.SESSION_COOKIE_NAME}=nonsense'}, 4403),
+            ({'cookie': outsider}, 4403),
+        ]
+        with self.settings(ALLOWED_HOSTS=['localhost']):
+            for options, code in cases:
+                sent, _, task = await self.connect(**options)
+                await task
+                self.assertEqual(sent, [{'type': 'websocket.close', 'code': code}], options)
+
+    async def test_initial_state_and_relay(self):
+        cookie = await sync_to_async(self.session_cookie)(self.black)
+        sent, incoming, task = await self.connect(cookie, query=b'format=compact')
+        await self.wait_for(sent, 2)
+        self.assertEqual(sent[0], {'type': 'websocket.accept'})
+        self.assertEqual(json.loads(sent[1]['text'])['v'], 0)
+
+        await sync_to_async(gameplay.play_move)(self.game, self.white, 'e2e4')
+        # Tests never commit, so publish the state as the commit hook would
+        await sync_to_async(realtime.publish_game_state)(self.game)
+        await self.wait_for(sent, 3)
+        state = json.loads(sent[2]['text'])
+        self.assertEqual((state['v'], state['n']), (1, 1))
+
+        # Anything the client says is ignored; a disconnect ends the handler and its subscription
+        await incoming.put({'type': 'websocket.receive', 'text': 'hello'})
+        await incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(len(sent), 3)
+        self.assertNotIn(realtime.game_channel(self.game.id), realtime.hub._subscribers)
+
+
+class PgnTests(TestCase):
+    """PGN export streams chunk by chunk (WSGI and ASGI), and imports what it exports."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.white = User.objects.create_user('white')
+        cls.black = User.objects.create_user('black')
+        for _ in range(5):
+            game = Game.objects.create(player1=cls.white, player2=cls.black)
+            for uci in ('e2e4', 'e7e5', 'd1h5'):
+                gameplay.play_move(game, cls.white if game.turn == 'white' else cls.black, uci)
+            gameplay.resign(game, cls.black)
+        UserGameJournal.objects.create(user=cls.white, game=game, description='Early queen')
+
+    def setUp(self):
+        cache.clear()
+        for name, value in (('CHUNK_SIZE', 3), ('ASYNC_BATCH_SIZE', 2)):
+            patcher = mock.patch.object(pgn, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_export_streams(self):
+        self.client.force_login(self.white)
+        response = self.client.get(reverse('export_pgn'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="white.pgn"')
+        self.assertTrue(response['ETag'])
+        text = b''.join(response.streaming_content).decode()
+        self.assertEqual(text.count('[Event '), 5)
+        self.assertIn('{ Early queen }', text)
+        self.assertIn('1. e4 e5 2. Qh5 1-0', text)
+
+        # Unchanged until the user's games change
+        response = self.client.get(reverse('export_pgn'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    async def test_export_streams_asynchronously_under_asgi(self):
+        await sync_to_async(self.async_client.force_login)(self.white)
+        response = await self.async_client.get(reverse('export_pgn'))
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="white.pgn"')
+        chunks = [chunk async for chunk in response.streaming_content]
+        # Five games, two per hop to the sync thread, whatever the row chunks
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(b''.join(chunks).decode().count('[Event '), 5)
+
+    def test_first_game_is_sent_before_the_chunk_is_converted(self):
+        with mock.patch.object(pgn, 'game_to_pgn', wraps=pgn.game_to_pgn) as game_to_pgn:
+            texts = pgn.export_pgn(pgn.games_for(self.white), chunk_size=500)
+            self.assertIn('[Event ', next(texts))
+            self.assertEqual(game_to_pgn.call_count, 1)
+            self.assertEqual(len(list(texts)), 4)
+
+    def test_import_round_trip(self):
+        exported = ''.join(pgn.export_pgn(pgn.games_for(self.white))).encode()
+        raw_games = list(pgn.split_games(iter(exported.splitlines(keepends=True))))
+        self.assertEqual(len(raw_games), 5)
+        self.assertEqual(raw_games[-1][1], len(exported))
+
+        records = [record for record in pgn.parse_games([raw for raw, _ in raw_games]) if record is not None]
+        self.assertEqual(len(records), 5)
+        # The parser computes the opening index keys, so the import needn't replay the games
+        self.assertEqual(records[0][-1], openings.game_positions(Game.objects.first().move_list()))
+        Game.objects.all().delete()
+        UserStats.objects.all().delete()
+        OpeningMove.objects.all().delete()
+        self.assertEqual(pgn.save_games(records, {}), 5)
+        self.assertEqual(
+            list(OpeningMove.objects.order_by('position_hash', 'move').values_list('move', 'white_wins')),
+            [(code, 5) for _, code in sorted(records[0][-1])],
+        )
+
+        game = Game.objects.select_related('player1', 'winner').first()
+        self.assertEqual(game.player1, self.white)
+        self.assertEqual(game.winner, self.white)
+        self.assertEqual([move.uci() for move in game.move_list()], ['e2e4', 'e7e5', 'd1h5'])
+        self.assertEqual(game.termination, Game.Termination.RESIGNATION)
+        self.assertEqual(UserStats.objects.get(user=self.white).wins, 5)
+        self.assertEqual(UserStats.objects.get(user=self.black).losses, 5)
+
+    def test_import_usernames(self):
+        self.assertEqual(pgn.import_username(' alice '), 'alice')
+        self.assertEqual(pgn.import_username('Carlsen, Magnus'), pgn.import_username('Carlsen, Magnus'))
+        self.assertTrue(pgn.import_username('Carlsen, Magnus').startswith('pgn_Carlsen_Magnus_'))
+        self.assertNotEqual(pgn.import_username('Carlsen, Magnus'), pgn.import_username('Carlsen Magnus'))
+        # Long names are not cut down to the same username
+        first, second = pgn.import_username('x' * 150 + 'a'), pgn.import_username('x' * 150 + 'b')
+        self.assertNotEqual(first, second)
+        for username in (first, second, pgn.import_username('?'), pgn.import_username('pgn_alice')):
+            self.assertTrue(username.startswith(pgn.IMPORTED_PREFIX))
+            self.assertLessEqual(len(username), 150)
+            User(username=username).full_clean(exclude=['password'])
+
+    def test_import_never_uses_accounts_that_log_in(self):
+        person = User.objects.create_user('magnus', password='secret')
+        with mock.patch.object(computer, '_computer_id', None):
+            computer_user = computer.computer_user()
+        names = ['magnus', computer.COMPUTER_USERNAME, 'Carlsen, Magnus', 'white']
+        ids = pgn.player_ids(names, {})
+        self.assertNotIn(person.id, ids.values())
+        self.assertNotIn(computer_user.id, ids.values())
+        self.assertEqual(len(set(ids.values())), 4)
+        # An earlier import's account (no usable password) is reused
+        self.assertEqual(ids['white'], self.white.id)
+        self.assertFalse(User.objects.filter(id__in=ids.values()).exclude(id=self.white.id).filter(
+            username__in=names,
+        ).exists())
+        # The same names find the same accounts next time
+        self.assertEqual(pgn.player_ids(names, {}), ids)
+
+    def test_joining_cannot_take_an_import_name(self):
+        form = JoinForm({'username': 'pgn_someone', 'password': 'x', 'confirm_password': 'x'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('username', form.errors)
+
+    def test_import_skips_unfinished_and_illegal_games(self):
+        with self.assertLogs('chess.pgn', 'ERROR'):
+            records = pgn.parse_games([
+                b'[White "a"]\n[Black "b"]\n[Result "*"]\n\n1. e4 *\n',
+                b'[White "a"]\n[Black "b"]\n[Result "1-0"]\n\n1. e5 1-0\n',
+            ])
+        self.assertEqual(records, [None, None])
+
+
+class EngineTests(SimpleTestCase):
+    """Sanity checks for the built-in engine, on positions with one clearly right move."""
+
+    def test_perpetual_check_is_a_draw(self):
+        # A queen and rook down, white checks forever: Qf6+ Kg8 Qg5+ Kh8 Qf6+ ...
+        board = chess.Board('5r1k/5p1p/8/8/5Q2/q7/r5PP/7K w - - 0 1')
+        result = engine.Searcher().search(board, time_budget=None, max_depth=4)
+        self.assertEqual(result.move, 'f4f6')
+        self.assertEqual(result.score, 0)
+
+    def test_table_is_keyed_by_zobrist_hash(self):
+        board = chess.Board()
+        searcher = engine.Searcher()
+        result = searcher.search(board, time_budget=None, max_depth=2)
+        entry = searcher.table.get(chess.polyglot.zobrist_hash(board))
+        self.assertEqual(entry[4].uci(), result.move)
+
+    def test_finds_mate_in_one(self):
+        result = engine.Searcher().search(chess.Board('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1'), max_depth=3)
+        self.assertEqual(result.move, 'd1d8')
+        self.assertGreater(result.score, engine.MATE_BOUND)
+
+    def test_takes_hanging_queen(self):
+        result = engine.Searcher().search(chess.Board('4k3/8/8/3q4/8/8/8/3RK3 w - - 0 1'), max_depth=3)
+        self.assertEqual(result.move, 'd1d5')
+
+    def test_no_legal_moves(self):
+        # Fool's mate: white is checkmated
+        board = chess.Board('rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3')
+        result = engine.Searcher().search(board)
+        self.assertIsNone(result.move)
+        self.assertEqual(result.score, -engine.MATE)
+
+
+class ProfilingTests(SimpleTestCase):
+    """Which requests get profiled, and that profiling never breaks a request."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(profiling, 'PROFILE_DIR', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.request = RequestFactory().get('/')
+        self.request.resolver_match = None
+
+    def view(self, request):
+        return HttpResponse('ok')
+
+    def test_sampling_decision(self):
+        with mock.patch.object(profiling, 'SAMPLE_RATE', 0):
+            self.assertFalse(profiling.wanted(self.request))
+            signed = RequestFactory().get('/', HTTP_X_PROFILE=profiling.profile_token())
+            self.assertTrue(profiling.wanted(signed))
+            forged = RequestFactory().get('/', HTTP_X_PROFILE='profile:forged')
+            self.assertFalse(profiling.wanted(forged))
+        with mock.patch.object(profiling, 'SAMPLE_RATE', 1):
+            self.assertTrue(profiling.wanted(self.request))
+
+    def test_saves_a_profile(self):
+        for mode in ('sample', 'cprofile'):
+            with self.subTest(mode=mode), mock.patch.object(profiling, 'MODE', mode):
+                response = profiling.profile_request(self.view, self.request)
+                self.assertEqual(response.content, b'ok')
+        self.assertEqual(len(os.listdir(profiling.PROFILE_DIR)), 2)
+
+    def test_overlapping_request_runs_unprofiled(self):
+        # As if another thread were in the middle of a profiled request
+        with profiling._profiling:
+            response = profiling.profile_request(self.view, self.request)
+        self.assertEqual(response.content, b'ok')
+        self.assertEqual(os.listdir(profiling.PROFILE_DIR), [])
+
+    def test_profiler_error_does_not_fail_request(self):
+        with mock.patch.object(profiling, 'MODE', 'cprofile'), \
+                mock.patch('cProfile.Profile.enable', side_effect=ValueError('Another profiling tool is already active')), \
+                self.assertLogs('chessboard.profiling', 'WARNING'):
+            response = profiling.profile_request(self.view, self.request)
+        self.assertEqual(response.content, b'ok')
+        self.assertEqual(os.listdir(profiling.PROFILE_DIR), [])
+        # The lock is released again for the next sampled request
+        self.assertTrue(profiling._profiling.acquire(blocking=False))
+        profiling._profiling.release()
+
+
+class MetricsTests(TestCase):
+    """The text exposition format, what the middleware records, and who may scrape /metrics."""
+
+    def test_counter_text(self):
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter('moves_total', 'Moves played.', ('colour',)))
+        counter.inc(('white',))
+        counter.inc(('white',), amount=2)
+        counter.inc(('bl"ack',))
+        self.assertEqual(registry.render(), (
+            '# HELP moves_total Moves played.\n'
+            '# TYPE moves_total counter\n'
+            'moves_total{colour="bl\\"ack"} 1\n'
+            'moves_total{colour="white"} 3\n'
+        ))
+
+    def test_histogram_text(self):
+        registry = metrics.Registry()
+        histogram = registry.register(metrics.Histogram('think_seconds', 'Thinking time.', buckets=(1, 5)))
+        for value in (0.5, 1, 3, 60):
+            histogram.observe((), value)
+        self.assertEqual(registry.render(), (
+            '# HELP think_seconds Thinking time.\n'
+            '# TYPE think_seconds histogram\n'
+            'think_seconds_bucket{le="1"} 2\n'
+            'think_seconds_bucket{le="5"} 3\n'
+            'think_seconds_bucket{le="+Inf"} 4\n'
+            'think_seconds_sum 64.5\n'
+            'think_seconds_count 4\n'
+        ))
+
+    def test_middleware_counts_queries(self):
+        def view(request):
+            User.objects.count()
+            User.objects.exists()
+            return HttpResponse('ok')
+
+        queries = metrics.Histogram('queries', '', ('view',), buckets=metrics.QUERY_COUNT_BUCKETS)
+        requests = metrics.Counter('requests', '', ('view', 'method', 'status'))
+        request = RequestFactory().get('/')
+        request.resolver_match = mock.Mock(url_name='home')
+        with mock.patch.object(metrics, 'DB_QUERIES', queries), mock.patch.object(metrics, 'REQUESTS', requests):
+            MetricsMiddleware(view)(request)
+            # Queries run outside a request are not counted
+            User.objects.count()
+        samples = {name + labels: value for name, labels, value in queries.samples()}
+        self.assertEqual(samples['queries_sum{view="home"}'], 2)
+        self.assertEqual(samples['queries_count{view="home"}'], 1)
+        self.assertEqual(list(requests.samples()), [('requests', '{view="home",method="GET",status="200"}', 1)])
+
+    def test_scrape_gating(self):
+        url = reverse('metrics')
+        with self.settings(METRICS_ALLOWED_IPS=['10.0.0.1']):
+            response = self.client.get(url, REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'# TYPE chess_http_requests_total counter', response.content)
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.2').status_code, 404)
+            user = User.objects.create_user('player', password='pw')
+            self.client.force_login(user)
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.2').status_code, 404)
+            user.is_staff = True
+            user.save()
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+
+class LRUCacheTests(SimpleTestCase):
+    """The in-memory caches behind board rendering, legal moves and the opening explorer."""
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # 'b' is now the oldest
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        cache.set('a', 4)  # Overwriting refreshes too
+        cache.set('d', 5)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 2, 'size': 2, 'maxsize': 2})
+
+    def test_get_or_create(self):
+        cache = LRUCache(4)
+        factory = mock.Mock(return_value='value')
+        self.assertEqual(cache.get_or_create('key', factory), 'value')
+        self.assertEqual(cache.get_or_create('key', factory), 'value')
+        factory.assert_called_once_with()
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 4})
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 4})
+
+    def test_legal_moves_reuses_board(self):
+        cache = LRUCache(4)
+        board = chess.Board()
+        board.push_uci('e2e4')
+        with mock.patch.object(rendering, 'legal_move_cache', cache), \
+                mock.patch('chess.Board', side_effect=AssertionError('board parsed again')):
+            moves = rendering.legal_moves(board.fen(), board)
+            # Same position, different clocks: answered from the cache
+            self.assertEqual(rendering.legal_moves(board.fen().replace(' 0 1', ' 3 9')), moves)
+        self.assertIn('e7e5', moves.split())
+        self.assertEqual(len(moves.split()), 20)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_stats_exported(self):
+        cache = LRUCache(4)
+        cache.get('missing')
+        with mock.patch.dict(metrics._caches, {'test': cache}):
+            text = metrics.registry.render()
+        for name in ('render', 'legal_moves', 'openings'):
+            self.assertIn(f'chess_cache_hits_total{{cache="{name}"}} ', text)
+        self.assertIn('chess_cache_misses_total{cache="test"} 1\n', text)
+        self.assertIn('chess_cache_entries{cache="test"} 0\n', text)
@@ -1,33 +1,31 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
-from .models import Board, Game, UserGameJournal
+from .models import Board, Game, UserGameJournal, UserStats
 from .forms import ChessMoveForm, JoinForm, LoginForm, ChallengeForm, GameDescriptionForm
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.core.handlers.asgi import ASGIRequest
+from django.core.exceptions import ImproperlyConfigured
 import chess
-from django.contrib.auth.models import User
 from django.db.models import Q
-from django.contrib.sessions.models import Session
-from django.utils import timezone
 from collections import Counter
 from django.shortcuts import get_object_or_404
-from django.core.paginator import Paginator
+from django.utils.functional import SimpleLazyObject
 from django.http import JsonResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+import json
+import logging
+import os
+import time
+from . import challenges, computer, game_list, gameplay, metrics, openings, pgn, presence, profiling, realtime, sessions
+from .rendering import legal_moves, normalize_fen, render_position
+
+logger = logging.getLogger(__name__)
 
 @login_required(login_url='/login/')
 def home(request):
-    # Clean up expired sessions to ensure accuracy
-    Session.objects.filter(expire_date__lt=timezone.now()).delete()
-
-    # Get the logged-in user IDs from the session data
-    active_sessions = Session.objects.filter(expire_date__gte=timezone.now())
-    logged_in_user_ids = [int(session.get_decoded().get('_auth_user_id')) for session in active_sessions if session.get_decoded().get('_auth_user_id')]
-
-    unique_user_ids = list(dict.fromkeys(logged_in_user_ids))
-
-    # Filter users who are currently logged in and exclude the current user
-    users_online = User.objects.filter(id__in=unique_user_ids).exclude(id=request.user.id)
-
     # Check if the user has an active game in progress
     current_game = Game.objects.filter(Q(player1=request.user) | Q(player2=request.user), active=True).first()
 
@@ -37,37 +35,25 @@ def home(request):
     # Initialize the challenge form
     challenge_form = ChallengeForm()
 
-    # Get the games and prefetch the user's journal entries for each game, excluding deleted ones
-    game_list = Game.objects.filter(
-        Q(player1=request.user) | Q(player2=request.user)
-    ).exclude(deleted_by=request.user).order_by('-id').prefetch_related('usergamejournal_set')
-
-    # Determine the outcome from the perspective of the logged-in user
-    for game in game_list:
-        if game.outcome:
-            if request.user == game.player1:
-                if "wins" in game.outcome:
-                    game.user_outcome = "Win" if game.player1.username in game.outcome else "Loss"
-                elif "draw" in game.outcome:
-                    game.user_outcome = "Tie"
-            elif request.user == game.player2:
-                if "wins" in game.outcome:
-                    game.user_outcome = "Win" if game.player2.username in game.outcome else "Loss"
-                elif "draw" in game.outcome:
-                    game.user_outcome = "Tie"
-        else:
-            game.user_outcome = "Ongoing"
+    # One keyset page of the user's games (?before=<id> / ?after=<id>). The
+    # rendered table is cached per user and only loaded from the database on
+    # a cache miss, hence the lazy object
+    before = request.GET.get('before', '')
+    after = request.GET.get('after', '')
+    before = int(before) if before.isdigit() else None
+    after = int(after) if after.isdigit() and before is None else None
+    page = SimpleLazyObject(lambda: game_list.load_page(request.user, before, after))
 
-    paginator = Paginator(game_list, 10)  # Show 10 games per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Win/loss/draw totals, maintained as games finish
+    user_stats = UserStats.objects.filter(user=request.user).first() or UserStats(user=request.user)
 
-    # Pass user-specific journal entries to the template
     return render(request, 'chessboard/home.html', {
-        'users_online': users_online,
         'challenge_form': challenge_form,
-        'page_obj': page_obj,
-        'user_journal_entries': UserGameJournal.objects.filter(user=request.user, deleted_for_user=False),  # Pass user-specific journal entries
+        'page': page,
+        'history_generation': user_stats.history_generation,
+        'history_cursor': f'b{before}' if before is not None else f'a{after}',
+        'history_cache_timeout': game_list.CACHE_TIMEOUT,
+        'user_stats': user_stats,
     })
 
 
@@ -78,85 +64,59 @@ def game_in_progress(request):
     if not current_game:
         return redirect('home')
 
-    chess_board = chess.Board(current_game.fen) if current_game.fen != 'startpos' else chess.Board()
-    current_turn = 'white' if chess_board.turn else 'black'
+    rendered = render_position(current_game.fen)
+    current_turn = rendered.turn
+    chess_board = None
+    against_computer = computer.is_computer(current_game.player2_id)
+    if against_computer:
+        # Picks the computer's reply back up if it was lost, e.g. to a server restart
+        computer.schedule_move(current_game)
 
-    form = ChessMoveForm(request.POST or None)
+    form = ChessMoveForm(request.POST or None, initial={'version': current_game.version})
+    status = 200
 
     if request.method == 'POST':
         if 'resign' in request.POST:  # Player clicked "Resign"
-            if request.user == current_game.player1:
-                current_game.outcome = f'{current_game.player2.username} wins by resignation'
-            else:
-                current_game.outcome = f'{current_game.player1.username} wins by resignation'
-            current_game.active = False  # Game is no longer active
-            current_game.save()
+            try:
+                gameplay.resign(current_game, request.user)
+            except gameplay.MoveConflict:
+                pass  # The game already ended, e.g. the opponent resigned first
             return redirect('home')  # Redirect to game history after resignation
 
         if 'move' in request.POST and form.is_valid():  # Only validate move submission
-            uci_move = form.cleaned_data['uci_move']
+            try:
+                chess_board = gameplay.play_move(
+                    current_game, request.user, form.cleaned_data['uci_move'], form.cleaned_data.get('version')
+                )
+                if not current_game.active:
+                    # The move ended the game (checkmate, draw, ...)
+                    return redirect('home')
+                # Render the new position from the board we already have
+                rendered = render_position(current_game.fen, chess_board)
+                current_turn = rendered.turn
+                form = ChessMoveForm(initial={'version': current_game.version})
+            except gameplay.NotYourTurn:
+                pass  # Moves out of turn are ignored
+            except gameplay.IllegalMove as e:
+                form.add_error(None, str(e))
+            except gameplay.MoveConflict:
+                # The board the move was made on is out of date (double-click, second tab)
+                form.add_error(None, 'The game changed before your move was saved. Please try again.')
+                status = 409
 
-            if (current_turn == 'white' and request.user == current_game.player1) or (current_turn == 'black' and request.user == current_game.player2):
-                try:
-                    chess_move = chess.Move.from_uci(uci_move)
-                    if chess_move in chess_board.legal_moves:
-                        chess_board.push(chess_move)
-                        current_game.moves += 1
-                        current_game.fen = chess_board.fen()
-                        current_game.turn = 'black' if current_turn == 'white' else 'white'  # Switch the turn
-                        current_game.save()
-                    else:
-                        form.add_error(None, 'Invalid move!')
-                except ValueError:
-                    form.add_error(None, 'Invalid move format!')
-
-    page_data = load_board_from_fen(current_game.fen)
     return render(request, 'chessboard/game_in_progress.html', {
-        'page_data': page_data,
+        'page_data': rendered.page_data,
         'chessboard_form': form,
         'current_game': current_game,
         'current_turn': current_turn,
-    })
+        'my_color': 'white' if request.user == current_game.player1 else 'black',
+        'legal_moves': legal_moves(current_game.fen, chess_board),
+        'against_computer': against_computer,
+    }, status=status)
 
 def load_board_from_fen(fen):
-    # Check if the FEN is 'startpos' and load the default FEN
-    if fen == 'startpos':
-        chess_board = chess.Board()  # Start the chess board in the default position
-    else:
-        try:
-            chess_board = chess.Board(fen)  # Load the FEN from the game model
-        except ValueError as e:
-            raise ValueError(f"Error loading FEN: {e}")
-
-    page_data = {"rows": []}
-
-    # Mapping of chess pieces to their Unicode symbols
-    piece_symbols = {
-        'K': '&#9812;', 'Q': '&#9813;', 'R': '&#9814;', 'B': '&#9815;', 'N': '&#9816;', 'P': '&#9817;',  # White pieces
-        'k': '&#9818;', 'q': '&#9819;', 'r': '&#9820;', 'b': '&#9821;', 'n': '&#9822;', 'p': '&#9823;'   # Black pieces
-    }
-
-    for row_number in range(8, 0, -1):  # Chess rows 8 to 1
-        row_data = {}
-        row_data['row_number'] = row_number
-
-        for col in 'abcdefgh':  # Columns a to h
-            square_name = f"{col}{row_number}"
-            square_index = chess.square(ord(col) - ord('a'), row_number - 1)  # Convert 'a1' to square index
-            piece = chess_board.piece_at(square_index)
-            if piece:
-                piece_symbol = piece_symbols.get(piece.symbol(), '&nbsp;')  # Map to Unicode or empty
-            else:
-                piece_symbol = '&nbsp;'  # Empty square
-            row_data[square_name] = piece_symbol
-
-        page_data['rows'].append(row_data)
-
-    # Handle the labels for A-H at the bottom
-    row_labels = {"row_labels": {"A": "A", "B": "B", "C": "C", "D": "D", "E": "E", "F": "F", "G": "G", "H": "H"}}
-    page_data['rows'].append(row_labels)
-
-    return page_data
+    # Rendered boards are memoized per position; the result is read-only
+    return render_position(fen).page_data
 
 
 @login_required(login_url='/login/')
@@ -180,17 +140,12 @@ def delete_game(request, game_id):
 
 # Function to reset the chessboard to the initial state
 def newGame(user):
-    # Initialize a new chess board with the starting position
-    chess_board = chess.Board()
-
-    # Save the initial FEN position to the database for the user
-    Board.objects.filter(user=user).delete()  # Clear the existing board state for the user
-    Board.objects.create(user=user, fen=chess_board.fen())  # Save the starting FEN
-    update_board_model(chess_board, user)
+    # Save the starting position to the database for the user
+    update_board_model(chess.Board(), user)
 
 # Load the board state from the Board model into a chess.Board object
 def load_chess_board_from_db(user):
-    # Retrieve the latest board state for the user
+    # Retrieve the saved board state for the user (a single fetch)
     board_record = Board.objects.filter(user=user).first()
     
     if board_record and board_record.fen:
@@ -208,18 +163,16 @@ def load_chess_board_from_db(user):
 
 # Load the board state from the Board model for rendering
 def load_board_from_db(user):
+    squares = Board.objects.filter(user=user).values_list('squares', flat=True).first() or '.' * 64
+
     page_data = {"rows": []}
     for row_number in range(8, 0, -1):  # Chess rows 8 to 1
         row_data = {}
         row_data['row_number'] = row_number
         
         for col in 'abcdefgh':  # Columns a to h
-            square_id = f"{col}{row_number}"
-            try:
-                record = Board.objects.get(user=user, location=square_id)
-                row_data[square_id] = record.value
-            except Board.DoesNotExist:
-                row_data[square_id] = "&nbsp;"  # Default to empty space if no record found
+            square_index = chess.square(ord(col) - ord('a'), row_number - 1)
+            row_data[f"{col}{row_number}"] = piece_symbol_to_html_entity(squares[square_index])
         
         # Append the row to the rows list
         page_data['rows'].append(row_data)
@@ -231,24 +184,20 @@ def load_board_from_db(user):
     return page_data
 
 
+# Pack the 64 squares of a board into a string of piece letters ('.' = empty)
+def pack_board_squares(chess_board):
+    return ''.join(piece.symbol() if piece else '.' for piece in map(chess_board.piece_at, chess.SQUARES))
+
+
 # Function to update the board in the Board model after a move
 def update_board_model(chess_board, user):
-    # Clear the existing board for the user
-    Board.objects.filter(user=user).delete()
-
-    # Save the updated FEN to the database for the user
-    Board.objects.create(user=user, fen=chess_board.fen())
-
-    # Iterate over all squares and update the model with the pieces' positions
-    for square in chess.SQUARES:
-        square_name = chess.square_name(square)
-        piece = chess_board.piece_at(square)
-        if piece:
-            # Map the piece symbol to the corresponding HTML entity
-            html_entity_piece = piece_symbol_to_html_entity(piece.symbol())
-            Board.objects.create(user=user, location=square_name, value=html_entity_piece)
-        else:
-            Board.objects.create(user=user, location=square_name, value="&nbsp;")
+    # Single upsert of the user's one board row
+    Board.objects.bulk_create(
+        [Board(user=user, fen=chess_board.fen(), squares=pack_board_squares(chess_board))],
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['fen', 'squares'],
+    )
 
 # Helper function to convert HTML entity to piece symbol for python-chess
 def html_entity_to_piece_symbol(entity):
@@ -293,9 +242,6 @@ def join(request):
     return render(request, 'chessboard/join.html', {'join_form': join_form})
 
 
-from django.contrib.sessions.models import Session
-from django.utils import timezone
-
 def user_login(request):
     if request.method == 'POST':
         login_form = LoginForm(request.POST)
@@ -307,10 +253,7 @@ def user_login(request):
             if user:
                 if user.is_active:
                     # Kill all other sessions for this user
-                    existing_sessions = Session.objects.filter(expire_date__gte=timezone.now())
-                    for session in existing_sessions:
-                        if str(user.id) == session.get_decoded().get('_auth_user_id'):
-                            session.delete()
+                    sessions.end_sessions(user)
 
                     # Log the user in
                     login(request, user)
@@ -349,6 +292,7 @@ def edit_description(request, game_id):
         form = GameDescriptionForm(request.POST, instance=user_journal)
         if form.is_valid():
             form.save()
+            game_list.invalidate(request.user.id)
             return redirect('home')  # After saving, redirect to home page with game history
     else:
         form = GameDescriptionForm(instance=user_journal)
@@ -358,9 +302,6 @@ def edit_description(request, game_id):
 
 @login_required(login_url='/login/')
 def delete_game(request, game_id):
-    # Log to check if the view is hit
-    print(f"delete_game view hit with game_id: {game_id}")
-    
     if request.method == "POST":
         # Get the game object by id
         game = get_object_or_404(Game, id=game_id)
@@ -372,15 +313,16 @@ def delete_game(request, game_id):
             # Mark the journal entry as deleted for this user
             journal_entry.deleted_for_user = True
             journal_entry.save()
-            print(f"Journal entry for game {game_id} marked as deleted for user {request.user.username}")
+            logger.info('journal_entry_deleted game_id=%s user=%s', game_id, request.user.username)
         else:
             # If no journal entry, just log it (or handle it if needed)
-            print(f"No journal entry found for game {game_id} for user {request.user.username}")
+            logger.debug('journal_entry_missing game_id=%s user=%s', game_id, request.user.username)
         
         # Also mark the game as deleted for this user
         game.deleted_by.add(request.user)
         game.save()
-        print(f"Game {game_id} marked as deleted for user {request.user.username}")
+        game_list.invalidate(request.user.id)
+        logger.info('game_deleted game_id=%s user=%s', game_id, request.user.username)
 
         # Redirect back to the home page after deleting
         return redirect('home')
@@ -394,51 +336,290 @@ def delete_journal_entry(request, game_id):
     
     # Only delete the user's journal entry, not the game itself
     UserGameJournal.objects.filter(user=request.user, game=game).delete()
+    game_list.invalidate(request.user.id)
     
     return redirect('home')
 
 @login_required(login_url='/login/')
 def online_users_ajax(request):
-    # Clean up expired sessions
-    Session.objects.filter(expire_date__lt=timezone.now()).delete()
+    # Everyone polls the same shared snapshot, including themselves; the page
+    # filters the current user out. Unchanged lists are answered with a 304
+    snapshot = presence.online_snapshot()
+    etag = f'"online-{snapshot.version}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(snapshot.body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
-    # Get the logged-in user IDs from session data
-    active_sessions = Session.objects.filter(expire_date__gte=timezone.now())
-    logged_in_user_ids = [session.get_decoded().get('_auth_user_id') for session in active_sessions]
-    unique_user_ids = list(dict.fromkeys(logged_in_user_ids))
 
-    # Filter users who are currently logged in and exclude the current user
-    users_online = User.objects.filter(id__in=unique_user_ids).exclude(id=request.user.id)
+# Upper bound on how long a long-poll request may be held open
+LONG_POLL_TIMEOUT = 25
+# A waiting long-poll is woken through the hub as soon as a move is committed
+# in this process. It also re-reads the version this often, which only bounds
+# how late it sees a move committed by another server process
+LONG_POLL_RECHECK = getattr(settings, 'LONG_POLL_RECHECK', 10)
+
+
+# Media type a client sends in Accept (or ?format=compact) to get the compact
+# FEN-only game state instead of the pre-rendered board
+COMPACT_MEDIA_TYPE = 'application/vnd.chess.compact+json'
+
+
+def game_state_format(request):
+    if request.GET.get('format') == 'compact' or COMPACT_MEDIA_TYPE in request.headers.get('Accept', ''):
+        return 'compact'
+    return 'full'
+
+
+def game_state_etag(game, wire_format='full'):
+    return f'"{game.id}-{game.version}-{wire_format}"'
 
-    # Return the list of online users as JSON
-    online_users_list = list(users_online.values('id', 'username'))
-    
-    return JsonResponse({'online_users': online_users_list})
+
+def wait_for_game_version(game_id, since, timeout):
+    """Block until the game's version moves past `since` or the timeout expires."""
+    deadline = time.monotonic() + timeout
+    # Listen before reading the version, so a move committed in between still wakes us
+    with realtime.hub.listen(realtime.game_channel(game_id)) as published:
+        while True:
+            published.clear()
+            version = Game.objects.filter(id=game_id).values_list('version', flat=True).first()
+            if version is None or version > since:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            published.wait(min(remaining, LONG_POLL_RECHECK))
 
 
 @login_required(login_url='/login/')
 def get_game_state(request, game_id):
+    # Long-poll mode: ?since=<version> holds the request until the state changes
+    since = request.GET.get('since')
+    if since is not None and since.isdigit():
+        try:
+            timeout = min(float(request.GET.get('timeout', LONG_POLL_TIMEOUT)), LONG_POLL_TIMEOUT)
+        except ValueError:
+            timeout = LONG_POLL_TIMEOUT
+        wait_for_game_version(game_id, int(since), max(timeout, 0))
+
+    current_game = get_object_or_404(Game.objects.select_related('player1', 'player2'), id=game_id)
+
+    # Answer 304 Not Modified if the client already has this version
+    wire_format = game_state_format(request)
+    etag = game_state_etag(current_game, wire_format)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        content, content_type = encode_game_state(current_game, wire_format)
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def encode_game_state(game, wire_format='full'):
+    """Serialize a game's state for the wire; returns (text, content type)."""
+    if wire_format == 'compact':
+        return json.dumps(compact_game_state_payload(game), separators=(',', ':')), COMPACT_MEDIA_TYPE
+    # Splice in the board JSON that was serialized once when the position was rendered
+    rendered = render_position(game.fen)
+    header = json.dumps(game_state_header(game, rendered))
+    return f'{header[:-1]}, "page_data": {rendered.page_data_json}}}', 'application/json'
+
+
+# Compact state: the FEN plus a small header; the client renders the pieces
+# and checks moves against the legal move list ('lm') before submitting them
+def compact_game_state_payload(game):
+    return {
+        'id': game.id,
+        'v': game.version,
+        'fen': chess.STARTING_FEN if game.fen == 'startpos' else game.fen,
+        'p1': game.player1.username,
+        'p2': game.player2.username,
+        'n': game.moves,
+        'a': game.active,
+        'o': game.outcome,
+        'lm': legal_moves(game.fen) if game.active else '',
+    }
+
+
+# State of a game as sent to polling clients and pushed over the websocket
+def game_state_payload(game):
+    rendered = render_position(game.fen)
+    payload = game_state_header(game, rendered)
+    payload['page_data'] = rendered.page_data
+    return payload
+
+
+def game_state_header(game, rendered):
+    return {
+        'current_turn': rendered.turn,
+        'current_game_id': game.id,
+        'player1': game.player1.username,
+        'player2': game.player2.username,
+        'moves': game.moves,
+        'version': game.version,
+        'active': game.active,  # Added active status
+        'outcome': game.outcome,  # Optionally include outcome for user feedback
+    }
+
+
+@login_required(login_url='/login/')
+def submit_move(request, game_id):
+    """JSON move/resignation API; answers with just the new version and the changed squares."""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request method.'}, status=405)
+
+    current_game = get_object_or_404(Game.objects.select_related('player1', 'player2'), id=game_id)
+    if request.user.id not in (current_game.player1_id, current_game.player2_id):
+        return JsonResponse({'success': False, 'error': 'You are not playing in this game.'}, status=403)
+
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid JSON.'}, status=400)
+        if not isinstance(data, dict):
+            return JsonResponse({'success': False, 'error': 'Expected a JSON object.'}, status=400)
+    else:
+        data = request.POST
+
+    # Version of the game the client made the move against, if it sent one
+    version = data.get('version')
+    try:
+        version = int(version) if version not in (None, '') else None
+    except (TypeError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Invalid version.'}, status=400)
+
+    try:
+        if data.get('resign'):
+            gameplay.resign(current_game, request.user)
+            return JsonResponse({'success': True, 'v': current_game.version, 'a': False, 'o': current_game.outcome})
+
+        before = current_game.fen
+        chess_board = gameplay.play_move(current_game, request.user, str(data.get('uci', '')).strip().lower(), version)
+    except gameplay.NotYourTurn:
+        return JsonResponse({'success': False, 'error': "It's not your turn."}, status=403)
+    except gameplay.IllegalMove as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except gameplay.MoveConflict:
+        return JsonResponse({
+            'success': False,
+            'error': 'The game changed before your move was saved. Please try again.',
+            'v': Game.objects.filter(id=game_id).values_list('version', flat=True).first(),
+        }, status=409)
+
+    return JsonResponse({
+        'success': True,
+        'v': current_game.version,
+        'changed': changed_squares(before, chess_board),
+        'turn': current_game.turn,
+        'a': current_game.active,
+        'o': current_game.outcome,
+        'lm': legal_moves(current_game.fen, chess_board) if current_game.active else '',
+    })
+
+
+def changed_squares(fen_before, chess_board):
+    """{square name: piece letter or ''} for every square that differs after the move."""
+    old_squares = pack_board_squares(chess.Board(normalize_fen(fen_before)))
+    new_squares = pack_board_squares(chess_board)
+    return {
+        chess.SQUARE_NAMES[square]: new.replace('.', '')
+        for square, (old, new) in enumerate(zip(old_squares, new_squares))
+        if old != new
+    }
+
+
+@login_required(login_url='/login/')
+def get_legal_moves(request, game_id):
+    # Legal moves in the current position, for clients validating moves locally
     current_game = get_object_or_404(Game, id=game_id)
+    etag = f'"{current_game.id}-{current_game.version}-lm"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse({
+            'v': current_game.version,
+            'lm': legal_moves(current_game.fen) if current_game.active else '',
+        })
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
-    if not current_game:
-        return JsonResponse({'error': 'Game not found'}, status=404)
 
-    # Prepare the response with the current FEN and whose turn it is
-    chess_board = chess.Board(current_game.fen) if current_game.fen != 'startpos' else chess.Board()
-    current_turn = 'white' if chess_board.turn else 'black'
+@login_required(login_url='/login/')
+def export_pgn(request):
+    # The export changes exactly when the user's game list does (see game_list.invalidate)
+    etag = f'"pgn-{request.user.id}-{game_list.generation(request.user.id)}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        # Stream the user's games as PGN; nothing is buffered beyond one chunk of games
+        games = pgn.games_for(request.user)
+        if isinstance(request, ASGIRequest):
+            content = pgn.aexport_pgn(
+                games, user=request.user, chunk_size=pgn.CHUNK_SIZE, batch_size=pgn.ASYNC_BATCH_SIZE,
+            )
+        else:
+            content = pgn.export_pgn(games, user=request.user, chunk_size=pgn.CHUNK_SIZE)
+        response = StreamingHttpResponse(content, content_type='application/x-chess-pgn')
+        response['Content-Disposition'] = f'attachment; filename="{request.user.username}.pgn"'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@login_required(login_url='/login/')
+def play_computer(request):
+    # Start a game against the built-in engine, the user playing white
+    if request.method == 'POST' and not Game.objects.filter(
+        Q(player1=request.user) | Q(player2=request.user), active=True
+    ).exists():
+        try:
+            computer.start_game(request.user)
+        except ImproperlyConfigured:
+            logger.exception('event=computer_unavailable')
+            return redirect('home')
+    return redirect('game_in_progress')
+
+
+@login_required(login_url='/login/')
+def hint(request, game_id):
+    """POST starts searching a hint for the user's move; GET ?v=<version> waits for it."""
+    current_game = get_object_or_404(Game, id=game_id)
+    if not computer.is_computer(current_game.player2_id) or request.user.id != current_game.player1_id:
+        return JsonResponse({'success': False, 'error': 'Hints are only available against the computer.'}, status=403)
+    if not current_game.active or current_game.turn != 'white':
+        return JsonResponse({'success': False, 'error': "It's not your turn."}, status=409)
+
+    if request.method == 'POST':
+        found = computer.request_hint(current_game, request.user)
+    else:
+        version = request.GET.get('v', '')
+        if version != str(current_game.version):
+            return JsonResponse({'success': False, 'error': 'The position has changed.', 'v': current_game.version},
+                                status=409)
+        found = computer.wait_for_hint(current_game, request.user)
+    if found is None:
+        return JsonResponse({'success': True, 'ready': False, 'v': current_game.version}, status=202)
+    return JsonResponse({'success': True, 'ready': True, 'v': current_game.version, **found})
 
-    # Convert the chess board to the necessary format for front-end rendering
-    page_data = load_board_from_fen(current_game.fen)
 
+@login_required(login_url='/login/')
+def opening_explorer(request):
+    """Moves played from a position in finished games, with results: ?fen=<FEN> or ?moves=e2e4,e7e5."""
+    moves = [uci for uci in request.GET.get('moves', '').split(',') if uci]
+    try:
+        chess_board = openings.board_for(request.GET.get('fen'), moves)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    explored = openings.explore(chess_board)
     return JsonResponse({
-        'page_data': page_data,
-        'current_turn': current_turn,
-        'current_game_id': current_game.id,
-        'player1': current_game.player1.username,
-        'player2': current_game.player2.username,
-        'moves': current_game.moves,
-        'active': current_game.active,  # Added active status
-        'outcome': current_game.outcome,  # Optionally include outcome for user feedback
+        'success': True,
+        'fen': chess_board.fen(),
+        'games': sum(row['games'] for row in explored),
+        'moves': explored,
     })
 
 
@@ -451,12 +632,13 @@ def send_challenge_ajax(request):
             if opponent == request.user:
                 return JsonResponse({'success': False, 'error': 'You cannot challenge yourself.'})
             # Check if the opponent is online
-            active_sessions = Session.objects.filter(expire_date__gte=timezone.now())
-            logged_in_user_ids = [int(session.get_decoded().get('_auth_user_id')) for session in active_sessions if session.get_decoded().get('_auth_user_id')]
-            if opponent.id in logged_in_user_ids:
-                # Create a new game
-                new_game = Game.objects.create(player1=request.user, player2=opponent, active=True)
-                return JsonResponse({'success': True})
+            if presence.is_online(opponent.id):
+                # Drop it in their inbox; the game starts once they accept
+                try:
+                    challenge = challenges.send_challenge(request.user, opponent)
+                except challenges.ChallengeError as e:
+                    return JsonResponse({'success': False, 'error': str(e)})
+                return JsonResponse({'success': True, 'challenge_id': challenge.id})
             else:
                 return JsonResponse({'success': False, 'error': 'Opponent is not online.'})
         else:
@@ -465,10 +647,67 @@ def send_challenge_ajax(request):
         return JsonResponse({'success': False, 'error': 'Invalid request method.'})
 
 @login_required(login_url='/login/')
-def check_for_challenges(request):
-    # Check if there is a Game where the user is player2, active=True, moves=0
-    pending_game = Game.objects.filter(player2=request.user, active=True, moves=0).first()
-    if pending_game:
-        return JsonResponse({'challenge_received': True})
-    else:
-        return JsonResponse({'challenge_received': False})
+def challenge_inbox(request):
+    # Long-poll: held open until a challenge arrives, a sent challenge is
+    # answered or a game starts, or until the wait times out
+    after = request.GET.get('after', '0')
+    sent = request.GET.get('sent')
+    try:
+        timeout = min(float(request.GET.get('timeout', challenges.INBOX_WAIT)), challenges.INBOX_WAIT)
+    except ValueError:
+        timeout = challenges.INBOX_WAIT
+    state = challenges.wait_for_inbox(
+        request.user,
+        after=int(after) if after.isdigit() else 0,
+        sent=int(sent) if sent and sent.isdigit() else None,
+        timeout=max(timeout, 0),
+    )
+    return JsonResponse(state)
+
+
+@login_required(login_url='/login/')
+def respond_to_challenge(request, challenge_id):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request method.'}, status=405)
+    try:
+        challenge = challenges.respond(challenge_id, request.user, accept=request.POST.get('action') == 'accept')
+    except challenges.ChallengeError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=409)
+    if challenge is None:
+        return JsonResponse({'success': False, 'error': 'This challenge is no longer available.'})
+    return JsonResponse({'success': True, 'accepted': challenge.game_id is not None})
+
+
+# Prometheus scrape endpoint. Open to the addresses in METRICS_ALLOWED_IPS
+# (the scraper) and to staff; everyone else gets a 404
+def metrics_view(request):
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if request.META.get('REMOTE_ADDR') not in allowed_ips and not request.user.is_staff:
+        raise Http404
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def profiles(request):
+    # Where the time goes in the profiled requests, slowest views first
+    view = request.GET.get('view') or None
+    return render(request, 'chessboard/profiles.html', {
+        'views': profiling.hottest_views(),
+        'functions': profiling.hottest_functions(view=view),
+        'selected_view': view,
+        'recent': [name for name, _ in profiling.profile_files()[:50]],
+        'header': profiling.HEADER,
+        'token': profiling.profile_token(),
+        'sample_rate': profiling.SAMPLE_RATE,
+    })
+
+
+@staff_member_required
+def profile_file(request, name):
+    # Download one saved profile, to open in snakeviz, speedscope, flamegraph.pl...
+    if not profiling.PROFILE_NAME.match(name):
+        raise Http404
+    try:
+        return FileResponse(open(os.path.join(profiling.PROFILE_DIR, name), 'rb'), as_attachment=True)
+    except FileNotFoundError:
+        raise Http404
@@ -43,11 +43,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "chessboard.middleware.MetricsMiddleware",
+    "chessboard.middleware.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "chessboard.middleware.PresenceMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -135,3 +138,56 @@ STATICFILES_DIRS = [ STATIC_DIR ]
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Addresses allowed to scrape /metrics without logging in (staff always can)
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Request profiling (see chessboard/profiling.py): profile 1 in N requests,
+# 0 to only profile requests sent with a signed X-Profile header
+PROFILE_SAMPLE_RATE = 0
+PROFILE_MODE = 'sample'  # or 'cprofile' for .pstats files (on 3.12+ these include other threads)
+PROFILE_DIR = BASE_DIR / 'profiles'
+PROFILE_MAX_FILES = 200
+
+# Game-state long-polls are woken as soon as a move is committed in the same
+# process; they re-read the game this often (seconds) to catch moves
+# committed by other server processes
+LONG_POLL_RECHECK = 10
+
+# Built-in engine (see chessboard/computer.py): worker processes searching
+# moves, and seconds spent per computer move and per hint
+ENGINE_WORKERS = 2
+ENGINE_MOVE_TIME = 1.0
+ENGINE_HINT_TIME = 0.5
+
+# Opening explorer (see chessboard/openings.py): plies of each game indexed,
+# and how many early plies are served from an in-memory cache
+OPENING_PLIES = 40
+OPENING_CACHE_PLIES = 8
+
+# Logging
+# https://docs.djangoproject.com/en/4.2/topics/logging/
+# Log lines are key=value pairs so they can be parsed by log tooling
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "keyvalue": {
+            "format": "time=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s",
+        },
+    },
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+            "formatter": "keyvalue",
+        },
+    },
+    "loggers": {
+        "chessboard": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}
@@ -37,6 +37,16 @@ urlpatterns = [
     path('delete-game/<int:game_id>/', chessboard_view.delete_game, name='delete_game'), 
     path('online-users-ajax/', chessboard_view.online_users_ajax, name='online_users_ajax'),
     path('get-game-state/<int:game_id>/', chessboard_view.get_game_state, name='get_game_state'),
+    path('play-computer/', chessboard_view.play_computer, name='play_computer'),
+    path('hint/<int:game_id>/', chessboard_view.hint, name='hint'),
+    path('legal-moves/<int:game_id>/', chessboard_view.get_legal_moves, name='legal_moves'),
+    path('submit-move/<int:game_id>/', chessboard_view.submit_move, name='submit_move'),
+    path('metrics', chessboard_view.metrics_view, name='metrics'),
+    path('profiles/', chessboard_view.profiles, name='profiles'),
+    path('profiles/<str:name>', chessboard_view.profile_file, name='profile_file'),
+    path('explorer/', chessboard_view.opening_explorer, name='opening_explorer'),
+    path('export-pgn/', chessboard_view.export_pgn, name='export_pgn'),
     path('send-challenge-ajax/', chessboard_view.send_challenge_ajax, name='send_challenge_ajax'),
-    path('check-for-challenges/', chessboard_view.check_for_challenges, name='check_for_challenges'),
+    path('challenge-inbox/', chessboard_view.challenge_inbox, name='challenge_inbox'),
+    path('respond-to-challenge/<int:challenge_id>/', chessboard_view.respond_to_challenge, name='respond_to_challenge'),
 ]
\ No newline at end of file
@@ -14,4 +14,58 @@ function movePiece() {
   function resetBoard() {
     window.location.reload();
   }
-  
\ No newline at end of file
+
+  // Mapping of FEN piece letters to their Unicode chess symbols
+  var PIECE_SYMBOLS = {
+    'K': '&#9812;', 'Q': '&#9813;', 'R': '&#9814;', 'B': '&#9815;', 'N': '&#9816;', 'P': '&#9817;',
+    'k': '&#9818;', 'q': '&#9819;', 'r': '&#9820;', 'b': '&#9821;', 'n': '&#9822;', 'p': '&#9823;'
+  };
+
+  // Draw the piece placement of a FEN onto the board cells (ids a1..h8)
+  function renderFen(fen) {
+    var ranks = fen.split(' ')[0].split('/');
+    for (var i = 0; i < 8; i++) {
+      var rank = 8 - i;
+      var file = 0;
+      for (var c of ranks[i]) {
+        if (c >= '1' && c <= '8') {
+          for (var n = 0; n < Number(c); n++, file++) {
+            setSquare(String.fromCharCode(97 + file) + rank, '');
+          }
+        } else {
+          setSquare(String.fromCharCode(97 + file) + rank, c);
+          file++;
+        }
+      }
+    }
+  }
+
+  // Only touch the cells whose piece actually changed
+  function setSquare(square, piece) {
+    var cell = document.getElementById(square);
+    if (cell && cell.dataset.piece !== piece) {
+      cell.dataset.piece = piece;
+      cell.innerHTML = PIECE_SYMBOLS[piece] || '&nbsp;';
+    }
+  }
+
+  // Side to move from a FEN: 'white' or 'black'
+  function fenTurn(fen) {
+    return fen.split(' ')[1] === 'b' ? 'black' : 'white';
+  }
+
+  // Parse the space-separated UCI move list sent by the server into a Set
+  function parseLegalMoves(list) {
+    return new Set((list || '').split(' ').filter(Boolean));
+  }
+
+  // Squares a piece on `from` may move to, given a Set of legal UCI moves
+  function legalTargets(legalMoves, from) {
+    var targets = new Set();
+    legalMoves.forEach(function (move) {
+      if (move.slice(0, 2) === from) {
+        targets.add(move.slice(2, 4));
+      }
+    });
+    return targets;
+  }